@@ -0,0 +1,276 @@
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from queue import Empty
+from typing import List, Tuple, Optional, Callable
+
+import numpy as np
+import cv2
+import rasterio
+import rasterio.transform
+
+from . import config
+from .files import PathConfig
+from .timing import timings, peak_rss_mb
+
+
+def make_synthetic_sector(
+        filename: Path,
+        sector: Tuple[int, int],
+        pixels: int,
+        seed: int = 23,
+):
+    """
+    Write a GeoTiff that looks like an opendtm sector: EPSG:25832, 40km extent
+    at a reduced resolution of `pixels`², float32 heights with -32768 as nodata.
+    """
+    rng = np.random.default_rng((seed, *sector))
+    coarse = rng.normal(size=(pixels // 64 + 2, pixels // 64 + 2)).astype(np.float32)
+    heights = cv2.resize(coarse, (pixels, pixels), interpolation=cv2.INTER_CUBIC) * 80 + 300
+    yy, xx = np.mgrid[:pixels, :pixels].astype(np.float32) / pixels
+    heights += np.sin(xx * 31 + sector[0]) * np.cos(yy * 23 + sector[1]) * 20
+    heights += rng.normal(size=heights.shape).astype(np.float32) * .3
+
+    # some sectors have a nodata border, like the ones at the german border
+    if rng.random() < .5:
+        heights[xx + yy * rng.random() < rng.random() * .5] = -32768
+
+    os.makedirs(filename.parent, exist_ok=True)
+    with rasterio.open(
+            filename, "w",
+            driver="GTiff",
+            width=pixels,
+            height=pixels,
+            count=1,
+            dtype="float32",
+            crs=rasterio.crs.CRS.from_epsg(25832),
+            transform=rasterio.transform.from_origin(
+                sector[0] * 1000, (sector[1] + 40) * 1000, 40_000 / pixels, 40_000 / pixels,
+            ),
+            nodata=-32768,
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+    ) as ds:
+        ds.write(heights.astype(np.float32), 1)
+
+
+def command_benchmark(
+        pathconfig: PathConfig,
+        sectors: List[Tuple[int, int]],
+        pixels: int,
+        zoom: int,
+        resolution: int,
+        workers: int,
+        output: Optional[str],
+        keep: bool,
+        verbose: bool,
+):
+    result = run_benchmark(
+        sectors=sectors,
+        pixels=pixels,
+        zoom=zoom,
+        resolution=resolution,
+        workers=workers,
+        keep_path=Path(tempfile.mkdtemp(prefix="opendtm-benchmark-")) if keep else None,
+        verbose=verbose,
+    )
+
+    if output is None:
+        output = config.PROJECT_PATH / "benchmarks" / (
+            f"{result['meta']['date'][:19].replace(':', '-')}-{result['meta']['commit'] or 'unknown'}.json"
+        )
+    output = Path(output)
+    os.makedirs(output.parent, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+
+    if verbose:
+        for name, stage in result["stages"].items():
+            print(
+                f"{name:12} {stage['seconds']:8.2f}s {stage['tiles']:8} tiles {stage['tiles_per_second']:9.1f} tiles/s"
+                f" {stage['mb_per_second']:8.1f} MB/s  peak rss {stage['peak_rss_mb']:.0f} MB"
+            )
+        for module, seconds in result["import_seconds"].items():
+            print(f"import {module:18} {seconds:6.3f}s")
+        print(f"saved {output}")
+
+
+def run_benchmark(
+        sectors: List[Tuple[int, int]],
+        pixels: int = 4000,
+        zoom: int = 13,
+        resolution: int = 256,
+        workers: int = 1,
+        keep_path: Optional[Path] = None,
+        verbose: bool = False,
+) -> dict:
+    """
+    Run reproject, render, downsample and preview on synthetic sectors,
+    each stage in a separate process to measure its peak memory.
+    """
+    from .reproject import command_reproject
+    from .rendertiles import command_render
+    from .downsample import command_downsample
+    from .preview import command_preview
+
+    with tempfile.TemporaryDirectory(prefix="opendtm-benchmark-") as temp_path:
+        base_path = keep_path or Path(temp_path)
+        pathconfig = PathConfig(
+            web_cache_path=base_path / "web",
+            tile_cache_path=base_path / "tiles-cache",
+            tile_output_path=base_path / "tiles",
+        )
+        for sector in sectors:
+            make_synthetic_sector(pathconfig.web_cache_file(*sector), sector, pixels)
+        source_bytes = sum(pathconfig.web_cache_file(*s).stat().st_size for s in sectors)
+
+        common = dict(pathconfig=pathconfig, verbose=False)
+        stages = [
+            ("reproject", lambda: command_reproject(
+                sectors=sectors, zoom=[zoom], resolution=resolution, reset=True, **common,
+            ), lambda: _count_files(pathconfig.tile_cache_path() / str(zoom), ".npz")),
+            ("render", lambda: command_render(
+                modality=["normal"], cache_zoom=zoom, tile_zoom=None, resolution=None,
+                edge_cache_size=10_000, tile_cache_size=1, approximate=False,
+                workers=workers, overwrite=True, **common,
+            ), lambda: _count_files(pathconfig.tile_output_path("normal") / str(zoom), ".png")),
+            ("downsample", lambda: command_downsample(
+                modality="normal", zoom=[zoom, zoom - 3], workers=workers, overwrite=True, **common,
+            ), lambda: sum(
+                _count_files(pathconfig.tile_output_path("normal") / str(z), ".png")
+                for z in range(zoom - 3, zoom)
+            )),
+            ("preview", lambda: command_preview(
+                modality="normal", zoom=zoom, resolution=None, padding=0,
+                edge_cache_size=10_000, tile_cache_size=1, approximate=False, numbers=False, **common,
+            ), lambda: _count_files(pathconfig.tile_cache_path() / str(zoom), ".npz")),
+        ]
+
+        result = {
+            "meta": {
+                "date": datetime.datetime.now().isoformat(),
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "cv2": cv2.__version__,
+                "gdal": rasterio.__gdal_version__,
+                "cpus": os.cpu_count(),
+                "sectors": sectors,
+                "pixels": pixels,
+                "zoom": zoom,
+                "resolution": resolution,
+                "workers": workers,
+                "source_mb": round(source_bytes / 1e6, 3),
+            },
+            "stages": {},
+            "import_seconds": measure_import_times(),
+        }
+        cwd = os.getcwd()
+        os.chdir(base_path)
+        try:
+            for name, func, count_tiles in stages:
+                stage = _run_stage(func)
+                stage["tiles"] = count_tiles()
+                seconds = max(stage["seconds"], 1e-9)
+                io_bytes = sum(
+                    s["bytes"] for key, s in stage["timings"].items()
+                    if key in ("tiff_read", "read", "write")
+                )
+                stage["tiles_per_second"] = round(stage["tiles"] / seconds, 3)
+                stage["mb_per_second"] = round(io_bytes / seconds / 1e6, 3)
+                result["stages"][name] = stage
+                if verbose:
+                    print(f"{name}: {stage['seconds']:.2f}s")
+        finally:
+            os.chdir(cwd)
+
+    return result
+
+
+def measure_import_times(modules: Optional[List[str]] = None) -> dict:
+    """
+    Seconds to import the cli and each command module in a fresh interpreter,
+    which every command and every spawned worker pays
+    """
+    from .cli import COMMAND_MODULES
+    if modules is None:
+        modules = ["src.cli", *sorted(set(COMMAND_MODULES.values()))]
+    result = {}
+    for module in modules:
+        output = subprocess.check_output(
+            [
+                sys.executable, "-c",
+                f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)",
+            ],
+            cwd=config.PROJECT_PATH,
+        )
+        result[module] = round(float(output.decode().strip().splitlines()[-1]), 4)
+    return result
+
+
+def _run_stage(func: Callable) -> dict:
+    queue = multiprocessing.get_context("fork").Queue()
+    process = multiprocessing.get_context("fork").Process(target=_stage_process, args=(func, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1.)
+            break
+        except Empty:
+            # a stage that is killed (out of memory, segfault) never sends a result
+            if not process.is_alive():
+                try:
+                    result = queue.get(timeout=1.)
+                    break
+                except Empty:
+                    raise RuntimeError(f"Benchmark stage died with exit code {process.exitcode}")
+    process.join()
+    if "error" in result:
+        raise RuntimeError(f"Benchmark stage failed: {result['error']}")
+    return result
+
+
+def _stage_process(func: Callable, queue: multiprocessing.Queue):
+    try:
+        timings.reset()
+        baseline_rss = _current_rss()
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        queue.put({
+            "seconds": round(seconds, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "baseline_rss_mb": round(baseline_rss / 2**20, 1),
+            "timings": timings.report()["stages"],
+        })
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def _current_rss() -> int:
+    try:
+        return int(Path("/proc/self/statm").read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _count_files(path: Path, extension: str) -> int:
+    return sum(1 for _ in path.rglob(f"*{extension}")) if path.exists() else 0
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=config.PROJECT_PATH, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
@@ -1,15 +1,36 @@
 import argparse
-from typing import List, Tuple
-
-from tqdm import tqdm
+import importlib
+import sys
+import time
+from functools import partial
+from typing import List, Tuple, Optional
 
 from src import config
 from src.opendtm import OpenDTM
 from src.files import PathConfig
-from src.reproject import command_reproject, command_show_resolution
-from src.preview import command_preview
-from src.rendertiles import command_render
-from src.downsample import command_downsample
+from src.encoders import ENCODERS
+from src.modalities import MODALITIES
+from src.timing import timings, PeriodicLogger
+
+
+# the command modules are imported on demand, so each command
+# only loads the libraries it needs (rasterio/GDAL, cv2, PIL, ...)
+COMMAND_MODULES = {
+    "reproject": "src.reproject",
+    "show_resolution": "src.reproject",
+    "preview": "src.preview",
+    "pyramid": "src.pyramid",
+    "edges": "src.edges",
+    "render": "src.rendertiles",
+    "downsample": "src.downsample",
+    "serve": "src.server",
+    "loadtest": "src.loadtest",
+    "benchmark": "src.benchmark",
+    "benchmark_encoders": "src.encoders",
+    "query": "src.query",
+    "plan": "src.plan",
+    "lease_status": "src.lease",
+}
 
 
 def parse_args() -> dict:
@@ -21,6 +42,24 @@ def parse_args() -> dict:
 
     main_parser.add_argument("-wc", "--web-cache-path", type=str, default=pathconfig.web_cache_path)
     main_parser.add_argument("-tc", "--tile-cache-path", type=str, default=pathconfig.tile_cache_path(None))
+    main_parser.add_argument(
+        "-of", "--output-format", type=str, default="png", choices=list(ENCODERS),
+        help="Encoder of the output tiles, png-fast trades size for speed, png-opt writes the smallest"
+             " lossless png color type, webp is lossless",
+    )
+
+    main_parser.add_argument(
+        "--report", type=str, default=None,
+        help="Write the per-stage timings (time, bytes, counts) as JSON to this file",
+    )
+    main_parser.add_argument(
+        "--report-interval", type=float, default=None,
+        help="Print the per-stage timings every N seconds",
+    )
+    main_parser.add_argument(
+        "--profile", type=str, default=None,
+        help="Run the command inside cProfile and dump the stats to this file",
+    )
 
     subparsers = main_parser.add_subparsers()
 
@@ -44,19 +83,63 @@ def parse_args() -> dict:
             help=f"Tile y extent to consider, two numbers for a range",
         )
 
+    def _add_lazy(parser: argparse.ArgumentParser):
+        parser.add_argument(
+            "--lazy", type=bool, nargs="?", default=False, const=True,
+            help="Process all tiles of the --tile-x/--tile-y ranges and reproject missing cache tiles"
+                 " on demand from the extracted sectors",
+        )
+
+    def _add_lease_args(parser: argparse.ArgumentParser, required: bool = False):
+        parser.add_argument(
+            "--lease-dir", type=str, default=None, required=required,
+            help="Directory on a shared filesystem, through which several nodes claim work units",
+        )
+        parser.add_argument(
+            "--lease-ttl", type=float, default=120.,
+            help="Seconds without heartbeat after which the lease of a node is taken over",
+        )
+        if not required:
+            parser.add_argument(
+                "--node-id", type=str, default=None,
+                help="Name of this node in the lease directory, default is {hostname}-{pid}",
+            )
+            parser.add_argument(
+                "--lease-reset", type=bool, nargs="?", default=False, const=True,
+                help="Do the work units again that a previous run has marked done in the lease directory."
+                     " Pass it to one node and start the others after it",
+            )
+
+    def _add_write_workers(parser: argparse.ArgumentParser):
+        parser.add_argument(
+            "-wj", "--write-workers", type=int, default=2,
+            help="Number of background threads that compress and write the tiles, 0 writes in the compute threads",
+        )
+
     def _add_random_order(parser: argparse.ArgumentParser):
         parser.add_argument(
             "-ro", "--random-order", type=bool, nargs="?", default=False, const=True,
             help="Randomize order of processing the tile files",
         )
 
-    def _add_modality(parser: argparse.ArgumentParser):
+    def _add_modality(parser: argparse.ArgumentParser, multiple: bool = False, choices=MODALITIES):
         parser.add_argument(
-            "-m", "--modality", type=str, default="height",
-            choices=("height", "normal"),
+            "-m", "--modality", type=str, default=["height"] if multiple else "height",
+            nargs="+" if multiple else None,
+            choices=choices,
             help="Set the modality to preview, render or downsample",
         )
 
+    def _add_hillshade_args(parser: argparse.ArgumentParser):
+        parser.add_argument(
+            "-az", "--azimuth", type=float, default=315.,
+            help="Direction of the hillshade light in degrees, clockwise from north",
+        )
+        parser.add_argument(
+            "-al", "--altitude", type=float, default=45.,
+            help="Angle of the hillshade light above the horizon in degrees",
+        )
+
     def _add_normal_args(parser: argparse.ArgumentParser):
         parser.add_argument("-tcs", "--tile-cache-size", type=int, default=1)
         parser.add_argument("-ecs", "--edge-cache-size", type=int, default=10_000)
@@ -68,24 +151,47 @@ def parse_args() -> dict:
     parser = subparsers.add_parser("cache")
     parser.set_defaults(command="cache")
     _add_sector_args(parser)
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1,
+        help="Number of sectors to download and extract in parallel",
+    )
+    parser.add_argument(
+        "-dpc", "--drop-page-cache", type=bool, nargs="?", default=False, const=True,
+        help="Advise the kernel to not keep the extracted GeoTiffs in the page cache",
+    )
 
     parser = subparsers.add_parser("reproject")
     parser.set_defaults(command="reproject")
     _add_sector_args(parser)
     _add_tile_args(parser)
     parser.add_argument("-r", "--resolution", type=int, default=256)
-    parser.add_argument("-z", "--zoom", type=int, default=10)
+    parser.add_argument(
+        "-z", "--zoom", type=int, nargs="+", default=[10],
+        help="One or more zoom levels. The source is only warped to the highest one, lower levels"
+             " are reduced from it in the same pass. Tile ranges refer to the highest zoom level",
+    )
     parser.add_argument(
         "-R", "--reset", type=bool, nargs="?", default=False, const=True,
         help="Delete the tile cache directory for that zoom level before sampling reprojections",
     )
+    parser.add_argument(
+        "-mt", "--metatile", type=int, default=0,
+        help="Warp blocks of N x N tiles at once from a mosaic of all sectors, instead of each tile"
+             " of each sector separately. This removes the seams at sector borders. N must be a power of 2",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1,
+        help="Number of sectors to reproject in parallel, the largest first. Not used with --metatile",
+    )
+    _add_write_workers(parser)
+    _add_lease_args(parser)
 
     parser = subparsers.add_parser(
         "preview",
         help="Preview the reprojected tiles (or normal-maps) by rendering them into one image",
     )
     parser.set_defaults(command="preview")
-    _add_modality(parser)
+    _add_modality(parser, choices=("height", "normal"))
     parser.add_argument("-z", "--zoom", type=int, default=10)
     parser.add_argument("-r", "--resolution", type=int, default=None, help="resolution per tile in preview")
     parser.add_argument("-p", "--padding", type=int, default=1, help="padding between tiles")
@@ -94,25 +200,76 @@ def parse_args() -> dict:
         "-n", "--numbers", type=bool, nargs="?", default=False, const=True,
         help="Just print the numbers of the grid",
     )
+    parser.add_argument(
+        "-np", "--no-pyramid", type=bool, nargs="?", default=False, const=True,
+        help="Do not use the height pyramid, even if it has a level for the resolution",
+    )
+    _add_lazy(parser)
     _add_tile_args(parser)
 
+    parser = subparsers.add_parser(
+        "pyramid",
+        help="Build the multi-resolution height pyramid, used for fast low-resolution previews",
+    )
+    parser.set_defaults(command="pyramid")
+    _add_tile_args(parser)
+    parser.add_argument("-z", "--zoom", type=int, default=10)
+    parser.add_argument(
+        "-mr", "--max-resolution", type=int, default=32,
+        help="Highest resolution per tile to store in the pyramid, levels go down to 1",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument(
+        "-O", "--overwrite", type=bool, nargs="?", default=False, const=True,
+        help="Rebuild the whole pyramid instead of updating changed blocks",
+    )
+
+    parser = subparsers.add_parser(
+        "edges",
+        help="Build the store of tile edges from the tile cache, reprojection keeps it up-to-date afterwards",
+    )
+    parser.set_defaults(command="edges")
+    _add_tile_args(parser)
+    parser.add_argument("-z", "--zoom", type=int, default=10)
+    parser.add_argument("-j", "--workers", type=int, default=1)
+
     parser = subparsers.add_parser(
         "render",
         help="Render png images from the reprojected tiles"
     )
     parser.set_defaults(command="render")
-    _add_modality(parser)
+    _add_modality(parser, multiple=True)
+    _add_hillshade_args(parser)
     _add_tile_args(parser)
     parser.add_argument("-z", "--cache-zoom", type=int, default=10)
-    parser.add_argument("-tz", "--tile-zoom", type=int, default=None)
+    parser.add_argument(
+        "-tz", "--tile-zoom", type=int, nargs="+", default=None,
+        help="One or more zoom levels of the output tiles, defaults to the cache zoom."
+             " All modalities and zoom levels are rendered from one read of each cache tile",
+    )
     parser.add_argument("-r", "--resolution", type=int, default=None, help="resolution per tile in tile-zoom")
     _add_normal_args(parser)
     parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument(
+        "-mb", "--memory-budget", type=float, default=None,
+        help="Megabytes for the tile and edge caches of all workers, in addition to the cache sizes in items",
+    )
+    parser.add_argument(
+        "--processes", type=bool, nargs="?", default=False, const=True,
+        help="Run the workers as processes that share the decoded tiles and edges in shared memory",
+    )
+    parser.add_argument(
+        "-scs", "--shared-cache-size", type=int, default=1000,
+        help="Number of tiles in the shared memory cache of --processes",
+    )
+    _add_write_workers(parser)
+    _add_lazy(parser)
     _add_random_order(parser)
     parser.add_argument(
         "-O", "--overwrite", type=bool, nargs="?", default=False, const=True,
         help="Overwrite existing rendered tiles",
     )
+    _add_lease_args(parser)
 
     parser = subparsers.add_parser("downsample")
     parser.set_defaults(command="downsample")
@@ -127,6 +284,142 @@ def parse_args() -> dict:
         "-O", "--overwrite", type=bool, nargs="?", default=False, const=True,
         help="Overwrite existing rendered tiles",
     )
+    _add_lease_args(parser)
+
+    parser = subparsers.add_parser(
+        "serve",
+        help="Serve pre-rendered tiles and render missing tiles on demand from the height cache",
+    )
+    parser.set_defaults(command="serve")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-z", "--cache-zoom", type=int, default=10)
+    parser.add_argument("-r", "--resolution", type=int, default=256, help="resolution of rendered tiles")
+    _add_normal_args(parser)
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of render processes")
+    parser.add_argument(
+        "-rcs", "--response-cache-size", type=int, default=10_000,
+        help="Number of encoded tiles to keep in memory",
+    )
+    parser.add_argument(
+        "-wb", "--write-back", type=bool, nargs="?", default=False, const=True,
+        help="Store tiles rendered on demand in the tile output path",
+    )
+
+    parser = subparsers.add_parser(
+        "loadtest",
+        help="Request random tiles from a running server and report latencies",
+    )
+    parser.set_defaults(command="loadtest")
+    _add_tile_args(parser)
+    _add_modality(parser)
+    parser.add_argument("-u", "--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("-z", "--zoom", type=int, default=10)
+    parser.add_argument("-n", "--num-requests", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=None)
+
+    parser = subparsers.add_parser(
+        "benchmark",
+        help="Run reproject, render, downsample and preview on synthetic sectors and save the timings as JSON",
+    )
+    parser.set_defaults(command="benchmark")
+    parser.add_argument(
+        "-sx", "--sector-x", type=int, nargs="+", default=[640, 680],
+        help="Sector west->east extent of the synthetic sectors",
+    )
+    parser.add_argument(
+        "-sy", "--sector-y", type=int, nargs="+", default=[5600, 5640],
+        help="Sector north->south extent of the synthetic sectors",
+    )
+    parser.add_argument(
+        "-p", "--pixels", type=int, default=4000,
+        help="Width and height of each synthetic sector, the real ones have 40,000",
+    )
+    parser.add_argument("-z", "--zoom", type=int, default=13)
+    parser.add_argument("-r", "--resolution", type=int, default=256)
+    parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument(
+        "-o", "--output", type=str, default=None,
+        help="JSON file for the results, default is benchmarks/<date>-<commit>.json",
+    )
+    parser.add_argument(
+        "-k", "--keep", type=bool, nargs="?", default=False, const=True,
+        help="Keep the synthetic data in a temporary directory",
+    )
+
+    parser = subparsers.add_parser(
+        "query",
+        help="Bilinear heights at the points of a CSV file, from the tile cache or the sectors",
+    )
+    parser.set_defaults(command="query")
+    parser.add_argument(
+        "-s", "--source", type=str, default="cache", choices=["cache", "sectors"],
+        help="Sample the reprojected tile cache at --zoom or the extracted sector GeoTiffs",
+    )
+    parser.add_argument("-z", "--zoom", type=int, default=17)
+    parser.add_argument("-i", "--input", type=str, default=None, help="CSV file with header, default is stdin")
+    parser.add_argument("-o", "--output", type=str, default=None, help="CSV file, default is stdout")
+    parser.add_argument(
+        "--crs", type=str, default="EPSG:4326",
+        help="Coordinate system of the points, e.g. EPSG:4326 (lon/lat) or EPSG:25832",
+    )
+    parser.add_argument(
+        "-c", "--columns", type=str, nargs=2, default=["lon", "lat"],
+        help="Names of the x and y columns",
+    )
+    parser.add_argument(
+        "--step", type=float, default=None,
+        help="Treat the points as a polyline and sample a height profile every STEP meters",
+    )
+    parser.add_argument("-tcs", "--tile-cache-size", type=int, default=1000)
+
+    parser = subparsers.add_parser(
+        "benchmark-encoders",
+        help="Compare bytes and milliseconds per tile of the output encoders on tiles of the tile cache",
+    )
+    parser.set_defaults(command="benchmark_encoders")
+    _add_modality(parser, multiple=True)
+    _add_tile_args(parser)
+    parser.add_argument("-z", "--cache-zoom", type=int, default=10)
+    parser.add_argument(
+        "-e", "--encoder", type=str, nargs="+", default=None, choices=list(ENCODERS),
+        help="Encoders to compare, default is all",
+    )
+    parser.add_argument("-n", "--num-tiles", type=int, default=100, help="Number of random tiles per modality")
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON file for the results")
+
+    parser = subparsers.add_parser(
+        "plan",
+        help="Estimate tiles, bytes and cpu-hours of reproject, render and downsample without running them",
+    )
+    parser.set_defaults(command="plan")
+    _add_sector_args(parser)
+    _add_tile_args(parser)
+    _add_modality(parser, multiple=True)
+    parser.add_argument("-r", "--resolution", type=int, default=256)
+    parser.add_argument(
+        "-z", "--zoom", type=int, nargs="+", default=[10],
+        help="Zoom levels of the reprojection, the highest one is rendered",
+    )
+    parser.add_argument(
+        "-dz", "--downsample-zoom", type=int, default=None,
+        help="Lowest zoom level the rendered tiles are downsampled to",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument(
+        "-c", "--calibration", type=str, nargs="+", default=None,
+        help="benchmark results or --report timing files of sample runs,"
+             " default is the latest file in the benchmarks directory",
+    )
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON file for the plan")
+
+    parser = subparsers.add_parser(
+        "lease-status",
+        help="Show the progress of all jobs and nodes of a distributed run",
+    )
+    parser.set_defaults(command="lease_status")
+    _add_lease_args(parser, required=True)
 
     parser = subparsers.add_parser("show-paths")
     parser.set_defaults(command="show_paths")
@@ -179,6 +472,7 @@ def parse_args() -> dict:
     kwargs["pathconfig"] = PathConfig(
         web_cache_path=kwargs.pop("web_cache_path"),
         tile_cache_path=kwargs.pop("tile_cache_path"),
+        output_format=kwargs.pop("output_format"),
         random_order=kwargs.pop("random_order") if "random_order" in kwargs else False,
         tile_x=tile_x,
         tile_y=tile_y,
@@ -187,29 +481,87 @@ def parse_args() -> dict:
     return kwargs
 
 
-def main(command: str, **kwargs):
-    func = globals().get(f"command_{command}", None)
+def main(
+        command: str,
+        report: Optional[str] = None,
+        report_interval: Optional[float] = None,
+        profile: Optional[str] = None,
+        **kwargs,
+):
+    if command in COMMAND_MODULES:
+        func = getattr(importlib.import_module(COMMAND_MODULES[command]), f"command_{command}")
+    else:
+        func = globals().get(f"command_{command}", None)
     if func is None:
         raise ValueError(f"Unknown command '{command}'")
 
-    func(**kwargs)
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        func = partial(profiler.runcall, func)
+
+    try:
+        if report_interval:
+            with PeriodicLogger(report_interval):
+                func(**kwargs)
+        else:
+            func(**kwargs)
+    finally:
+        if profile:
+            profiler.dump_stats(profile)
+        if report:
+            timings.write_report(report, command=command)
+        if report_interval:
+            print(timings.log_line(), file=sys.stderr)
 
 
 def command_cache(
         pathconfig: PathConfig,
         sectors: List[Tuple[int, int]],
+        workers: int,
+        drop_page_cache: bool,
         verbose: bool,
 ):
+    from multiprocessing.pool import ThreadPool as Pool
+    from tqdm import tqdm
+
+    from src.schedule import schedule_sectors
+
     dtm = OpenDTM(verbose=verbose, pathconfig=pathconfig)
-    for sector in tqdm(sectors, desc="sectors", disable=not verbose):
+    # the largest downloads first, so a parallel run does not end with one of them alone
+    sectors, costs, sector_costs = schedule_sectors(
+        pathconfig, dtm, sectors, workers, rate_key="cache", remote=workers > 1, verbose=verbose,
+    )
+    sector_seconds = {}
+
+    def _cache_sector(sector: Tuple[int, int]):
+        start_time = time.time()
+        needs_work = not pathconfig.web_cache_file(*sector).exists()
         dtm.download_sector(sector)
-        dtm.extract_sector(sector)
+        dtm.extract_sector(sector, drop_page_cache=drop_page_cache)
+        if needs_work:
+            sector_seconds[sector] = time.time() - start_time
+
+    if workers <= 1:
+        for sector in tqdm(sectors, desc="sectors", disable=not verbose):
+            _cache_sector(sector)
+    else:
+        with Pool(workers) as pool:
+            for _ in tqdm(
+                    pool.imap_unordered(_cache_sector, sectors),
+                    total=len(sectors), desc="sectors", disable=not verbose,
+            ):
+                pass
+
+    if sector_seconds:
+        sector_costs.add_measurement("cache", sum(sector_seconds.values()), sum(costs[s] for s in sector_seconds))
+        sector_costs.save()
 
 
 def command_show_paths(pathconfig: PathConfig, **kwargs):
     print(f"web-cache:  {pathconfig.web_cache_path}")
-    print(f"tile-cache: {pathconfig.tile_cache_path(modality="height")}")
-    print(f"            {pathconfig.tile_cache_path(modality="normal")}")
+    print(f"tile-cache: {pathconfig.tile_cache_path(modality='height')}")
+    print(f"            {pathconfig.tile_cache_path(modality='normal')}")
 
 
 if __name__ == "__main__":
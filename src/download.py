@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from typing import Union
+from typing import Union, Optional
 
 import requests
 from tqdm import tqdm
@@ -49,3 +49,17 @@ def streaming_download(
             if local_filename.exists():
                 os.remove(local_filename)
             raise
+
+
+def remote_file_size(url: str, timeout: float = 30.) -> Optional[int]:
+    """
+    The content-length of a file in web, without downloading it
+    """
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=timeout)
+    except requests.RequestException as e:
+        raise IOError(f"{type(e).__name__} for {url}: {e}")
+    if r.status_code != 200:
+        raise IOError(f"Status {r.status_code} for {r.request.url}")
+    size = r.headers.get("content-length")
+    return int(size) if size else None
@@ -6,10 +6,15 @@ from typing import List, Tuple, Optional
 
 from tqdm import tqdm
 import numpy as np
-import cv2
 import PIL.Image
 
 from .files import PathConfig, DeleteFileOnException, split_tile_file_map
+from .modalities import ENCODED_MODALITIES, encode_heights, decode_heights
+from .resample import reduce_2x2
+from .timing import timings
+
+# tile columns of a work unit in distributed runs
+UNIT_COLUMNS = 16
 
 
 def command_downsample(
@@ -19,7 +24,18 @@ def command_downsample(
         workers: int,
         overwrite: bool,
         verbose: bool,
+        lease_dir: Optional[str] = None,
+        node_id: Optional[str] = None,
+        lease_ttl: float = 120.,
+        lease_reset: bool = False,
 ):
+    """
+    Downsample the output tiles from zoom[0] down to zoom[1].
+
+    With `lease_dir`, the stripes of UNIT_COLUMNS tile columns of each level are split between
+    several nodes on a shared filesystem, which all wait for the level to complete, see `LeaseManager`.
+    Stripes that are done in the lease directory are skipped, `lease_reset` downsamples them again.
+    """
     if len(zoom) == 1:
         zoom = [zoom[0], zoom[0]]
     elif len(zoom) != 2:
@@ -37,7 +53,29 @@ def command_downsample(
             overwrite=overwrite,
         )
 
-        if workers <= 1 or len(downsampled_map) < workers*10:
+        if lease_dir:
+            from .lease import LeaseManager, job_name
+            units = {}
+            for key, up_tiles in downsampled_map.items():
+                units.setdefault(str(key[0] // UNIT_COLUMNS), {})[key] = up_tiles
+
+            def _downsample_unit(unit: str) -> dict:
+                return {"tiles": _downsample_level(downsampled_map=units[unit], **{**kwargs, "verbose": False})}
+
+            with LeaseManager(
+                    lease_dir, job_name(f"downsample-{modality}-z{zoom}", pathconfig),
+                    node_id=node_id, ttl=lease_ttl, reset=lease_reset,
+            ) as lease:
+                if lease.num_done_before and overwrite:
+                    warnings.warn(
+                        f"{lease.num_done_before} stripe(s) of zoom {zoom} are done by a previous run"
+                        f" and are not downsampled again, use --lease-reset to overwrite them"
+                    )
+                num_units = lease.process(sorted(units, key=int), _downsample_unit, workers=workers)
+            if verbose:
+                print(f"downsampled {num_units} of {len(units)} stripe(s) {zoom}->{zoom - 1} on node {lease.node_id}")
+
+        elif workers <= 1 or len(downsampled_map) < workers*10:
             _downsample_level(downsampled_map=downsampled_map, **kwargs)
         else:
             downsampled_map_batches = split_tile_file_map(downsampled_map, workers)
@@ -66,10 +104,14 @@ def _downsample_level(
         verbose: bool,
         overwrite: bool,
         tqdm_position: int = 0,
-):
+) -> int:
+    """
+    :return: number of written tiles
+    """
     progress = tqdm(downsampled_map.items(), desc=f"downsampling {zoom}->{zoom-1}", disable=not verbose, position=tqdm_position)
     num_incomplete = 0
     num_skipped = 0
+    num_written = 0
     for (x0, y0), up_tiles in progress:
         progress.set_postfix({"skipped": num_skipped, "incomplete": num_incomplete})
 
@@ -103,8 +145,17 @@ def _downsample_level(
         if tile is None or not num_pasted:
             continue
 
-        tile = tile.resize((up_tile.width, up_tile.height), PIL.Image.Resampling.BICUBIC)
+        with timings.measure("resize"):
+            if modality in ENCODED_MODALITIES:
+                # interpolating the packed channels would mix up the digits, average the heights instead
+                heights = decode_heights(np.asarray(tile.convert("RGBA")), modality)
+                tile = encode_heights(reduce_2x2(heights), modality)
+            else:
+                tile = tile.resize((up_tile.width, up_tile.height), PIL.Image.Resampling.BICUBIC)
         pathconfig.save_output_tile(zoom - 1, x0, y0, tile, modality=modality)
+        num_written += 1
+
+    return num_written
 
 
 
@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import warnings
+from multiprocessing.pool import ThreadPool as Pool
+from pathlib import Path
+from typing import Optional, Dict, Tuple
+
+from tqdm import tqdm
+import numpy as np
+
+from .files import PathConfig
+from .timing import timings
+
+
+EDGE_NAMES = ("left", "right", "bottom", "top")
+
+
+class EdgeStore:
+    """
+    The 1-pixel borders of all cached tiles of one zoom level.
+
+    Edges are stored in uncompressed shards of ``shard_size``² tiles,
+    which are memory-mapped, so a neighbour edge is a cheap lookup
+    instead of a tile decode:
+
+        {tile-cache}/height-edges/{zoom}/index.json
+        {tile-cache}/height-edges/{zoom}/{shard_x}/{shard_y}.npy          float32 (S, S, 4, resolution)
+        {tile-cache}/height-edges/{zoom}/{shard_x}/{shard_y}.present.npy  bool (S, S)
+
+    The edges are indexed [tile y, tile x, edge] with the edge order of `EDGE_NAMES`.
+    """
+    def __init__(self, pathconfig: PathConfig, zoom: int, shard_size: int = 64):
+        self.pathconfig = pathconfig
+        self.zoom = zoom
+        self.path = pathconfig.tile_edges_path(zoom)
+        self._index = None
+        self._shard_size = shard_size
+        self._shards: Dict[Tuple[int, int], Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def index(self) -> Optional[dict]:
+        if self._index is None:
+            filename = self.path / "index.json"
+            if filename.exists():
+                self._index = json.loads(filename.read_text())
+        return self._index
+
+    @property
+    def shard_size(self) -> int:
+        return self.index["shard_size"] if self.index else self._shard_size
+
+    def exists(self) -> bool:
+        return self.index is not None
+
+    def shard_filename(self, sx: int, sy: int, present: bool = False) -> Path:
+        return self.path / str(sx) / (f"{sy}.present.npy" if present else f"{sy}.npy")
+
+    def get(self, x: int, y: int) -> Optional[np.ndarray]:
+        """
+        Returns the four edges of a tile as array of shape (4, resolution),
+        or None if the tile is not in the store
+        """
+        ss = self.shard_size
+        shard = self._get_shard(x // ss, y // ss, create=False)
+        if shard is None:
+            return None
+        edges, present = shard
+        if not present[y % ss, x % ss]:
+            return None
+        with timings.measure("edge_read", bytes=edges.shape[-1] * 16):
+            return np.array(edges[y % ss, x % ss])
+
+    def get_edge(self, x: int, y: int, name: str) -> Optional[np.ndarray]:
+        """
+        Returns one edge in the shape of the tile slice,
+        i.e. (resolution, 1) for left/right and (1, resolution) for bottom/top
+        """
+        edges = self.get(x, y)
+        if edges is None:
+            return None
+        edge = edges[EDGE_NAMES.index(name)]
+        return edge[:, None] if name in ("left", "right") else edge[None, :]
+
+    def put(self, x: int, y: int, data: np.ndarray):
+        if not self.exists():
+            self._create_index(data.shape[0])
+        elif data.shape[0] != self.index["resolution"]:
+            raise ValueError(
+                f"Edge store {self.path} has resolution {self.index['resolution']}, got tile of shape {data.shape}"
+            )
+        ss = self.shard_size
+        edges, present = self._get_shard(x // ss, y // ss, create=True)
+        edges[y % ss, x % ss] = (data[:, 0], data[:, -1], data[0], data[-1])
+        present[y % ss, x % ss] = True
+
+    def flush(self):
+        with self._lock:
+            for shard in self._shards.values():
+                if shard is not None:
+                    shard[0].flush()
+                    shard[1].flush()
+
+    def _create_index(self, resolution: int):
+        with self._lock:
+            if self.exists():
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self._index = {"resolution": resolution, "shard_size": self._shard_size}
+            temp_filename = self.path / f"index.json.{os.getpid()}.tmp"
+            temp_filename.write_text(json.dumps(self._index))
+            os.replace(temp_filename, self.path / "index.json")
+
+    def _get_shard(self, sx: int, sy: int, create: bool) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        shard = self._shards.get((sx, sy))
+        if shard is not None or (not create and (sx, sy) in self._shards):
+            return shard
+        with self._lock:
+            # another thread might have opened it in the meantime
+            shard = self._shards.get((sx, sy))
+            if shard is not None:
+                return shard
+            filename = self.shard_filename(sx, sy)
+            present_filename = self.shard_filename(sx, sy, present=True)
+            if filename.exists() and present_filename.exists():
+                shard = (
+                    np.load(filename, mmap_mode="r+" if create else "r"),
+                    np.load(present_filename, mmap_mode="r+" if create else "r"),
+                )
+            elif create:
+                ss, resolution = self.shard_size, self.index["resolution"]
+                os.makedirs(filename.parent, exist_ok=True)
+                # the edges are created first, a shard only counts when the present-mask exists
+                edges = np.lib.format.open_memmap(
+                    filename, mode="w+", dtype=np.float32, shape=(ss, ss, len(EDGE_NAMES), resolution),
+                )
+                edges[:] = np.nan
+                present = np.lib.format.open_memmap(present_filename, mode="w+", dtype=bool, shape=(ss, ss))
+                shard = (edges, present)
+            if shard is not None or not create:
+                self._shards[(sx, sy)] = shard
+        return shard
+
+
+def command_edges(
+        pathconfig: PathConfig,
+        zoom: int,
+        workers: int,
+        verbose: bool,
+):
+    """
+    Build the edge store of a zoom level from the existing tile cache
+    """
+    store = EdgeStore(pathconfig, zoom)
+    tiles_map = pathconfig.tile_cache_file_map(zoom=zoom)
+    if not tiles_map:
+        print(f"No tiles at {pathconfig.tile_cache_path()}/{zoom}")
+        return
+
+    def _put_edges(tile: Tuple[int, int]):
+        try:
+            data = pathconfig.load_tile_cache_file(zoom, *tile)
+        except Exception as e:
+            warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(zoom, *tile)}")
+            return
+        store.put(*tile, data)
+
+    tiles = list(tiles_map)
+    with Pool(max(1, workers)) as pool:
+        for _ in tqdm(pool.imap_unordered(_put_edges, tiles), total=len(tiles), desc="tiles", disable=not verbose):
+            pass
+    store.flush()
+    if verbose:
+        print(f"edges of {len(tiles):,} tiles at {store.path}")
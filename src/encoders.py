@@ -0,0 +1,186 @@
+import io
+import json
+import random
+import time
+from pathlib import Path
+from typing import Optional, List, Dict, TYPE_CHECKING
+
+import numpy as np
+
+# PIL is imported when needed, the encoder names are read by the cli
+if TYPE_CHECKING:
+    import PIL.Image
+
+
+class TileEncoder:
+    """
+    Encodes the output tiles with PIL's ``image.save(fp, format, **kwargs)``
+    """
+    def __init__(self, name: str, format: str, lossless: bool = True, **kwargs):
+        self.name = name
+        self.format = format
+        self.lossless = lossless
+        # png is always lossless, webp needs to be told
+        self.kwargs = {"lossless": lossless, **kwargs} if format == "webp" else kwargs
+
+    @property
+    def extension(self) -> str:
+        return f".{self.format}"
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.format}"
+
+    def encode(self, image: "PIL.Image.Image") -> bytes:
+        fp = io.BytesIO()
+        image.save(fp, format=self.format, **self.kwargs)
+        return fp.getvalue()
+
+
+class OptimizedPNGEncoder(TileEncoder):
+    """
+    Stores RGBA images with binary alpha in the smallest lossless PNG color type,
+    grayscale, palette or RGB, with the transparency as tRNS chunk
+    """
+    def encode(self, image: "PIL.Image.Image") -> bytes:
+        return super().encode(optimize_png_mode(image))
+
+
+ENCODERS: Dict[str, TileEncoder] = {
+    encoder.name: encoder
+    for encoder in (
+        TileEncoder("png", "png"),
+        TileEncoder("png-fast", "png", compress_level=1),
+        OptimizedPNGEncoder("png-opt", "png", compress_level=9),
+        TileEncoder("webp", "webp", lossless=True, quality=80, method=4),
+        TileEncoder("webp-lossy", "webp", lossless=False, quality=90, method=4),
+    )
+}
+
+
+def get_encoder(name: str) -> TileEncoder:
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown output format '{name}', expected one of {', '.join(ENCODERS)}")
+    return ENCODERS[name]
+
+
+def optimize_png_mode(image: "PIL.Image.Image") -> "PIL.Image.Image":
+    """
+    Convert an RGBA image without partial transparency to an L, P or RGB image
+    with a single transparent color. Other images are returned unchanged.
+    """
+    import PIL.Image
+    if image.mode != "RGBA":
+        return image
+    rgba = np.asarray(image)
+    alpha = rgba[..., 3]
+    opaque = alpha == 255
+    if not (opaque | (alpha == 0)).all():
+        return image
+
+    has_transparent = not opaque.all()
+    rgb = rgba[..., :3]
+    packed = (rgb[..., 0].astype(np.int32) << 16) | (rgb[..., 1].astype(np.int32) << 8) | rgb[..., 2]
+    colors = np.unique(packed[opaque])
+
+    gray = (rgb[..., 0] == rgb[..., 1]) & (rgb[..., 1] == rgb[..., 2])
+    if gray[opaque].all():
+        free = _first_unused(np.unique(rgb[..., 0][opaque]), 256)
+        if not has_transparent or free is not None:
+            values = rgb[..., 0].copy()
+            if has_transparent:
+                values[~opaque] = free
+            result = PIL.Image.fromarray(values, mode="L")
+            if has_transparent:
+                result.info["transparency"] = int(free)
+            return result
+
+    if len(colors) + has_transparent <= 256:
+        indices = np.searchsorted(colors, packed).astype(np.uint8)
+        indices[~opaque] = len(colors)
+        palette = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], -1).astype(np.uint8)
+        result = PIL.Image.fromarray(indices, mode="P")
+        result.putpalette(palette.tobytes() + (b"\0\0\0" if has_transparent else b""))
+        if has_transparent:
+            result.info["transparency"] = len(colors)
+        return result
+
+    values = rgb.copy()
+    if has_transparent:
+        free = int(_first_unused(colors, 1 << 24))
+        values[~opaque] = (free >> 16, (free >> 8) & 255, free & 255)
+    result = PIL.Image.fromarray(values, mode="RGB")
+    if has_transparent:
+        result.info["transparency"] = tuple(int(v) for v in values[~opaque][0])
+    return result
+
+
+def _first_unused(sorted_values: np.ndarray, limit: int) -> Optional[int]:
+    gaps = np.flatnonzero(sorted_values != np.arange(len(sorted_values)))
+    if len(gaps):
+        return int(gaps[0])
+    return len(sorted_values) if len(sorted_values) < limit else None
+
+
+def command_benchmark_encoders(
+        pathconfig,
+        modality: List[str],
+        cache_zoom: int,
+        encoder: Optional[List[str]],
+        num_tiles: int,
+        output: Optional[str],
+        verbose: bool,
+):
+    """
+    Encode the same rendered tiles with each encoder and compare bytes and milliseconds per tile
+    """
+    from tqdm import tqdm
+    import PIL.Image
+    from .modalities import to_rgba_uint8, DERIVED_MODALITIES
+    from .normalmap import NormalMapper
+
+    encoders = [get_encoder(name) for name in (encoder or ENCODERS)]
+    tiles = list(pathconfig.tile_cache_file_map(zoom=cache_zoom))
+    if not tiles:
+        print(f"No tiles at {pathconfig.tile_cache_path()}/{cache_zoom}")
+        return
+    tiles = random.Random(23).sample(tiles, min(num_tiles, len(tiles)))
+
+    normal_mapper = NormalMapper(
+        pathconfig=pathconfig, zoom=cache_zoom, edge_cache_size=10_000, tile_cache_size=100, approximate=False,
+    )
+    results = {}
+    for mod in modality:
+        images = []
+        for x, y in tqdm(tiles, desc=f"rendering {mod}", disable=not verbose):
+            if mod == "normal":
+                data = normal_mapper.normal_map(x, y)
+            elif mod in DERIVED_MODALITIES:
+                data = normal_mapper.derived_map(x, y, mod)
+            else:
+                data = np.array(normal_mapper.get_tile(x, y))
+            images.append(PIL.Image.fromarray(to_rgba_uint8(data, mod)))
+
+        results[mod] = {}
+        for enc in encoders:
+            num_bytes = 0
+            start_time = time.perf_counter()
+            for image in images:
+                num_bytes += len(enc.encode(image))
+            seconds = time.perf_counter() - start_time
+            results[mod][enc.name] = {
+                "bytes_per_tile": round(num_bytes / len(images)),
+                "ms_per_tile": round(seconds * 1000 / len(images), 3),
+                "lossless": enc.lossless,
+            }
+
+    if verbose:
+        for mod, mod_results in results.items():
+            print(f"\n{mod} ({len(tiles)} tiles at zoom {cache_zoom})")
+            print(f"{'encoder':12} {'bytes/tile':>12} {'ms/tile':>10}")
+            for name, r in mod_results.items():
+                print(f"{name:12} {r['bytes_per_tile']:12,} {r['ms_per_tile']:10.2f}")
+
+    if output:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        Path(output).write_text(json.dumps({"zoom": cache_zoom, "num_tiles": len(tiles), "results": results}, indent=2))
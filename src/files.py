@@ -1,12 +1,22 @@
+import io
 import os
 import random
+import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Union, Dict, Tuple, Optional, Hashable, Any, List
+from typing import Union, Dict, Tuple, Optional, Hashable, Any, List, Callable, Generator, TYPE_CHECKING
 
 import numpy as np
-import PIL.Image
 
 from . import config
+from .encoders import get_encoder
+from .modalities import rgba_to_uint8, ENCODED_MODALITIES
+from .timing import timings
+
+# PIL is imported when needed, most commands don't write images
+if TYPE_CHECKING:
+    import PIL.Image
 
 
 class PathConfig:
@@ -18,6 +28,9 @@ class PathConfig:
         self.is_random_order = kwargs.get("random_order", False)
         self.tile_range_x: Optional[Tuple[int, int]] = kwargs.get("tile_x")
         self.tile_range_y: Optional[Tuple[int, int]] = kwargs.get("tile_y")
+        self.output_encoder = get_encoder(kwargs.get("output_format") or "png")
+        # directories that have been created by `_write_file`
+        self._directories = set()
 
     def web_cache_file(self, sector_x: int, sector_y: int, extension: str = ".tif"):
         return self.web_cache_path / f"{extension[1:]}/E{sector_x}N{sector_y}{extension}"
@@ -28,6 +41,12 @@ class PathConfig:
             path = path / modality
         return path
 
+    def tile_pyramid_path(self, zoom: int, modality: str = "height") -> Path:
+        return self.tile_cache_path(modality=f"{modality}-pyramid") / str(zoom)
+
+    def tile_edges_path(self, zoom: int, modality: str = "height") -> Path:
+        return self.tile_cache_path(modality=f"{modality}-edges") / str(zoom)
+
     def tile_output_path(self, modality: str = "height") -> Path:
         path = self._tile_output_path / modality
         return path
@@ -35,6 +54,20 @@ class PathConfig:
     def tile_cache_filename(self, z: int, x: int, y: int, modality: str = "height"):
         return self.tile_cache_path(modality=modality) / f"{z}/{x}/{y}.npz"
 
+    def iter_tile_cache_files(
+            self,
+            zoom: int,
+            modality: str = "height",
+            column_filter: Optional[Callable[[int], bool]] = None,
+    ) -> Generator[Tuple[Tuple[int, int], Path], None, None]:
+        """
+        Like `tile_cache_file_map` but streaming, ignores the random order
+        """
+        yield from iter_tile_files(
+            self.tile_cache_path(modality=modality), zoom, ".npz",
+            tile_range_x=self.tile_range_x, tile_range_y=self.tile_range_y, column_filter=column_filter,
+        )
+
     def tile_cache_file_map(self, zoom: int, modality: str = "height"):
         path = self.tile_cache_path(modality=modality)
         tile_map = get_tile_file_map(path, zoom, ".npz", tile_range_x=self.tile_range_x, tile_range_y=self.tile_range_y)
@@ -43,46 +76,97 @@ class PathConfig:
         return tile_map
 
     def tile_output_filename(self, z: int, x: int, y: int, modality: str = "height"):
-        return self.tile_output_path(modality=modality) / f"{z}/{x}/{y}.png"
+        return self.tile_output_path(modality=modality) / f"{z}/{x}/{y}{self.output_encoder.extension}"
 
     def tile_cache_file_exists(self, z: int, x: int, y: int, modality: str = "height") -> bool:
         return self.tile_cache_filename(z, x, y, modality=modality).exists()
 
     def load_tile_cache_file(self, z: int, x: int, y: int, modality: str = "height") -> np.ndarray:
         filename = self.tile_cache_filename(z, x, y, modality=modality)
-        return np.load(filename).get("arr_0")
+        with timings.measure("read") as m:
+            data = filename.read_bytes()
+            m["bytes"] = len(data)
+        with timings.measure("npz_decode", bytes=len(data)):
+            return np.load(io.BytesIO(data)).get("arr_0")
 
     def tile_output_exists(self, z: int, x: int, y: int, modality: str = "height") -> bool:
         return self.tile_output_filename(z, x, y, modality=modality).exists()
 
     def tile_output_file_map(self, zoom: int, modality: str = "height"):
         path = self.tile_output_path(modality=modality)
-        tile_map = get_tile_file_map(path, zoom, ".png", tile_range_x=self.tile_range_x, tile_range_y=self.tile_range_y)
+        tile_map = get_tile_file_map(path, zoom, self.output_encoder.extension, tile_range_x=self.tile_range_x, tile_range_y=self.tile_range_y)
         if self.is_random_order:
             tile_map = randomize_tile_file_map(tile_map)
         return tile_map
 
     def save_tile_cache_file(self, z: int, x: int, y: int, array: np.ndarray, modality: str = "height"):
         filename = self.tile_cache_filename(z, x, y, modality=modality)
-        os.makedirs(filename.parent, exist_ok=True)
-        with DeleteFileOnException(filename):
-            np.savez_compressed(filename, array)
+        with timings.measure("npz_encode", bytes=array.nbytes):
+            fp = io.BytesIO()
+            np.savez_compressed(fp, array)
+        self._write_file(filename, fp.getvalue())
+
+    def save_output_tile(self, z: int, x: int, y: int, array: Union[np.ndarray, "PIL.Image.Image"], modality: str = "height"):
+        self.write_output_tile(z, x, y, self.encode_output_tile(array, modality=modality), modality=modality)
 
-    def save_output_tile(self, z: int, x: int, y: int, array: Union[np.ndarray, PIL.Image.Image], modality: str = "height"):
+    def write_output_tile(self, z: int, x: int, y: int, data: bytes, modality: str = "height"):
+        self._write_file(self.tile_output_filename(z, x, y, modality=modality), data)
+
+    def encode_output_tile(self, array: Union[np.ndarray, "PIL.Image.Image"], modality: str = "height") -> bytes:
+        import PIL.Image
         if isinstance(array, PIL.Image.Image):
             image = array
         else:
-            image = PIL.Image.fromarray(
-                (array * 255).clip(0, 255).astype(np.uint8)
-            )
-        filename = self.tile_output_filename(z, x, y, modality=modality)
-        os.makedirs(filename.parent, exist_ok=True)
-        with DeleteFileOnException(filename):
-            image.save(filename)
-
-    def load_tile_output_file(self, z: int, x: int, y: int, modality: str = "height") -> PIL.Image.Image:
+            image = PIL.Image.fromarray(rgba_to_uint8(array))
+        if not self.output_encoder.lossless and modality in ENCODED_MODALITIES:
+            raise ValueError(f"Output format '{self.output_encoder.name}' is lossy and would corrupt the {modality} heights")
+        with timings.measure(f"{self.output_encoder.format}_encode") as m:
+            data = self.output_encoder.encode(image)
+            m["bytes"] = len(data)
+        return data
+
+    def load_tile_output_file(self, z: int, x: int, y: int, modality: str = "height") -> "PIL.Image.Image":
+        import PIL.Image
         filename = self.tile_output_filename(z, x, y, modality=modality)
-        return PIL.Image.open(filename)
+        with timings.measure("read") as m:
+            data = filename.read_bytes()
+            m["bytes"] = len(data)
+        with timings.measure(f"{self.output_encoder.format}_decode", bytes=len(data)):
+            image = PIL.Image.open(io.BytesIO(data))
+            image.load()
+            # the optimized pngs are palette, grayscale or rgb images with a transparent color
+            if image.mode != "RGBA":
+                image = image.convert("RGBA")
+        return image
+
+    def _write_file(self, filename: Path, data: bytes):
+        # write to a temporary file and rename, so a killed process never leaves half files
+        temp_filename = filename.with_name(f"{filename.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        with timings.measure("write", bytes=len(data)):
+            # one makedirs call per directory
+            if filename.parent not in self._directories:
+                os.makedirs(filename.parent, exist_ok=True)
+                self._directories.add(filename.parent)
+            with DeleteFileOnException(temp_filename):
+                try:
+                    temp_filename.write_bytes(data)
+                except FileNotFoundError:
+                    # the directory has been removed in the meantime, e.g. by --reset
+                    os.makedirs(filename.parent, exist_ok=True)
+                    temp_filename.write_bytes(data)
+                os.replace(temp_filename, filename)
+
+
+def sync_to_disk():
+    """
+    Flush all written files and directory entries to disk, where the OS supports it.
+
+    Called once per reproject block before the journal marks it done,
+    which is much cheaper than syncing each tile.
+    """
+    if hasattr(os, "sync"):
+        with timings.measure("sync"):
+            os.sync()
 
 
 class DeleteFileOnException:
@@ -106,17 +190,40 @@ def get_tile_file_map(
         tile_range_x: Optional[Tuple[int, int]] = None,
         tile_range_y: Optional[Tuple[int, int]] = None,
 ) -> Dict[Tuple[int, int], Path]:
-    dic = {}
-    for file in sorted((Path(base_path) / str(zoom)).rglob(f"**/*{extension}")):
-        x, y = int(file.parent.name), int(file.with_suffix("").name)
+    return dict(iter_tile_files(base_path, zoom, extension, tile_range_x=tile_range_x, tile_range_y=tile_range_y))
+
+
+def iter_tile_files(
+        base_path: Union[str, Path],
+        zoom: int,
+        extension: str = ".png",
+        tile_range_x: Optional[Tuple[int, int]] = None,
+        tile_range_y: Optional[Tuple[int, int]] = None,
+        column_filter: Optional[Callable[[int], bool]] = None,
+) -> Generator[Tuple[Tuple[int, int], Path], None, None]:
+    """
+    Yields ((x, y), filename) column by column, without listing all files first.
+
+    :param column_filter: optional function that decides if a tile column x is included
+    """
+    path = Path(base_path) / str(zoom)
+    if not path.exists():
+        return
+    columns = sorted(int(entry.name) for entry in os.scandir(path) if entry.is_dir() and entry.name.isdigit())
+    for x in columns:
         if tile_range_x and not tile_range_x[0] <= x <= tile_range_x[1]:
             continue
-        if tile_range_y and not tile_range_y[0] <= y <= tile_range_y[1]:
+        if column_filter is not None and not column_filter(x):
             continue
-
-        dic[(x, y)] = file
-
-    return dic
+        rows = sorted(
+            (int(entry.name[:-len(extension)]), entry.name)
+            for entry in os.scandir(path / str(x))
+            if entry.name.endswith(extension) and entry.name[:-len(extension)].isdigit()
+        )
+        for y, name in rows:
+            if tile_range_y and not tile_range_y[0] <= y <= tile_range_y[1]:
+                continue
+            yield (x, y), path / str(x) / name
 
 
 def split_tile_file_map(
@@ -130,7 +237,7 @@ def split_tile_file_map(
     max_y = max(t[1] for t in tile_map)
 
     w, h = max_x - min_x, max_y - min_y
-    ws, hs = w // workers, h // workers
+    ws, hs = max(1, w // workers), max(1, h // workers)
 
     spatial_batches = {}
     for x, y in tile_map:
@@ -166,12 +273,19 @@ def randomize_tile_file_map(
 
 
 class MemoryCache:
+    """
+    Least-recently-used cache, limited by number of items and, optionally, by bytes.
 
-    def __init__(self, max_items: int):
+    `num_misses` counts the requests for keys that had been cached before,
+    as far as the (bounded) record of evicted keys reaches.
+    """
+    def __init__(self, max_items: int, max_bytes: Optional[int] = None, max_evicted: int = 100_000):
         self._max_items = max_items
-        self._cache = {}
-        self._ever_seen = set()
-        self._age = 0
+        self._max_bytes = max_bytes
+        self._max_evicted = max(max_evicted, max_items)
+        self._cache: OrderedDict = OrderedDict()
+        self._evicted: OrderedDict = OrderedDict()
+        self.num_bytes = 0
         self.num_hits = 0
         self.num_misses = 0
 
@@ -179,25 +293,39 @@ class MemoryCache:
         return key in self._cache
 
     def get(self, key: Hashable) -> Optional[Any]:
-        self._age += 1
-        if key not in self._cache:
-            if key in self._ever_seen:
+        entry = self._cache.get(key)
+        if entry is None:
+            if key in self._evicted:
                 self.num_misses += 1
             return None
         self.num_hits += 1
-        cache = self._cache[key]
-        cache["age"] = self._age
-        return cache["value"]
+        self._cache.move_to_end(key)
+        return entry[0]
 
     def put(self, key: Hashable, value: Any):
-        self._cache[key] = {
-            "age": self._age,
-            "value": value,
-        }
-        self._ever_seen.add(key)
-
-        if len(self._cache) > self._max_items:
-            keys = sorted(self._cache, key=lambda k: self._cache[k]["age"])
-            keys = keys[:len(self._cache) - self._max_items]
-            for key in keys:
-                del self._cache[key]
+        size = _sizeof(value)
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self.num_bytes -= old[1]
+        self._cache[key] = (value, size)
+        self.num_bytes += size
+        self._evicted.pop(key, None)
+
+        while len(self._cache) > self._max_items or (
+                self._max_bytes is not None and self.num_bytes > self._max_bytes and len(self._cache) > 1
+        ):
+            evicted_key, (_, evicted_size) = self._cache.popitem(last=False)
+            self.num_bytes -= evicted_size
+            self._evicted[evicted_key] = None
+            if len(self._evicted) > self._max_evicted:
+                self._evicted.popitem(last=False)
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
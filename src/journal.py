@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Tuple, Union, Set
+
+import mercantile
+
+
+class ReprojectJournal:
+    """
+    Append-only record of the reprojected work units of one zoom level.
+
+    A work unit is a block of tiles of one sector, identified by
+    (zoom, resolution, sector, block), where block is an ancestor tile.
+    A "begin" line is written before and a "done" line after a block has been
+    merged into the tile cache. Blocks that have begun but are not done
+    were interrupted and are simply done again.
+    """
+    Key = Tuple[int, int, Tuple[int, int], Tuple[int, int, int]]
+
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+        self._done: Set[ReprojectJournal.Key] = set()
+        self._begun: Set[ReprojectJournal.Key] = set()
+        self._lock = threading.Lock()
+        # the journals of the nodes of a distributed run are named journal.{node}.jsonl
+        filenames = [self.filename, *self.filename.parent.glob(f"{self.filename.stem.split('.')[0]}.*{self.filename.suffix}")]
+        for filename in sorted(set(filenames)):
+            if not filename.exists():
+                continue
+            with filename.open() as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a killed run
+                        continue
+                    key = self._key(record["zoom"], record["resolution"], record["sector"], record["block"])
+                    if record["event"] == "begin":
+                        self._begun.add(key)
+                    elif record["event"] == "done":
+                        self._done.add(key)
+        self.num_interrupted = len(self._begun - self._done)
+
+    @staticmethod
+    def _key(zoom: int, resolution: int, sector, block) -> Key:
+        return zoom, resolution, tuple(sector), tuple(block)
+
+    def is_done(self, zoom: int, resolution: int, sector: Tuple[int, int], block: mercantile.Tile) -> bool:
+        """
+        Returns True if the block, or any larger block containing it, has been completed
+        """
+        while True:
+            if self._key(zoom, resolution, sector, (block.z, block.x, block.y)) in self._done:
+                return True
+            if block.z == 0:
+                return False
+            block = mercantile.parent(block)
+
+    def begin(self, zoom: int, resolution: int, sector: Tuple[int, int], block: mercantile.Tile):
+        self._write("begin", zoom, resolution, sector, block, sync=False)
+
+    def done(self, zoom: int, resolution: int, sector: Tuple[int, int], block: mercantile.Tile):
+        self._write("done", zoom, resolution, sector, block, sync=True)
+        self._done.add(self._key(zoom, resolution, sector, (block.z, block.x, block.y)))
+
+    def _write(self, event: str, zoom: int, resolution: int, sector, block: mercantile.Tile, sync: bool):
+        os.makedirs(self.filename.parent, exist_ok=True)
+        line = json.dumps({
+            "event": event, "zoom": zoom, "resolution": resolution,
+            "sector": list(sector), "block": [block.z, block.x, block.y],
+        })
+        with self._lock:
+            with self.filename.open("a") as fp:
+                fp.write(line + "\n")
+                if sync:
+                    fp.flush()
+                    os.fsync(fp.fileno())
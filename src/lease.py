@@ -0,0 +1,399 @@
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union, Iterable, Callable, Dict, Generator
+
+from .timing import Timings, timings
+
+
+class LeaseManager:
+    """
+    Distributes the work units of a job between nodes that share a filesystem.
+
+    A node claims a unit by creating its lease file with O_EXCL, which only one
+    node can do, and marks it done by writing a done file. Held leases are touched
+    by a heartbeat thread, leases that have not been touched for `ttl` seconds belong
+    to a dead node and are taken over. No broker is needed, just a shared directory:
+
+        {lease-dir}/{job}/{unit}.lease  json, node and claim time, mtime is the heartbeat
+        {lease-dir}/{job}/{unit}.done   json, node, seconds and stats of the unit
+        {lease-dir}/nodes/{node}--{job}.json  stats and timings of each node, see `lease_status`
+
+    The clocks of the nodes are expected to be in sync within a fraction of `ttl`.
+
+    A node that stalls longer than `ttl` loses its leases. It checks the owner of
+    a lease before touching, releasing or completing it, and drops units that
+    have been taken over.
+
+    The done files stay for later runs, which skip the units. `reset` deletes the
+    done files of the job, pass it to one node before starting the others.
+    """
+    def __init__(
+            self,
+            path: Union[str, Path],
+            job: str,
+            node_id: Optional[str] = None,
+            ttl: float = 120.,
+            poll_interval: Optional[float] = None,
+            reset: bool = False,
+    ):
+        self.path = Path(path)
+        self.job = job
+        self.job_path = self.path / job
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.ttl = ttl
+        self.poll_interval = min(ttl / 4, 5.) if poll_interval is None else poll_interval
+        self.num_done = 0
+        self.num_failed = 0
+        self.num_taken_over = 0
+        self.num_lost = 0
+        self._lock = threading.Lock()
+        self._held: Dict[str, Path] = {}
+        self._done_cache = set()
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+        os.makedirs(self.job_path, exist_ok=True)
+        os.makedirs(self.path / "nodes", exist_ok=True)
+        if reset:
+            for filename in self.job_path.glob("*.done"):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+        # units that were done when this node started, e.g. by a previous run
+        self.num_done_before = len(list(self.job_path.glob("*.done")))
+
+    def __enter__(self):
+        self._stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+        self.write_node_stats()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._heartbeat_thread.join()
+        for unit in list(self._held):
+            self.release(unit)
+        self.write_node_stats()
+
+    def lease_filename(self, unit: str) -> Path:
+        return self.job_path / f"{unit}.lease"
+
+    def done_filename(self, unit: str) -> Path:
+        return self.job_path / f"{unit}.done"
+
+    def is_done(self, unit: str) -> bool:
+        if unit in self._done_cache:
+            return True
+        if self.done_filename(unit).exists():
+            self._done_cache.add(unit)
+            return True
+        return False
+
+    def try_acquire(self, unit: str) -> bool:
+        """
+        Claim the unit, returns False if it is done or leased by a live node
+        """
+        if self.is_done(unit):
+            return False
+        filename = self.lease_filename(unit)
+        for _ in range(2):
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._take_over(filename):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"node": self.node_id, "claimed": time.time()}, fp)
+            with self._lock:
+                self._held[unit] = filename
+            # it might have been completed between the done check and the claim
+            if self.is_done(unit):
+                self.release(unit)
+                return False
+            return True
+        return False
+
+    def complete(self, unit: str, **stats) -> bool:
+        """
+        Mark a claimed unit as done and drop its lease.
+
+        :return: False if the lease has been taken over by another node in the meantime
+        """
+        lease = self._read_json(self.lease_filename(unit))
+        if lease.get("node") != self.node_id:
+            self._drop(unit)
+            return False
+        filename = self.done_filename(unit)
+        temp_filename = filename.with_name(f"{filename.name}.{self.node_id}.tmp")
+        claimed = lease.get("claimed", time.time())
+        temp_filename.write_text(json.dumps({
+            "node": self.node_id, "finished": time.time(), "seconds": round(time.time() - claimed, 3), **stats,
+        }))
+        os.replace(temp_filename, filename)
+        self._done_cache.add(unit)
+        self.num_done += 1
+        self.release(unit)
+        return True
+
+    def release(self, unit: str):
+        """
+        Give up a claimed unit without completing it
+        """
+        with self._lock:
+            filename = self._held.pop(unit, None)
+        if filename is not None and self._owns(filename):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def touch_leases(self):
+        """
+        Renew the held leases, called by the heartbeat thread
+        """
+        with self._lock:
+            held = list(self._held.items())
+        for unit, filename in held:
+            if not self._owns(filename):
+                self._drop(unit)
+                continue
+            try:
+                os.utime(filename)
+            except FileNotFoundError:
+                self._drop(unit)
+
+    def iter_claims(self, units: Iterable[str], wait: bool = True) -> Generator[str, None, None]:
+        """
+        Yield the units this node could claim, the caller must `complete` or `release` each one.
+
+        Units leased by other nodes are retried after the first pass. With `wait`, the
+        generator returns when all units are done, taking over the leases of dead nodes,
+        so it also works as a barrier between the nodes.
+        """
+        deferred = []
+        for unit in units:
+            if self.try_acquire(unit):
+                yield unit
+            elif not self.is_done(unit):
+                deferred.append(unit)
+
+        while deferred:
+            remaining = []
+            for unit in deferred:
+                if self.try_acquire(unit):
+                    yield unit
+                elif not self.is_done(unit):
+                    remaining.append(unit)
+            deferred = remaining
+            if not deferred or not wait:
+                break
+            time.sleep(self.poll_interval)
+
+    def process(
+            self,
+            units: Iterable[str],
+            func: Callable[[str], Optional[dict]],
+            workers: int = 1,
+            wait: bool = True,
+    ) -> int:
+        """
+        Claim and process units in `workers` threads until no unit is left.
+
+        `func` may return a dict of stats which is stored in the done file.
+        A failing unit is released, so another node can try it, and the error is raised.
+        Units that have been taken over while `func` was running are not counted.
+
+        :return: number of units processed by this node
+        """
+        claims = self.iter_claims(units, wait=wait)
+        claims_lock = threading.Lock()
+        errors = []
+        num_processed = [0]
+
+        def _worker():
+            while not errors:
+                with claims_lock:
+                    unit = next(claims, None)
+                if unit is None:
+                    break
+                try:
+                    stats = func(unit)
+                except Exception as e:
+                    self.num_failed += 1
+                    self.release(unit)
+                    errors.append(e)
+                    break
+                if self.complete(unit, **(stats or {})):
+                    with claims_lock:
+                        num_processed[0] += 1
+
+        threads = [threading.Thread(target=_worker) for _ in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.write_node_stats()
+        if errors:
+            raise errors[0]
+        return num_processed[0]
+
+    def write_node_stats(self):
+        filename = self.path / "nodes" / f"{self.node_id}--{self.job}.json"
+        temp_filename = filename.with_name(f"{filename.name}.{threading.get_ident()}.tmp")
+        temp_filename.write_text(json.dumps({
+            "node": self.node_id,
+            "pid": os.getpid(),
+            "job": self.job,
+            "started": self._started,
+            "heartbeat": time.time(),
+            "running": not self._stop.is_set(),
+            "units_done": self.num_done,
+            "units_failed": self.num_failed,
+            "units_taken_over": self.num_taken_over,
+            "units_lost": self.num_lost,
+            "leases_held": len(self._held),
+            "timings": timings.snapshot(),
+        }))
+        os.replace(temp_filename, filename)
+
+    def _take_over(self, filename: Path) -> bool:
+        """
+        Remove an expired lease, only one node succeeds in renaming it
+        """
+        try:
+            if time.time() - filename.stat().st_mtime < self.ttl:
+                return False
+            stale_filename = filename.with_name(f"{filename.name}.{self.node_id}.stale")
+            os.rename(filename, stale_filename)
+        except FileNotFoundError:
+            # completed or taken over by another node, try again
+            return True
+        # another node might have taken it over between the check and the rename
+        if time.time() - stale_filename.stat().st_mtime < self.ttl:
+            try:
+                os.link(stale_filename, filename)
+            except FileExistsError:
+                pass
+            os.remove(stale_filename)
+            return False
+        os.remove(stale_filename)
+        self.num_taken_over += 1
+        return True
+
+    def _owns(self, filename: Path) -> bool:
+        return self._read_json(filename).get("node") == self.node_id
+
+    def _drop(self, unit: str):
+        """
+        Forget a unit whose lease has been taken over by another node
+        """
+        with self._lock:
+            filename = self._held.pop(unit, None)
+        if filename is not None:
+            self.num_lost += 1
+
+    def _heartbeat(self):
+        while not self._stop.wait(min(self.ttl / 4, 30.)):
+            self.touch_leases()
+            self.write_node_stats()
+
+    @staticmethod
+    def _read_json(filename: Path) -> dict:
+        try:
+            return json.loads(filename.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+
+def job_name(name: str, pathconfig) -> str:
+    """
+    Append the --tile-x/--tile-y ranges of the PathConfig to the job name,
+    so the units of a ranged run are not taken as done by a full run
+    """
+    for axis, tile_range in (("x", pathconfig.tile_range_x), ("y", pathconfig.tile_range_y)):
+        if tile_range:
+            name = f"{name}-{axis}{tile_range[0]}-{tile_range[1]}"
+    return name
+
+
+def lease_status(path: Union[str, Path], ttl: float = 120.) -> dict:
+    """
+    Merged view of all jobs and nodes of a lease directory
+    """
+    path = Path(path)
+    now = time.time()
+    result = {"jobs": {}, "nodes": {}, "timings": {}}
+    # the timings are per process, so only the latest job of each process counts
+    node_timings = {}
+
+    for filename in sorted((path / "nodes").glob("*.json")) if (path / "nodes").exists() else []:
+        node = LeaseManager._read_json(filename)
+        if not node:
+            continue
+        if not node.get("running"):
+            node["state"] = "exited"
+        else:
+            node["state"] = "alive" if now - node.get("heartbeat", 0) < ttl else "lost"
+        process = (node["node"], node["pid"])
+        latest = node_timings.get(process)
+        if latest is None or latest[0] < node["heartbeat"]:
+            node_timings[process] = (node["heartbeat"], node["timings"])
+        del node["timings"]
+        result["nodes"][f"{node['node']} {node['job']}"] = node
+
+    merged_timings = Timings()
+    for _, snapshot in node_timings.values():
+        merged_timings.merge(snapshot)
+
+    for job_path in sorted(p for p in path.iterdir() if p.is_dir() and p.name != "nodes"):
+        job = {"done": 0, "leased": 0, "expired": 0, "seconds": 0., "done_by_node": {}, "stats": {}}
+        for filename in job_path.iterdir():
+            if filename.suffix == ".done":
+                data = LeaseManager._read_json(filename)
+                job["done"] += 1
+                job["seconds"] += data.get("seconds", 0)
+                node = data.get("node")
+                job["done_by_node"][node] = job["done_by_node"].get(node, 0) + 1
+                for key, value in data.items():
+                    if key not in ("node", "finished", "seconds") and isinstance(value, (int, float)):
+                        job["stats"][key] = job["stats"].get(key, 0) + value
+            elif filename.suffix == ".lease":
+                try:
+                    expired = now - filename.stat().st_mtime >= ttl
+                except FileNotFoundError:
+                    continue
+                job["expired" if expired else "leased"] += 1
+        result["jobs"][job_path.name] = job
+
+    result["timings"] = merged_timings.snapshot()
+    return result
+
+
+def command_lease_status(lease_dir: str, lease_ttl: float, **kwargs):
+    status = lease_status(lease_dir, ttl=lease_ttl)
+    for name, job in status["jobs"].items():
+        stats = ", ".join(f"{key} {value:,}" for key, value in sorted(job["stats"].items()))
+        print(
+            f"{name:32} done {job['done']:8,}  leased {job['leased']:5,}  expired {job['expired']:5,}"
+            f"  unit-seconds {job['seconds']:10,.1f}" + (f"  ({stats})" if stats else "")
+        )
+        for node, count in sorted(job["done_by_node"].items()):
+            print(f"    {node:28} {count:8,}")
+    now = time.time()
+    for name, node in status["nodes"].items():
+        print(
+            f"node {node['node']:27} {node['state']:6}  job {node['job']:24}"
+            f"  done {node.get('units_done', 0):,}  failed {node.get('units_failed', 0):,}"
+            f"  taken over {node.get('units_taken_over', 0):,}  heartbeat {now - node.get('heartbeat', now):.0f}s ago"
+        )
+    if status["timings"]:
+        merged = Timings()
+        merged.merge(status["timings"])
+        print(merged.log_line())
@@ -0,0 +1,81 @@
+import asyncio
+import random
+import time
+from typing import List, Tuple, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+
+from .files import PathConfig
+
+
+def command_loadtest(
+        pathconfig: PathConfig,
+        url: str,
+        modality: str,
+        zoom: int,
+        num_requests: int,
+        concurrency: int,
+        seed: Optional[int],
+        verbose: bool,
+):
+    """
+    Request random tiles inside the --tile-x/--tile-y ranges from a running `serve`
+    and print the latency percentiles.
+    """
+    if not pathconfig.tile_range_x or not pathconfig.tile_range_y:
+        raise ValueError("loadtest needs --tile-x and --tile-y ranges")
+
+    rnd = random.Random(seed)
+    paths = [
+        f"/{modality}/{zoom}/{rnd.randint(*pathconfig.tile_range_x)}/{rnd.randint(*pathconfig.tile_range_y)}"
+        f"{pathconfig.output_encoder.extension}"
+        for _ in range(num_requests)
+    ]
+
+    parsed = urlparse(url)
+    results = asyncio.run(_run_requests(parsed.hostname, parsed.port or 80, paths, concurrency))
+
+    latencies = np.array([r[1] for r in results]) * 1000
+    duration = max(r[2] for r in results) - min(r[2] - r[1] for r in results)
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"requests:    {len(results)} in {duration:.2f}s ({len(results) / duration:.1f}/s), concurrency {concurrency}")
+    print(f"status:      {', '.join(f'{k}: {v}' for k, v in sorted(statuses.items()))}")
+    print(f"latency ms:  p50 {np.percentile(latencies, 50):.1f}  p90 {np.percentile(latencies, 90):.1f}"
+          f"  p99 {np.percentile(latencies, 99):.1f}  max {latencies.max():.1f}")
+
+
+async def _run_requests(host: str, port: int, paths: List[str], concurrency: int) -> List[Tuple[int, float, float]]:
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+    results = []
+
+    async def _client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while not queue.empty():
+                path = queue.get_nowait()
+                start = time.perf_counter()
+                writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                end = time.perf_counter()
+                results.append((status, end - start, end))
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(_client() for _ in range(concurrency)))
+    return results
@@ -0,0 +1,167 @@
+import math
+from typing import Optional, Tuple
+
+import mercantile
+import numpy as np
+
+
+# modalities that are calculated from the normal-map
+DERIVED_MODALITIES = ("hillshade", "slope", "aspect")
+# heights packed into the RGB channels, see `encode_heights`
+ENCODED_MODALITIES = ("terrain-rgb", "terrarium")
+MODALITIES = ("height", "normal", *DERIVED_MODALITIES, *ENCODED_MODALITIES)
+
+
+def to_rgba(array: np.ndarray, modality: str, nan_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Convert a height or normal tile to a float RGBA image in range [0, 1].
+
+    Invalid pixels (NaN or <= -10,000) get zero alpha.
+    The array is not modified, it might be a cached tile.
+
+    The encoded height modalities are returned as exact uint8 RGBA.
+    """
+    if nan_mask is None:
+        nan_mask = get_nan_mask(array)
+
+    if modality in ENCODED_MODALITIES:
+        return encode_heights(array, modality, nan_mask)
+
+    if modality == "normal":
+        array = np.where(nan_mask[..., None], -1, array) * .5 + .5
+        array = np.pad(array, ((0, 0), (0, 0), (0, 1)))
+    elif modality in DERIVED_MODALITIES:
+        # hillshade is in [0, 1], slope in [0, 90] and aspect in [0, 360) degrees
+        array = np.where(nan_mask, 0, array) / {"hillshade": 1., "slope": 90., "aspect": 360.}[modality]
+        array = array[..., None].repeat(4, -1)
+    else:
+        array = np.where(nan_mask, 0, array) / 2000  # TODO: get max height in dataset
+        array = array[..., None].repeat(4, -1)
+
+    array[..., 3] = 1. - nan_mask
+    return array
+
+
+def to_rgba_uint8(array: np.ndarray, modality: str, nan_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    return rgba_to_uint8(to_rgba(array, modality, nan_mask))
+
+
+def rgba_to_uint8(array: np.ndarray) -> np.ndarray:
+    if array.dtype == np.uint8:
+        return array
+    return (array * 255).clip(0, 255).astype(np.uint8)
+
+
+def encode_heights(heights: np.ndarray, modality: str, nan_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Pack heights in meters into uint8 RGBA, invalid pixels get zero alpha.
+
+    terrain-rgb (Mapbox): height = -10000 + (R * 65536 + G * 256 + B) * 0.1
+    terrarium (Mapzen):   height = R * 256 + G + B / 256 - 32768
+    """
+    if nan_mask is None:
+        nan_mask = get_nan_mask(heights)
+    h = np.where(nan_mask, 0, heights).astype(np.float64)
+
+    rgba = np.empty((*h.shape, 4), dtype=np.uint8)
+    if modality == "terrain-rgb":
+        value = np.round((h + 10_000) * 10).astype(np.int64).clip(0, 2**24 - 1)
+        rgba[..., 0] = value >> 16
+        rgba[..., 1] = (value >> 8) & 255
+        rgba[..., 2] = value & 255
+    elif modality == "terrarium":
+        value = np.clip(h + 32768, 0, 65536 - 1 / 256)
+        integer = np.floor(value)
+        rgba[..., 0] = integer // 256
+        rgba[..., 1] = integer % 256
+        rgba[..., 2] = np.floor((value - integer) * 256)
+    else:
+        raise ValueError(f"Unknown height encoding '{modality}'")
+
+    rgba[..., 3] = np.where(nan_mask, 0, 255)
+    return rgba
+
+
+def decode_heights(rgba: np.ndarray, modality: str) -> np.ndarray:
+    """
+    Inverse of `encode_heights`, pixels with zero alpha become NaN
+    """
+    r, g, b = (rgba[..., c].astype(np.float64) for c in range(3))
+    if modality == "terrain-rgb":
+        heights = -10_000 + (r * 65536 + g * 256 + b) * .1
+    elif modality == "terrarium":
+        heights = r * 256 + g + b / 256 - 32768
+    else:
+        raise ValueError(f"Unknown height encoding '{modality}'")
+
+    heights = heights.astype(np.float32)
+    if rgba.shape[-1] == 4:
+        heights[rgba[..., 3] == 0] = np.nan
+    return heights
+
+
+def get_nan_mask(array: np.ndarray) -> np.ndarray:
+    array2d = array
+    if array2d.ndim == 3:
+        array2d = array2d[..., 0]
+    return np.isnan(array2d) | (array2d <= -10_000)
+
+
+def tile_pixel_size(tile: mercantile.Tile, resolution: int) -> float:
+    """
+    Ground size of one pixel in meters, at the center latitude of the tile
+    """
+    bounds = mercantile.xy_bounds(tile)
+    lat = mercantile.ul(tile.x + .5, tile.y + .5, tile.z).lat
+    return (bounds.right - bounds.left) / resolution * math.cos(math.radians(lat))
+
+
+def normals_to_gradients(normals: np.ndarray, pixel_size: float, z_factor: float = 2.) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Recover the height gradients from a normal-map of `heights_to_normals`.
+
+    :return: tuple of (dz/dx east, dz/dy north) arrays in meters per meter
+    """
+    # the normals are (h[y+1] - h[y-1], h[x-1] - h[x+1], z_factor), normalized, where y points south
+    scale = z_factor / (2. * pixel_size) / np.maximum(normals[..., 2], 1e-12)
+    return -normals[..., 1] * scale, -normals[..., 0] * scale
+
+
+def derive_from_normals(
+        normals: np.ndarray,
+        modality: str,
+        pixel_size: float,
+        azimuth: float = 315.,
+        altitude: float = 45.,
+) -> np.ndarray:
+    """
+    Calculate hillshade, slope or aspect from a normal-map.
+
+    :param pixel_size: ground size of a pixel in meters, see `tile_pixel_size`
+    :param azimuth: direction of the light in degrees, clockwise from north
+    :param altitude: angle of the light above the horizon in degrees
+    :return: 2d array, hillshade in [0, 1], slope and aspect in degrees
+    """
+    dx, dy = normals_to_gradients(normals, pixel_size)
+    nan_mask = np.isnan(normals[..., 0])
+
+    if modality == "hillshade":
+        az, alt = math.radians(azimuth), math.radians(altitude)
+        light = (math.sin(az) * math.cos(alt), math.cos(az) * math.cos(alt), math.sin(alt))
+        with np.errstate(invalid="ignore"):
+            result = (-dx * light[0] - dy * light[1] + light[2]) / np.sqrt(dx * dx + dy * dy + 1)
+            result = np.clip(result, 0, 1)
+
+    elif modality == "slope":
+        result = np.degrees(np.arctan(np.hypot(dx, dy)))
+
+    elif modality == "aspect":
+        # compass direction of the downhill slope
+        result = np.degrees(np.arctan2(-dx, -dy)) % 360
+
+    else:
+        raise ValueError(f"Can not derive modality '{modality}' from normals")
+
+    result = result.astype(np.float32)
+    result[nan_mask] = np.nan
+    return result
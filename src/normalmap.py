@@ -1,10 +1,16 @@
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, TYPE_CHECKING
 
-from tqdm import tqdm
+import mercantile
 import numpy as np
-import cv2
 
 from .files import PathConfig, MemoryCache
+from .edges import EdgeStore
+from .modalities import derive_from_normals, tile_pixel_size
+from .timing import timings
+
+if TYPE_CHECKING:
+    from .tilesource import TileSource
+    from .shmcache import SharedTileCache
 
 
 class NormalMapper:
@@ -17,14 +23,25 @@ class NormalMapper:
             tile_cache_size: int,
             approximate: bool,
             eps: float = 0.000001,
+            edge_cache_bytes: Optional[int] = None,
+            tile_cache_bytes: Optional[int] = None,
+            tile_source: Optional["TileSource"] = None,
+            shared_cache: Optional["SharedTileCache"] = None,
     ):
         self.pathconfig = pathconfig
+        # lazily reprojects the missing tiles
+        self.tile_source = tile_source
+        # tiles and edges decoded by other worker processes
+        self.shared_cache = shared_cache
         self.zoom = zoom
-        self.edge_cache = MemoryCache(max_items=edge_cache_size)
-        self.tile_cache = MemoryCache(max_items=tile_cache_size)
+        self.edge_cache = MemoryCache(max_items=edge_cache_size, max_bytes=edge_cache_bytes)
+        self.tile_cache = MemoryCache(max_items=tile_cache_size, max_bytes=tile_cache_bytes)
         self.eps = eps
         self.approximate = approximate
         self.num_edges_approximated = 0
+        self.edge_store = EdgeStore(pathconfig, zoom)
+        if not self.edge_store.exists():
+            self.edge_store = None
 
     def cache_edges(self, x: int, y: int, data: np.ndarray):
         for name, edge in (
@@ -40,10 +57,20 @@ class NormalMapper:
         if tile is False:
             return None
         if tile is None:
-            if not self.pathconfig.tile_cache_file_exists(self.zoom, x, y):
-                tile = False
-            else:
-                tile = self.pathconfig.load_tile_cache_file(self.zoom, x, y)
+            if self.shared_cache is not None:
+                tile = self.shared_cache.get_tile(x, y)
+            if tile is None:
+                if self.tile_source is not None:
+                    tile = self.tile_source.get_height(self.zoom, x, y)
+                    if tile is None:
+                        tile = False
+                elif not self.pathconfig.tile_cache_file_exists(self.zoom, x, y):
+                    tile = False
+                else:
+                    tile = self.pathconfig.load_tile_cache_file(self.zoom, x, y)
+                if self.shared_cache is not None:
+                    self.shared_cache.put_tile(x, y, None if tile is False else tile)
+            if tile is not False:
                 self.cache_edges(x, y, tile)
             self.tile_cache.put((x, y), tile)
         return None if tile is False else tile
@@ -55,12 +82,22 @@ class NormalMapper:
         if edge is False:
             edge = None
         elif edge is None:
-            tile = self.get_tile(x, y)
-            if tile is None:
-                self.edge_cache.put((x, y, name), False)
-                edge = None
+            if self.shared_cache is not None:
+                edge = self.shared_cache.get_edge(x, y, name)
+            if edge is None and self.edge_store is not None:
+                edge = self.edge_store.get_edge(x, y, name)
+            if edge is not None:
+                self.edge_cache.put((x, y, name), edge)
             else:
-                edge = self.edge_cache.get((x, y, name))
+                # tiles that are not in the edge store are loaded
+                tile = self.get_tile(x, y)
+                if tile is None:
+                    self.edge_cache.put((x, y, name), False)
+                    edge = None
+                else:
+                    # the tile might come from the tile cache, while its edges have been evicted
+                    self.cache_edges(x, y, tile)
+                    edge = self.edge_cache.get((x, y, name))
 
         #if edge is None and not approximate:
         #    warnings.warn(f"Approximating {name} edge of tile {zoom}/{x}/{y}")
@@ -97,24 +134,55 @@ class NormalMapper:
         # TODO this does not account for window in DTM sector
         #   z_factor = 2 * tile.shape[0] / 40_000
         #   so currently assume 1:1 reprojection
-        z_factor = 2
+        with timings.measure("normal"):
+            return heights_to_normals(tile, z_factor=2, eps=self.eps)
 
-        tile = np.concat(
-            [
-                (tile[2:,   1:-1] - tile[ :-2, 1:-1])[..., None],
-                (tile[1:-1,  :-2] - tile[1:-1, 2:  ])[..., None],
-                np.ones((tile.shape[0] - 2, tile.shape[1] - 2, 1)) * z_factor,
-            ],
-            axis=-1,
-        )
-        tile /= np.linalg.norm(tile, axis=2, keepdims=True) + self.eps
-
-        return tile
+    def derived_map(
+            self,
+            x: int,
+            y: int,
+            modality: str,
+            azimuth: float = 315.,
+            altitude: float = 45.,
+            normals: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Hillshade, slope or aspect of a tile, see `modalities.derive_from_normals`.
+
+        Pass the `normals` if they have been calculated already.
+        """
+        if normals is None:
+            normals = self.normal_map(x, y)
+        pixel_size = tile_pixel_size(mercantile.Tile(x, y, self.zoom), normals.shape[1])
+        with timings.measure(modality):
+            return derive_from_normals(normals, modality, pixel_size, azimuth=azimuth, altitude=altitude)
 
     def stats(self) -> dict:
         return {
             "edge_hits/misses": f"{self.edge_cache.num_hits}/{self.edge_cache.num_misses}",
             "tile_hits/misses": f"{self.tile_cache.num_hits}/{self.tile_cache.num_misses}",
+            **(self.shared_cache.stats() if self.shared_cache is not None else {}),
+            "cache_mb": round((self.edge_cache.num_bytes + self.tile_cache.num_bytes) / 2**20, 1),
             "approxed_edges": self.num_edges_approximated,
         }
 
+
+def heights_to_normals(heights: np.ndarray, z_factor: float = 2., eps: float = 0.000001) -> np.ndarray:
+    """
+    Calculate normals from a height map that is padded by one pixel on each side.
+
+    :param heights: 2d array of shape (H + 2, W + 2)
+    :param z_factor: float, the z component before normalization,
+        which is 2 for central differences over two pixels of 1m
+    :return: array of shape (H, W, 3)
+    """
+    normals = np.concat(
+        [
+            (heights[2:,   1:-1] - heights[ :-2, 1:-1])[..., None],
+            (heights[1:-1,  :-2] - heights[1:-1, 2:  ])[..., None],
+            np.ones((heights.shape[0] - 2, heights.shape[1] - 2, 1)) * z_factor,
+        ],
+        axis=-1,
+    )
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True) + eps
+    return normals
@@ -3,19 +3,21 @@ import math
 import sys
 import warnings
 import zipfile
+import zlib
 import os
 from pathlib import Path
-from typing import Tuple, Union, Optional, List, Generator
+from typing import Tuple, Union, Optional, List, Generator, TYPE_CHECKING
 
 import decouple
 import numpy as np
-import rasterio
-import rasterio.windows
 
 from . import config
-from .download import streaming_download
 from .files import DeleteFileOnException, PathConfig
 
+# rasterio (GDAL) and requests are imported when needed, they slow down the start of every command
+if TYPE_CHECKING:
+    import rasterio
+
 
 class OpenDTM:
     """
@@ -74,57 +76,116 @@ class OpenDTM:
         if cache_filename.exists():
             return
 
+        from .download import streaming_download
         streaming_download(
-            url=f"https://openmaps.online/dtm_ger_download/E{sector[0]}N{sector[1]}.zip",
+            url=self.sector_url(sector),
             local_filename=cache_filename,
             verbose=self.verbose,
         )
 
-    def extract_sector(self, sector: Sector):
+    def sector_url(self, sector: Sector) -> str:
+        return f"https://openmaps.online/dtm_ger_download/E{sector[0]}N{sector[1]}.zip"
+
+    def remote_sector_size(self, sector: Sector) -> Optional[int]:
+        """
+        Size of the sector zip on the server, or None if it can not be requested
+        """
+        from .download import remote_file_size
+        try:
+            return remote_file_size(self.sector_url(sector))
+        except IOError as e:
+            self._log(f"Size of sector {sector} unknown: {e}")
+            return None
+
+    def extract_sector(self, sector: Sector, drop_page_cache: bool = False):
+        """
+        Extract the GeoTiff of a sector from its zip file.
+
+        The member is streamed into a temporary file, verifying size and CRC on the way,
+        and only renamed to the final filename when complete. A small ``.done`` marker
+        next to the tif records the verified CRC and size, so an interrupted extraction
+        (tif without marker) is detected and redone.
+
+        :param drop_page_cache: bool, advise the kernel to drop the written pages
+            from the page cache, to not evict more useful things on big extractions
+        """
         if sector not in self.AVAILABLE_SECTORS:
             raise ValueError(f"Sector {sector} does not exist")
 
         filename_part = f"E{sector[0]}N{sector[1]}"
         cache_zip_filename = self.pathconfig.web_cache_file(*sector, extension=".zip")
         sector_filename = self.pathconfig.web_cache_file(*sector)
-        if not sector_filename.exists():
-            if not cache_zip_filename.exists():
-                if self._download:
-                    self.download_sector(sector)
-                else:
-                    raise ValueError(f"Sector {sector} not downloaded")
-
-            with zipfile.ZipFile(cache_zip_filename) as zf:
-                possible_names = (
-                    f"{filename_part}.tif",
-                    f"{filename_part}/{filename_part}.tif",
-                    f"{filename_part}/{filename_part}_ok.tif",
-                )
-                tif_filename = None
-                for possible_name in possible_names:
-                    try:
-                        zf.getinfo(possible_name)
-                        tif_filename = possible_name
-                        break
-                    except KeyError:
-                        pass
-                if not tif_filename:
-                    files = [f.filename for f in zf.filelist]
-                    raise KeyError(f"None of {possible_names} found in zip, zipped files are:\n{files}")
-
-                self._log(f"Extracting {filename_part}")
-                with zf.open(tif_filename) as fp_src:
-                    os.makedirs(sector_filename.parent, exist_ok=True)
-                    with DeleteFileOnException(sector_filename):
-                        with sector_filename.open("wb") as fp_dst:
-                            while True:
-                                data = fp_src.read(2**20)
-                                if data:
-                                    fp_dst.write(data)
-                                else:
-                                    break
-
-    def open_sector(self, sector: Sector) -> rasterio.DatasetReader:
+        marker_filename = self._extract_marker_filename(sector)
+        if sector_filename.exists() and marker_filename.exists():
+            return
+
+        if not cache_zip_filename.exists():
+            if self._download:
+                self.download_sector(sector)
+            else:
+                raise ValueError(f"Sector {sector} not downloaded")
+
+        with zipfile.ZipFile(cache_zip_filename) as zf:
+            possible_names = (
+                f"{filename_part}.tif",
+                f"{filename_part}/{filename_part}.tif",
+                f"{filename_part}/{filename_part}_ok.tif",
+            )
+            info = None
+            for possible_name in possible_names:
+                try:
+                    info = zf.getinfo(possible_name)
+                    break
+                except KeyError:
+                    pass
+            if info is None:
+                files = [f.filename for f in zf.filelist]
+                raise KeyError(f"None of {possible_names} found in zip, zipped files are:\n{files}")
+
+            if sector_filename.exists():
+                # extracted before the markers existed, trust it if the size matches
+                if sector_filename.stat().st_size == info.file_size:
+                    self._write_extract_marker(sector, crc=info.CRC, size=info.file_size)
+                    return
+                self._log(f"Incomplete extraction of {filename_part}, extracting again")
+                os.remove(sector_filename)
+
+            self._log(f"Extracting {filename_part}")
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(zf.fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            os.makedirs(sector_filename.parent, exist_ok=True)
+            temp_filename = sector_filename.with_name(sector_filename.name + ".part")
+            with zf.open(info) as fp_src:
+                with DeleteFileOnException(temp_filename):
+                    crc, size = _copy_stream(fp_src, temp_filename, drop_page_cache=drop_page_cache)
+                    if size != info.file_size:
+                        raise IOError(f"Extracted {size:,} bytes of {filename_part}, expected {info.file_size:,}")
+                    if crc != info.CRC:
+                        raise IOError(f"CRC mismatch in {filename_part}: {crc:08x} != {info.CRC:08x}")
+            os.replace(temp_filename, sector_filename)
+            self._write_extract_marker(sector, crc=crc, size=size)
+
+    def _extract_marker_filename(self, sector: Sector) -> Path:
+        filename = self.pathconfig.web_cache_file(*sector)
+        return filename.with_name(filename.name + ".done")
+
+    def _write_extract_marker(self, sector: Sector, crc: int, size: int):
+        self._extract_marker_filename(sector).write_text(json.dumps({"crc": crc, "size": size}))
+
+    def open_sector(self, sector: Sector) -> "rasterio.DatasetReader":
+        """
+        Open the GeoTIFF of the sector. Files without a nodata tag are opened through
+        a VRT with -32768 as nodata, so that averaged reads do not mix it into the heights.
+        """
+        import rasterio
+        ds = rasterio.open(self._sector_file(sector))
+        if ds.nodata is None:
+            ds.close()
+            ds = rasterio.open(self.mosaic_vrt([sector]))
+        return ds
+
+    def _sector_file(self, sector: Sector) -> Path:
         if sector not in self.AVAILABLE_SECTORS:
             raise ValueError(f"Sector {sector} does not exist")
         filename = self.pathconfig.web_cache_file(*sector)
@@ -133,4 +194,93 @@ class OpenDTM:
                 self.extract_sector(sector)
             else:
                 raise ValueError(f"Sector {sector} not downloaded or extracted")
-        return rasterio.open(filename)
+        return filename
+
+    def open_mosaic(self, sectors: List[Sector]) -> "rasterio.DatasetReader":
+        """
+        Open the sectors as one virtual dataset (a GDAL VRT),
+        so that tiles on sector borders can be read in one piece.
+        """
+        import rasterio
+        return rasterio.open(self.mosaic_vrt(sectors))
+
+    def mosaic_vrt(self, sectors: List[Sector]) -> str:
+        import rasterio
+        infos = []
+        for sector in sectors:
+            with rasterio.open(self._sector_file(sector)) as ds:
+                infos.append((self.pathconfig.web_cache_file(*sector), ds.width, ds.height, ds.transform, ds.dtypes[0]))
+
+        pixel_size = infos[0][3].a
+        left = min(info[3].c for info in infos)
+        top = max(info[3].f for info in infos)
+        right = max(info[3].c + info[1] * info[3].a for info in infos)
+        bottom = min(info[3].f + info[2] * info[3].e for info in infos)
+        width = int(round((right - left) / pixel_size))
+        height = int(round((top - bottom) / pixel_size))
+
+        sources = []
+        for filename, w, h, transform, dtype in infos:
+            sources.append(
+                f'<ComplexSource><SourceFilename relativeToVRT="0">{filename.resolve()}</SourceFilename>'
+                f'<SourceBand>1</SourceBand>'
+                f'<SourceProperties RasterXSize="{w}" RasterYSize="{h}" DataType="{_gdal_type(dtype)}"/>'
+                f'<SrcRect xOff="0" yOff="0" xSize="{w}" ySize="{h}"/>'
+                f'<DstRect xOff="{(transform.c - left) / pixel_size:.3f}" yOff="{(top - transform.f) / pixel_size:.3f}"'
+                f' xSize="{w * transform.a / pixel_size:.3f}" ySize="{h * -transform.e / pixel_size:.3f}"/>'
+                f'<NODATA>-32768</NODATA></ComplexSource>'
+            )
+        return (
+            f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+            f'<SRS>EPSG:{self.srid}</SRS>'
+            f'<GeoTransform>{left}, {pixel_size}, 0, {top}, 0, {-pixel_size}</GeoTransform>'
+            f'<VRTRasterBand dataType="Float32" band="1"><NoDataValue>-32768</NoDataValue>'
+            + "".join(sources)
+            + '</VRTRasterBand></VRTDataset>'
+        )
+
+
+def _gdal_type(dtype: str) -> str:
+    return {
+        "float32": "Float32", "float64": "Float64", "int16": "Int16", "int32": "Int32", "uint16": "UInt16",
+    }[dtype]
+
+
+def _copy_stream(
+        fp_src,
+        filename: Path,
+        buffer_size: int = 16 * 2**20,
+        drop_page_cache: bool = False,
+) -> Tuple[int, int]:
+    """
+    Copy a readable binary stream into a file with one large reused buffer.
+
+    :return: tuple of (crc32, number of bytes)
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    crc = 0
+    size = 0
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        synced = 0
+        while True:
+            num = fp_src.readinto(buffer)
+            if not num:
+                break
+            chunk = view[:num]
+            crc = zlib.crc32(chunk, crc)
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+            size += num
+
+            if drop_page_cache and hasattr(os, "posix_fadvise") and size - synced >= 16 * buffer_size:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, synced, size - synced, os.POSIX_FADV_DONTNEED)
+                synced = size
+        os.fsync(fd)
+        if drop_page_cache and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return crc, size
@@ -0,0 +1,299 @@
+import json
+from pathlib import Path
+from typing import List, Tuple, Optional, Dict
+
+import mercantile
+import rasterio.warp
+
+from . import config
+from .files import PathConfig
+from .opendtm import OpenDTM
+from .reproject import src_crs, crs_4326
+
+# extracted GeoTiffs of all 281 sectors take 1.6 TB, see README
+DEFAULT_SECTOR_BYTES = 1.6e12 / 281
+
+PLAN_STAGES = ("reproject", "render", "downsample")
+
+TileRect = Tuple[int, int, int, int]
+
+
+def sector_tile_rect(sector: Tuple[int, int], zoom: int) -> TileRect:
+    """
+    The inclusive tile range (x0, y0, x1, y1) of the sector at the zoom level,
+    the same tiles that `reproject_sectors` enumerates
+    """
+    west, south, east, north = rasterio.warp.transform_bounds(
+        src_crs, crs_4326,
+        sector[0] * 1000, sector[1] * 1000, (sector[0] + 40) * 1000, (sector[1] + 40) * 1000,
+    )
+    # same as mercantile.tiles, without enumerating them
+    ul = mercantile.tile(west, north, zoom)
+    lr = mercantile.tile(east - mercantile.LL_EPSILON, south + mercantile.LL_EPSILON, zoom)
+    return ul.x, ul.y, lr.x, lr.y
+
+
+def clip_rect(rect: TileRect, pathconfig: PathConfig, zoom: int, range_zoom: int) -> Optional[TileRect]:
+    """
+    Intersection with the --tile-x/--tile-y ranges, which refer to `range_zoom`
+    """
+    x0, y0, x1, y1 = rect
+    shift = range_zoom - zoom
+    if pathconfig.tile_range_x:
+        x0, x1 = max(x0, pathconfig.tile_range_x[0] >> shift), min(x1, pathconfig.tile_range_x[1] >> shift)
+    if pathconfig.tile_range_y:
+        y0, y1 = max(y0, pathconfig.tile_range_y[0] >> shift), min(y1, pathconfig.tile_range_y[1] >> shift)
+    if x0 > x1 or y0 > y1:
+        return None
+    return x0, y0, x1, y1
+
+
+def rect_area(rect: Optional[TileRect]) -> int:
+    if rect is None:
+        return 0
+    return (rect[2] - rect[0] + 1) * (rect[3] - rect[1] + 1)
+
+
+def count_tiles(rects: List[TileRect]) -> int:
+    """
+    Number of tiles in the union of the inclusive tile ranges
+    """
+    xs = sorted(set(x for r in rects for x in (r[0], r[2] + 1)))
+    count = 0
+    for x_start, x_end in zip(xs, xs[1:]):
+        intervals = sorted((r[1], r[3] + 1) for r in rects if r[0] <= x_start and x_end <= r[2] + 1)
+        height, current_start, current_end = 0, None, None
+        for start, end in intervals:
+            if current_end is None or start > current_end:
+                if current_end is not None:
+                    height += current_end - current_start
+                current_start, current_end = start, end
+            else:
+                current_end = max(current_end, end)
+        if current_end is not None:
+            height += current_end - current_start
+        count += height * (x_end - x_start)
+    return count
+
+
+def load_calibration(filenames: List[str]) -> Dict[str, dict]:
+    """
+    Per-stage rates from `benchmark` results or `--report` timing files.
+
+    For each stage of PLAN_STAGES:
+
+        seconds_per_tile         cpu seconds per output tile, without reading the GeoTiffs
+        tiff_seconds_per_byte    seconds per byte of GeoTiff read (reproject)
+        bytes_per_tile           written bytes per tile
+        resolution               tile resolution of the run, if known
+
+    Later files override earlier ones.
+    """
+    calibration = {}
+    for filename in filenames:
+        data = json.loads(Path(filename).read_text())
+        if "meta" in data and "stages" in data and all(isinstance(s, dict) and "timings" in s for s in data["stages"].values()):
+            # benchmark result
+            for name, stage in data["stages"].items():
+                if name in PLAN_STAGES:
+                    rates = _stage_rates(stage["timings"], stage["seconds"], stage["tiles"])
+                    if rates:
+                        calibration[name] = {**rates, "resolution": data["meta"].get("resolution")}
+        elif data.get("command") in PLAN_STAGES:
+            # timings report of a single command
+            name = data["command"]
+            encode_stage = "npz_encode" if name == "reproject" else None
+            if encode_stage is None:
+                encode_stage = next((s for s in data["stages"] if s.endswith("_encode") and s != "npz_encode"), None)
+            tiles = data["stages"].get(encode_stage, {}).get("count", 0)
+            rates = _stage_rates(data["stages"], data.get("wall_seconds", 0), tiles)
+            if rates:
+                calibration[name] = {**rates, "resolution": data.get("resolution")}
+        else:
+            raise ValueError(f"{filename} is neither a benchmark result nor a timings report")
+    return calibration
+
+
+def _stage_rates(stage_timings: Dict[str, dict], wall_seconds: float, tiles: int) -> Optional[dict]:
+    if not tiles:
+        return None
+    tiff = stage_timings.get("tiff_read", {})
+    write = stage_timings.get("write", {})
+    # the measured stages add up the time of all threads, the wall time covers the rest of a serial run
+    seconds = max(sum(s["seconds"] for s in stage_timings.values()), wall_seconds)
+    return {
+        "seconds_per_tile": (seconds - tiff.get("seconds", 0)) / tiles,
+        "tiff_seconds_per_byte": tiff["seconds"] / tiff["bytes"] if tiff.get("bytes") else 0.,
+        "bytes_per_tile": write["bytes"] / write["count"] if write.get("count") else None,
+    }
+
+
+def default_calibration_files() -> List[str]:
+    """
+    The latest result in the benchmarks directory
+    """
+    path = config.PROJECT_PATH / "benchmarks"
+    files = sorted(path.glob("*.json")) if path.exists() else []
+    return [str(files[-1])] if files else []
+
+
+def make_plan(
+        pathconfig: PathConfig,
+        sectors: List[Tuple[int, int]],
+        zoom: List[int],
+        resolution: int,
+        modality: List[str],
+        downsample_zoom: Optional[int],
+        workers: int,
+        calibration: Dict[str, dict],
+) -> dict:
+    """
+    Estimate tiles, bytes and cpu time of reproject, render and downsample
+    without processing any data
+    """
+    from .schedule import SectorCosts
+
+    zooms = sorted(set(zoom), reverse=True)
+    max_zoom = zooms[0]
+    num_pixels = resolution * resolution
+
+    # tiles of the union of the sector footprints per zoom level
+    def _tiles(z: int) -> int:
+        rects = [
+            clip_rect(sector_tile_rect(s, z), pathconfig, z, max_zoom)
+            for s in sectors
+        ]
+        return count_tiles([r for r in rects if r is not None])
+
+    # the share of each sector that lies in the tile ranges is read
+    source_bytes = 0.
+    for sector in sectors:
+        filename = pathconfig.web_cache_file(*sector)
+        size = filename.stat().st_size if filename.exists() else DEFAULT_SECTOR_BYTES
+        rect = sector_tile_rect(sector, max_zoom)
+        source_bytes += size * rect_area(clip_rect(rect, pathconfig, max_zoom, max_zoom)) / rect_area(rect)
+
+    output_modalities = list(modality)
+    downsample_zooms = list(range(downsample_zoom, max_zoom)) if downsample_zoom is not None else []
+    num_tiles = {z: _tiles(z) for z in sorted(set(zooms + downsample_zooms))}
+
+    stages = {
+        "reproject": {
+            "zooms": zooms,
+            "tiles": sum(num_tiles[z] for z in zooms),
+            "source_bytes": source_bytes,
+            "cache_bytes": None,
+            "output_bytes": 0,
+        },
+        "render": {
+            "zooms": [max_zoom],
+            "tiles": num_tiles[max_zoom] * len(output_modalities),
+            "source_bytes": 0,
+            "cache_bytes": 0,
+            "output_bytes": None,
+        },
+        "downsample": {
+            "zooms": downsample_zooms,
+            "tiles": sum(num_tiles[z] for z in downsample_zooms) * len(output_modalities),
+            "source_bytes": 0,
+            "cache_bytes": 0,
+            "output_bytes": None,
+        },
+    }
+    for name, stage in stages.items():
+        rates = calibration.get(name)
+        stage["cpu_hours"] = None
+        if not rates:
+            continue
+        # per-tile costs and sizes scale with the number of pixels of a tile
+        scale = num_pixels / rates["resolution"] ** 2 if rates.get("resolution") else 1.
+        cpu_seconds = stage["tiles"] * rates["seconds_per_tile"] * scale
+        cpu_seconds += stage["source_bytes"] * rates["tiff_seconds_per_byte"]
+        stage["cpu_hours"] = cpu_seconds / 3600
+        if rates["bytes_per_tile"] is not None:
+            key = "cache_bytes" if name == "reproject" else "output_bytes"
+            # encoded heights do not compress like normal maps, but it's the best guess
+            stage[key] = stage["tiles"] * rates["bytes_per_tile"] * scale
+
+    # a previous reproject run of these settings is better than the benchmark
+    sector_costs = SectorCosts(pathconfig)
+    seconds_per_cost, measured = sector_costs.seconds_per_cost(f"reproject-z{max_zoom}-r{resolution}")
+    if measured and not pathconfig.tile_range_x and not pathconfig.tile_range_y:
+        costs = sector_costs.estimate(OpenDTM(pathconfig=pathconfig, verbose=False), sectors)
+        stages["reproject"]["cpu_hours"] = sum(costs.values()) * seconds_per_cost / 3600
+        stages["reproject"]["calibrated_by"] = "sector-costs"
+
+    for stage in stages.values():
+        stage["wall_hours"] = stage["cpu_hours"] / max(1, workers) if stage["cpu_hours"] is not None else None
+
+    return {
+        "sectors": len(sectors),
+        "resolution": resolution,
+        "modalities": output_modalities,
+        "workers": workers,
+        "tiles_per_zoom": num_tiles,
+        "stages": stages,
+    }
+
+
+def command_plan(
+        pathconfig: PathConfig,
+        sectors: List[Tuple[int, int]],
+        zoom: List[int],
+        resolution: int,
+        modality: List[str],
+        downsample_zoom: Optional[int],
+        workers: int,
+        calibration: Optional[List[str]],
+        output: Optional[str],
+        verbose: bool,
+):
+    """
+    Dry-run of the pipeline: print the estimated tiles, bytes and cpu-hours per stage
+    """
+    if calibration is None:
+        calibration = default_calibration_files()
+    plan = make_plan(
+        pathconfig=pathconfig,
+        sectors=sectors,
+        zoom=zoom,
+        resolution=resolution,
+        modality=modality,
+        downsample_zoom=downsample_zoom,
+        workers=workers,
+        calibration=load_calibration(calibration),
+    )
+    plan["calibration"] = calibration
+
+    if output:
+        Path(output).write_text(json.dumps(plan, indent=2))
+
+    print(f"{plan['sectors']} sector(s), resolution {resolution}, calibration: {', '.join(calibration) or 'none'}")
+    for z, count in plan["tiles_per_zoom"].items():
+        print(f"zoom {z:2}: {count:14,} tiles")
+    print(f"{'stage':12} {'zooms':>10} {'tiles':>14} {'source':>10} {'cache':>10} {'output':>10} {'cpu-hours':>10} {f'wall ({workers}j)':>10}")
+    for name, stage in plan["stages"].items():
+        zooms = stage["zooms"]
+        zoom_str = "-" if not zooms else f"{min(zooms)}" if len(zooms) == 1 else f"{min(zooms)}-{max(zooms)}"
+        print(
+            f"{name:12} {zoom_str:>10} {stage['tiles']:14,} {_format_bytes(stage['source_bytes']):>10}"
+            f" {_format_bytes(stage['cache_bytes']):>10} {_format_bytes(stage['output_bytes']):>10}"
+            f" {_format_hours(stage['cpu_hours']):>10} {_format_hours(stage['wall_hours']):>10}"
+        )
+    if not calibration:
+        print("No calibration, run `python src/cli.py benchmark` or pass --calibration")
+
+
+def _format_bytes(num: Optional[float]) -> str:
+    if num is None:
+        return "?"
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if num < 1000 or unit == "TB":
+            return f"{num:.0f} {unit}" if unit == "B" else f"{num:.1f} {unit}"
+        num /= 1000
+
+
+def _format_hours(hours: Optional[float]) -> str:
+    if hours is None:
+        return "?"
+    return f"{hours:.2f}" if hours < 10 else f"{hours:,.0f}"
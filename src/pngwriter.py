@@ -0,0 +1,95 @@
+import struct
+import zlib
+from pathlib import Path
+from typing import Union, BinaryIO
+
+import numpy as np
+
+
+class PNGStreamWriter:
+    """
+    Writes an 8-bit PNG image row-band by row-band,
+    so the whole image never needs to be in memory.
+
+        with PNGStreamWriter("image.png", width=100_000, height=100_000) as writer:
+            for band in bands:
+                writer.write_rows(band)
+    """
+    COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+    def __init__(
+            self,
+            filename: Union[str, Path],
+            width: int,
+            height: int,
+            channels: int = 4,
+            compress_level: int = 6,
+            chunk_size: int = 2**20,
+    ):
+        if channels not in self.COLOR_TYPES:
+            raise ValueError(f"channels must be one of {list(self.COLOR_TYPES)}, got {channels}")
+        self.filename = Path(filename)
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+        self._fp: BinaryIO = self.filename.open("wb")
+        self._fp.write(b"\x89PNG\r\n\x1a\n")
+        self._write_chunk(b"IHDR", struct.pack(
+            ">IIBBBBB", width, height, 8, self.COLOR_TYPES[channels], 0, 0, 0,
+        ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._fp.close()
+        else:
+            self.close()
+
+    def write_rows(self, rows: np.ndarray):
+        if rows.ndim == 2:
+            rows = rows[..., None]
+        if rows.shape[1:] != (self.width, self.channels):
+            raise ValueError(f"Expected rows of shape (N, {self.width}, {self.channels}), got {rows.shape}")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError(f"Writing more than {self.height} rows")
+
+        # each scanline is prefixed with filter type 0
+        scanlines = np.zeros((rows.shape[0], self.width * self.channels + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows.astype(np.uint8, copy=False).reshape(rows.shape[0], -1)
+        self._add_compressed(self._compressor.compress(scanlines.tobytes()))
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.height:
+            self._fp.close()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows have been written")
+        self._add_compressed(self._compressor.flush())
+        self._flush_idat()
+        self._write_chunk(b"IEND", b"")
+        self._fp.close()
+
+    def _add_compressed(self, data: bytes):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self.chunk_size:
+                self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending:
+            self._write_chunk(b"IDAT", b"".join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+
+    def _write_chunk(self, tag: bytes, data: bytes):
+        self._fp.write(struct.pack(">I", len(data)))
+        self._fp.write(tag)
+        self._fp.write(data)
+        self._fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
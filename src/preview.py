@@ -5,10 +5,14 @@ from typing import List, Tuple, Optional
 from tqdm import tqdm
 import numpy as np
 import cv2
-import PIL.Image
 
 from .files import PathConfig, DeleteFileOnException
-from .normalmap import NormalMapper
+from .modalities import to_rgba_uint8
+from .normalmap import NormalMapper, heights_to_normals
+from .pngwriter import PNGStreamWriter
+from .pyramid import HeightPyramid
+from .resample import resize_area
+from .timing import timings
 
 
 def command_preview(
@@ -22,17 +26,37 @@ def command_preview(
         approximate: bool,
         numbers: bool,
         verbose: bool,
+        no_pyramid: bool = False,
+        lazy: bool = False,
 ):
-    tiles_map = pathconfig.tile_cache_file_map(zoom=zoom)
+    pyramid = HeightPyramid(pathconfig, zoom)
+    level = None
+    if resolution is not None and not no_pyramid and not lazy:
+        level = pyramid.level_for(resolution)
+
+    tile_source = None
+    if lazy:
+        # all tiles of the tile ranges, missing ones are reprojected on demand
+        from .tilesource import TileSource, tiles_in_range
+        tile_source = TileSource(pathconfig, verbose=verbose)
+
+    if level is not None:
+        tiles_map = None
+        min_x, min_y, max_x, max_y = pyramid.extent()
+    else:
+        if tile_source is not None:
+            tiles_map = {tile: None for tile in tiles_in_range(pathconfig, zoom)}
+        else:
+            tiles_map = pathconfig.tile_cache_file_map(zoom=zoom)
 
-    if not tiles_map:
-        print(f"No tiles at {pathconfig.tile_cache_path(modality=modality)}/{zoom}")
-        return
+        if not tiles_map:
+            print(f"No tiles at {pathconfig.tile_cache_path(modality=modality)}/{zoom}")
+            return
 
-    min_x = min(t[0] for t in tiles_map)
-    min_y = min(t[1] for t in tiles_map)
-    max_x = max(t[0] for t in tiles_map)
-    max_y = max(t[1] for t in tiles_map)
+        min_x = min(t[0] for t in tiles_map)
+        min_y = min(t[1] for t in tiles_map)
+        max_x = max(t[0] for t in tiles_map)
+        max_y = max(t[1] for t in tiles_map)
 
     if numbers or verbose:
         print(f"z={zoom}")
@@ -41,78 +65,170 @@ def command_preview(
         if numbers:
             return
 
+    if level is not None:
+        if verbose:
+            print(f"Using pyramid level {level}² at {pyramid.path}")
+        _preview_from_pyramid(
+            pyramid=pyramid,
+            level=level,
+            modality=modality,
+            resolution=resolution,
+            padding=padding,
+            extent=(min_x, min_y, max_x, max_y),
+            verbose=verbose,
+        )
+        return
+
     normal_mapper = None if modality != "normal" else NormalMapper(
         pathconfig=pathconfig,
         zoom=zoom,
         edge_cache_size=edge_cache_size,
         tile_cache_size=tile_cache_size,
         approximate=approximate,
+        tile_source=tile_source,
     )
 
     def _get_cache_tile(x, y):
         if modality == "height":
+            if tile_source is not None:
+                return tile_source.get_height(zoom, x, y)
             return pathconfig.load_tile_cache_file(zoom, x, y, modality=modality)
         elif modality == "normal":
+            if normal_mapper.get_tile(x, y) is None:
+                return None
             return normal_mapper.normal_map(x, y)
 
-    array = None
-    small_res = resolution
-    for (tx, ty), filename in tqdm(tiles_map.items(), desc="tiles", disable=not verbose):
-        x = tx - min_x
-        y = ty - min_y
+    rows = {}
+    for tx, ty in tiles_map:
+        rows.setdefault(ty, []).append(tx)
 
+    num_channels = (3, ) if modality == "normal" else ()
+
+    def _get_preview_tile(tx, ty):
         try:
             data = _get_cache_tile(tx, ty)
+            if data is None:
+                # a lazy tile without data
+                data = np.full((resolution or tile_source.resolution(zoom),) * 2 + num_channels, np.nan)
         except KeyboardInterrupt:
             raise
         except:
             if resolution is None:
                 raise
-            data = np.zeros((resolution, resolution, *array.shape[2:]))
+            data = np.zeros((resolution, resolution, *num_channels))
             if data.ndim == 3:
                 data[..., 0] = 1
+        return data
 
-        if resolution is None:
-            resolution = data.shape[0]
-        if array is None:
-            array = np.zeros((
-                (max_y - min_y + 1) * (resolution + padding),
-                (max_x - min_x + 1) * (resolution + padding),
-                *data.shape[2:]
-            ))
-            array -= 10_000.
-
-        if small_res is not None:
-            data = cv2.resize(data, (small_res, small_res), cv2.INTER_NEAREST)
-        array[
-            y * (resolution + padding): y * (resolution + padding) + resolution,
-            x * (resolution + padding): x * (resolution + padding) + resolution
-        ] = data
-
-    nan_mask = np.isnan(array) | (array <= -10_000)
-    if nan_mask.ndim == 3:
-        nan_mask = nan_mask[..., 0]
-    array[nan_mask] = -1 if modality == "normal" else 0
-
-    if modality == "normal":
-        array = array * .5 + .5
-        array = np.pad(array, ((0, 0), (0, 0), (0, 1)))
-    else:
-        array /= 2000  # TODO: get max height in dataset
-        #array = (1. - np.abs(.5 - array % 1.)*10.).clip(0, 1)
-        array = array[..., None].repeat(4, -1)
+    # the first tile defines the resolution
+    first_tile = next(iter(tiles_map))
+    first_data = _get_preview_tile(*first_tile)
+    small_res = resolution
+    if resolution is None:
+        resolution = first_data.shape[0]
 
-    array[..., 3] = 1. - nan_mask
+    filename = _preview_filename(modality, zoom, resolution, padding)
 
-    image = PIL.Image.fromarray(
-        (array * 255).clip(0, 255).astype(np.uint8)
-    )
+    # only one row of tiles is held in memory
+    band = np.zeros((resolution + padding, (max_x - min_x + 1) * (resolution + padding), 4), dtype=np.uint8)
+    progress = tqdm(total=len(tiles_map), desc="tiles", disable=not verbose)
+    with DeleteFileOnException(filename):
+        with PNGStreamWriter(filename, width=band.shape[1], height=(max_y - min_y + 1) * band.shape[0]) as writer:
+            for ty in range(min_y, max_y + 1):
+                band[:] = 0
+                for tx in rows.get(ty, []):
+                    if (tx, ty) == first_tile:
+                        data = first_data
+                    else:
+                        data = _get_preview_tile(tx, ty)
+                    if small_res is not None:
+                        with timings.measure("resize", bytes=data.nbytes):
+                            data = cv2.resize(data, (small_res, small_res), interpolation=cv2.INTER_NEAREST)
+
+                    x = (tx - min_x) * (resolution + padding)
+                    band[:resolution, x: x + resolution] = to_rgba_uint8(data, modality)
+                    progress.update()
+
+                with timings.measure("png_encode", bytes=band.nbytes):
+                    writer.write_rows(band)
+    progress.close()
+
+    if tile_source is not None:
+        tile_source.close()
+        if verbose:
+            print(tile_source.stats())
+    if verbose:
+        print(f"file://{filename}")
+
+
+def _preview_filename(modality: str, zoom: int, resolution: int, padding: int) -> Path:
     filename = Path(
         f"preview/{modality}-preview-z{zoom}-r{resolution}-p{padding}.png"
     ).resolve()
     os.makedirs(filename.parent, exist_ok=True)
+    return filename
+
+
+def _preview_from_pyramid(
+        pyramid: HeightPyramid,
+        level: int,
+        modality: str,
+        resolution: int,
+        padding: int,
+        extent: Tuple[int, int, int, int],
+        verbose: bool,
+):
+    min_x, min_y, max_x, max_y = extent
+    num_x = max_x - min_x + 1
+    filename = _preview_filename(modality, pyramid.zoom, resolution, padding)
+    # normals of the coarser level get steeper with the size of a pixel
+    z_factor = 2 * pyramid.index["resolution"] / level
+
+    band = np.zeros((resolution + padding, num_x, resolution + padding, 4), dtype=np.uint8)
     with DeleteFileOnException(filename):
-        image.save(filename)
+        with PNGStreamWriter(filename, width=num_x * band.shape[2], height=(max_y - min_y + 1) * band.shape[0]) as writer:
+            for ty in tqdm(range(min_y, max_y + 1), desc="tile rows", disable=not verbose):
+                if modality == "normal":
+                    heights = pyramid.read_rows(level, min_x - 1, max_x + 1, ty * level - 1, (ty + 1) * level + 1)
+                    valid = ~np.isnan(heights[1:-1, 1:-1])
+                    with timings.measure("normal"):
+                        data = heights_to_normals(_fill_nan_border(heights), z_factor=z_factor)
+                    data[~valid] = np.nan
+                    data = data[:, level - 1: level - 1 + num_x * level]
+                else:
+                    data = pyramid.read_rows(level, min_x, max_x, ty * level, (ty + 1) * level)
+
+                if level != resolution:
+                    # NaN-aware, so invalid pixels don't spread into valid ones,
+                    # pixels with more than half invalid support stay transparent
+                    size = (num_x * resolution, resolution)
+                    with timings.measure("resize", bytes=data.nbytes):
+                        if data.ndim == 2:
+                            data = resize_area(data, size, min_weight=.5)
+                        else:
+                            data = np.stack([resize_area(data[..., c], size, min_weight=.5) for c in range(data.shape[2])], -1)
+
+                rgba = to_rgba_uint8(data, modality)
+                band[:resolution, :, :resolution] = rgba.reshape(resolution, num_x, resolution, 4)
+                with timings.measure("png_encode", bytes=band.nbytes):
+                    writer.write_rows(band.reshape(band.shape[0], -1, 4))
+
     if verbose:
         print(f"file://{filename}")
 
+
+def _fill_nan_border(heights: np.ndarray) -> np.ndarray:
+    """
+    Fill NaN pixels next to valid pixels with a neighbour value,
+    so the normals at the border of valid data are not NaN
+    """
+    filled = heights.copy()
+    for shifted in (
+            np.pad(heights[1:], ((0, 1), (0, 0)), constant_values=np.nan),
+            np.pad(heights[:-1], ((1, 0), (0, 0)), constant_values=np.nan),
+            np.pad(heights[:, 1:], ((0, 0), (0, 1)), constant_values=np.nan),
+            np.pad(heights[:, :-1], ((0, 0), (1, 0)), constant_values=np.nan),
+    ):
+        mask = np.isnan(filled)
+        filled[mask] = shifted[mask]
+    return filled
@@ -0,0 +1,207 @@
+import json
+import os
+import warnings
+from multiprocessing.pool import ThreadPool as Pool
+from pathlib import Path
+from typing import List, Tuple, Optional, Dict
+
+from tqdm import tqdm
+import numpy as np
+
+from .files import PathConfig
+from .resample import reduce_by, reduce_2x2, resize_area
+from .timing import timings
+
+
+class HeightPyramid:
+    """
+    Multi-resolution overview of the height cache of one zoom level.
+
+    Each level stores the tiles downsampled to ``r``² pixels, mosaiced into
+    uncompressed blocks of ``block_size``² tiles, so that a row of tiles
+    can be read through memory-mapping without decoding every cache file:
+
+        {tile-cache}/height-pyramid/{zoom}/index.json
+        {tile-cache}/height-pyramid/{zoom}/r{r}/{block_x}/{block_y}.npy
+    """
+    def __init__(self, pathconfig: PathConfig, zoom: int, block_size: int = 64):
+        self.pathconfig = pathconfig
+        self.zoom = zoom
+        self.path = pathconfig.tile_pyramid_path(zoom)
+        self._index = None
+        self._block_size = block_size
+        self._blocks = {}
+
+    @property
+    def index(self) -> Optional[dict]:
+        if self._index is None:
+            filename = self.path / "index.json"
+            if filename.exists():
+                self._index = json.loads(filename.read_text())
+        return self._index
+
+    @property
+    def block_size(self) -> int:
+        return self.index["block_size"] if self.index else self._block_size
+
+    def exists(self) -> bool:
+        return self.index is not None
+
+    def extent(self) -> Tuple[int, int, int, int]:
+        """
+        Returns (min_x, min_y, max_x, max_y) tile extent, limited to the
+        tile ranges of the PathConfig
+        """
+        min_x, min_y, max_x, max_y = self.index["extent"]
+        if self.pathconfig.tile_range_x:
+            min_x = max(min_x, self.pathconfig.tile_range_x[0])
+            max_x = min(max_x, self.pathconfig.tile_range_x[1])
+        if self.pathconfig.tile_range_y:
+            min_y = max(min_y, self.pathconfig.tile_range_y[0])
+            max_y = min(max_y, self.pathconfig.tile_range_y[1])
+        return min_x, min_y, max_x, max_y
+
+    def level_for(self, resolution: int) -> Optional[int]:
+        """
+        Returns the coarsest level that has at least the given resolution per tile
+        """
+        if not self.exists():
+            return None
+        levels = [r for r in self.index["levels"] if r >= resolution]
+        return min(levels) if levels else None
+
+    def block_filename(self, level: int, bx: int, by: int) -> Path:
+        return self.path / f"r{level}" / str(bx) / f"{by}.npy"
+
+    def read_rows(self, level: int, min_x: int, max_x: int, row_start: int, row_end: int) -> np.ndarray:
+        """
+        Read the pixel rows [row_start, row_end) of the level mosaic
+        for the tile columns min_x to max_x (inclusive).
+
+        Row numbers are pixel rows, i.e. tile y * level. Missing data is NaN.
+        """
+        bs = self.block_size
+        block_px = bs * level
+        result = np.full((row_end - row_start, (max_x - min_x + 1) * level), np.nan, dtype=np.float32)
+        by_start, by_end = row_start // block_px, (row_end - 1) // block_px
+        for by in range(by_start, by_end + 1):
+            r0 = max(row_start, by * block_px)
+            r1 = min(row_end, (by + 1) * block_px)
+            for bx in range(min_x // bs, max_x // bs + 1):
+                block = self._get_block(level, bx, by)
+                if block is None:
+                    continue
+                c0 = max(min_x * level, bx * block_px)
+                c1 = min((max_x + 1) * level, (bx + 1) * block_px)
+                result[r0 - row_start: r1 - row_start, c0 - min_x * level: c1 - min_x * level] = block[
+                    r0 - by * block_px: r1 - by * block_px,
+                    c0 - bx * block_px: c1 - bx * block_px,
+                ]
+        return result
+
+    def _get_block(self, level: int, bx: int, by: int) -> Optional[np.ndarray]:
+        key = (level, bx, by)
+        if key not in self._blocks:
+            # only keep the memory-maps of the recent row of blocks
+            self._blocks = {k: v for k, v in self._blocks.items() if k[0] == level and k[2] >= by - 1}
+            filename = self.block_filename(level, bx, by)
+            self._blocks[key] = np.load(filename, mmap_mode="r") if filename.exists() else None
+        return self._blocks[key]
+
+
+def command_pyramid(
+        pathconfig: PathConfig,
+        zoom: int,
+        max_resolution: int,
+        workers: int,
+        overwrite: bool,
+        verbose: bool,
+):
+    pyramid = HeightPyramid(pathconfig, zoom)
+    bs = pyramid.block_size
+
+    tiles_map = pathconfig.tile_cache_file_map(zoom=zoom)
+    if not tiles_map:
+        print(f"No tiles at {pathconfig.tile_cache_path()}/{zoom}")
+        return
+
+    resolution = pathconfig.load_tile_cache_file(zoom, *next(iter(tiles_map))).shape[0]
+    levels = []
+    level = resolution // 2
+    while level >= 1:
+        if level <= max_resolution:
+            levels.append(level)
+        level //= 2
+    if not levels:
+        raise ValueError(f"No pyramid levels for tile resolution {resolution} and --max-resolution {max_resolution}")
+
+    if pyramid.exists() and not overwrite:
+        if pyramid.index["resolution"] != resolution or pyramid.index["levels"] != levels:
+            raise ValueError(
+                f"Existing pyramid has resolution {pyramid.index['resolution']} and levels {pyramid.index['levels']}"
+                f", use --overwrite to rebuild"
+            )
+
+    blocks: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+    for x, y in tiles_map:
+        blocks.setdefault((x // bs, y // bs), []).append((x, y))
+
+    def _build_block(item):
+        (bx, by), tiles = item
+        mosaic = None
+        if not overwrite and all(pyramid.block_filename(l, bx, by).exists() for l in levels):
+            # skip the block when no tile has changed since, otherwise paste into the existing block
+            block_time = min(pyramid.block_filename(l, bx, by).stat().st_mtime for l in levels)
+            tiles = [t for t in tiles if tiles_map[t].stat().st_mtime >= block_time]
+            if not tiles:
+                return
+            mosaic = np.load(pyramid.block_filename(levels[0], bx, by))
+        if mosaic is None:
+            mosaic = np.full((bs * levels[0], bs * levels[0]), np.nan, dtype=np.float32)
+        for x, y in tiles:
+            try:
+                data = pathconfig.load_tile_cache_file(zoom, x, y)
+            except Exception as e:
+                warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(zoom, x, y)}")
+                continue
+            if data.shape[0] % levels[0] == 0:
+                data = reduce_by(data, data.shape[0] // levels[0])
+            else:
+                data = resize_area(data, (levels[0], levels[0]))
+            ox, oy = (x - bx * bs) * levels[0], (y - by * bs) * levels[0]
+            mosaic[oy: oy + levels[0], ox: ox + levels[0]] = data
+
+        for level in levels:
+            if level != levels[0]:
+                mosaic = reduce_2x2(mosaic)
+            filename = pyramid.block_filename(level, bx, by)
+            os.makedirs(filename.parent, exist_ok=True)
+            temp_filename = filename.with_name(f"{filename.stem}.part.npy")
+            with timings.measure("write", bytes=mosaic.nbytes):
+                np.save(temp_filename, mosaic)
+            os.replace(temp_filename, filename)
+
+    items = list(blocks.items())
+    with Pool(max(1, workers)) as pool:
+        for _ in tqdm(pool.imap_unordered(_build_block, items), total=len(items), desc="blocks", disable=not verbose):
+            pass
+
+    extent = [
+        min(t[0] for t in tiles_map),
+        min(t[1] for t in tiles_map),
+        max(t[0] for t in tiles_map),
+        max(t[1] for t in tiles_map),
+    ]
+    if pyramid.exists() and not overwrite:
+        old = pyramid.index["extent"]
+        extent = [min(extent[0], old[0]), min(extent[1], old[1]), max(extent[2], old[2]), max(extent[3], old[3])]
+
+    os.makedirs(pyramid.path, exist_ok=True)
+    (pyramid.path / "index.json").write_text(json.dumps({
+        "resolution": resolution,
+        "block_size": bs,
+        "levels": levels,
+        "extent": extent,
+    }))
+    if verbose:
+        print(f"pyramid levels {levels} at {pyramid.path}")
@@ -0,0 +1,313 @@
+import csv
+import math
+import sys
+import time
+from typing import Optional, Tuple, Callable, List, Dict
+
+import numpy as np
+import rasterio
+import rasterio.warp
+import rasterio.windows
+
+from .files import PathConfig, MemoryCache
+from .opendtm import OpenDTM
+from .timing import timings
+
+
+# half the circumference of the web-mercator world
+MERCATOR_ORIGIN = 20037508.342789244
+# crs of the DTM sectors, in which the distances along a line are ground meters
+METRIC_CRS = "EPSG:25832"
+
+
+def transform_points(
+        x: np.ndarray,
+        y: np.ndarray,
+        src_crs: str,
+        dst_crs: str,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Transform arrays of coordinates between two coordinate reference systems
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if src_crs == dst_crs or not len(x):
+        return x, y
+    if src_crs == "EPSG:4326" and dst_crs == "EPSG:3857":
+        return (
+            np.radians(x) * 6378137.,
+            np.log(np.tan(np.pi / 4 + np.radians(np.clip(y, -85.0511, 85.0511)) / 2)) * 6378137.,
+        )
+    tx, ty = rasterio.warp.transform(src_crs, dst_crs, x, y)
+    return np.asarray(tx), np.asarray(ty)
+
+
+def sample_bilinear(
+        px: np.ndarray,
+        py: np.ndarray,
+        block_size: int,
+        get_block: Callable[[int, int], Optional[np.ndarray]],
+) -> np.ndarray:
+    """
+    Bilinear interpolation at global pixel coordinates of a grid of square blocks.
+
+    Pixel centers are at integer coordinates, block (bx, by) holds the pixels
+    [by * block_size, (by + 1) * block_size) x [bx * block_size, (bx + 1) * block_size).
+    `get_block` is called once per needed block and returns None for missing blocks.
+    Missing or NaN neighbours are ignored, points without any valid neighbour become NaN.
+    """
+    px, py = np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64)
+    x0, y0 = np.floor(px), np.floor(py)
+    fx, fy = px - x0, py - y0
+    x0, y0 = x0.astype(np.int64), y0.astype(np.int64)
+
+    # the 4 neighbours of all points
+    cx = np.concatenate([x0, x0 + 1, x0, x0 + 1])
+    cy = np.concatenate([y0, y0, y0 + 1, y0 + 1])
+    weights = np.concatenate([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy])
+
+    bx, by = cx // block_size, cy // block_size
+    values = np.full(cx.shape, np.nan, dtype=np.float32)
+    for indices in _group_indices(bx, by):
+        block = get_block(int(bx[indices[0]]), int(by[indices[0]]))
+        if block is not None:
+            values[indices] = block[cy[indices] % block_size, cx[indices] % block_size]
+
+    with timings.measure("query_interpolate", bytes=values.nbytes):
+        valid = ~np.isnan(values)
+        weights = np.where(valid, weights, 0).reshape(4, -1)
+        values = np.where(valid, values, 0).reshape(4, -1)
+        weight_sum = weights.sum(axis=0)
+        heights = (values * weights).sum(axis=0) / np.maximum(weight_sum, 1e-12)
+        heights[weight_sum < 1e-6] = np.nan
+    return heights.astype(np.float32)
+
+
+def _group_indices(a: np.ndarray, b: np.ndarray) -> List[np.ndarray]:
+    """
+    The indices of each distinct pair of the two integer arrays
+    """
+    if not len(a):
+        return []
+    key = (a - a.min()) * (int(b.max() - b.min()) + 1) + (b - b.min())
+    order = np.argsort(key, kind="stable")
+    return np.split(order, np.flatnonzero(np.diff(key[order])) + 1)
+
+
+class HeightQuery:
+    """
+    Base class of the height queries, `query` transforms the points
+    to the crs of the source and calls `_query`
+    """
+    crs: str = None
+
+    def query(self, x: np.ndarray, y: np.ndarray, crs: str = "EPSG:4326") -> np.ndarray:
+        x, y = transform_points(x, y, crs, self.crs)
+        if not len(x):
+            return np.zeros((0,), dtype=np.float32)
+        return self._query(x, y)
+
+    def _query(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+
+class CacheHeightQuery(HeightQuery):
+    """
+    Bilinear heights from the reprojected .npz tile cache of one zoom level
+    """
+    crs = "EPSG:3857"
+
+    def __init__(
+            self,
+            pathconfig: PathConfig,
+            zoom: int,
+            tile_cache_size: int = 1000,
+            tile_cache_bytes: Optional[int] = None,
+    ):
+        self.pathconfig = pathconfig
+        self.zoom = zoom
+        self.tile_cache = MemoryCache(max_items=tile_cache_size, max_bytes=tile_cache_bytes)
+        self._resolution = None
+
+    @property
+    def resolution(self) -> Optional[int]:
+        if self._resolution is None:
+            for (x, y), _ in self.pathconfig.iter_tile_cache_files(self.zoom):
+                tile = self.get_tile(x, y)
+                if tile is not None:
+                    self._resolution = tile.shape[0]
+                    break
+        return self._resolution
+
+    def get_tile(self, x: int, y: int) -> Optional[np.ndarray]:
+        tile = self.tile_cache.get((x, y))
+        if tile is None:
+            if not self.pathconfig.tile_cache_file_exists(self.zoom, x, y):
+                tile = False
+            else:
+                tile = self.pathconfig.load_tile_cache_file(self.zoom, x, y)
+            self.tile_cache.put((x, y), tile)
+        return None if tile is False else tile
+
+    def _query(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        resolution = self.resolution
+        if resolution is None:
+            return np.full(x.shape, np.nan, dtype=np.float32)
+        num_pixels = resolution * (1 << self.zoom)
+        px = (x + MERCATOR_ORIGIN) / (2 * MERCATOR_ORIGIN) * num_pixels - .5
+        py = (MERCATOR_ORIGIN - y) / (2 * MERCATOR_ORIGIN) * num_pixels - .5
+        return sample_bilinear(px, py, resolution, self.get_tile)
+
+
+class SectorHeightQuery(HeightQuery):
+    """
+    Bilinear heights from the extracted sector GeoTiffs,
+    read in windows of block_size² pixels
+    """
+    crs = "EPSG:25832"
+
+    def __init__(
+            self,
+            dtm: OpenDTM,
+            block_size: int = 512,
+            block_cache_size: int = 256,
+    ):
+        self.dtm = dtm
+        self.block_size = block_size
+        self.block_cache = MemoryCache(max_items=block_cache_size)
+        self._datasets: Dict[Tuple[int, int], Optional[rasterio.DatasetReader]] = {}
+
+    def close(self):
+        for ds in self._datasets.values():
+            if ds is not None:
+                ds.close()
+        self._datasets.clear()
+
+    def get_dataset(self, sector: Tuple[int, int]) -> Optional[rasterio.DatasetReader]:
+        if sector not in self._datasets:
+            ds = None
+            if self.dtm.pathconfig.web_cache_file(*sector).exists():
+                ds = self.dtm.open_sector(sector)
+            self._datasets[sector] = ds
+        return self._datasets[sector]
+
+    def get_block(self, sector: Tuple[int, int], bx: int, by: int) -> Optional[np.ndarray]:
+        block = self.block_cache.get((sector, bx, by))
+        if block is None:
+            ds = self.get_dataset(sector)
+            block = False
+            if ds is not None and 0 <= bx * self.block_size < ds.width and 0 <= by * self.block_size < ds.height:
+                window = rasterio.windows.Window(
+                    bx * self.block_size, by * self.block_size, self.block_size, self.block_size,
+                )
+                with timings.measure("tiff_read") as m:
+                    block = ds.read(1, window=window, boundless=True, fill_value=np.nan, masked=ds.nodata is not None)
+                    if np.ma.isMaskedArray(block):
+                        block = block.astype(np.float32).filled(np.nan)
+                    block = block.astype(np.float32)
+                    block[block == -32768] = np.nan
+                    m["bytes"] = block.nbytes
+            self.block_cache.put((sector, bx, by), block)
+        return None if block is False else block
+
+    def _query(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        heights = np.full(x.shape, np.nan, dtype=np.float32)
+        sx, sy = np.floor(x / 40000).astype(np.int64), np.floor(y / 40000).astype(np.int64)
+        for indices in _group_indices(sx, sy):
+            sector = self.dtm.sector_at(x[indices[0]], y[indices[0]])
+            ds = self.get_dataset(sector) if sector else None
+            if ds is None:
+                continue
+            px = (x[indices] - ds.transform.c) / ds.transform.a - .5
+            py = (y[indices] - ds.transform.f) / ds.transform.e - .5
+            heights[indices] = sample_bilinear(
+                px, py, self.block_size, lambda bx, by: self.get_block(sector, bx, by),
+            )
+        return heights
+
+
+def densify_line(x: np.ndarray, y: np.ndarray, step: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Points along the polyline every `step` units, including all vertices.
+
+    :return: tuple of x, y and distance along the line
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) < 2:
+        return x, y, np.zeros_like(x)
+    segment_lengths = np.hypot(np.diff(x), np.diff(y))
+    vertex_distance = np.concatenate([[0.], np.cumsum(segment_lengths)])
+    distance = np.union1d(np.arange(0, vertex_distance[-1], step), vertex_distance)
+    return np.interp(distance, vertex_distance, x), np.interp(distance, vertex_distance, y), distance
+
+
+def command_query(
+        pathconfig: PathConfig,
+        source: str,
+        zoom: int,
+        input: Optional[str],
+        output: Optional[str],
+        crs: str,
+        columns: List[str],
+        step: Optional[float],
+        tile_cache_size: int,
+        verbose: bool,
+):
+    """
+    Read points from a CSV, add a height column and write it as CSV.
+
+    With `step`, the points are a polyline and the heights are sampled along it.
+    """
+    crs = crs if ":" in crs else f"EPSG:{crs}"
+    in_fp = open(input, newline="") if input else sys.stdin
+    try:
+        reader = csv.reader(in_fp)
+        header = next(reader, None)
+        if header is None:
+            return
+        if any(c not in header for c in columns):
+            raise ValueError(f"Columns {columns} not found in CSV header {header}")
+        column_indices = [header.index(c) for c in columns]
+        rows = list(reader)
+    finally:
+        if input:
+            in_fp.close()
+
+    x = np.array([float(row[column_indices[0]]) for row in rows], dtype=np.float64)
+    y = np.array([float(row[column_indices[1]]) for row in rows], dtype=np.float64)
+
+    if source == "cache":
+        query = CacheHeightQuery(pathconfig, zoom, tile_cache_size=tile_cache_size)
+    elif source == "sectors":
+        query = SectorHeightQuery(OpenDTM(pathconfig=pathconfig, verbose=verbose))
+    else:
+        raise ValueError(f"Unknown query source '{source}'")
+
+    if step:
+        # web-mercator units are not meters, so the line is densified in the crs of the sectors
+        px, py, distance = densify_line(*transform_points(x, y, crs, METRIC_CRS), step)
+        x, y = transform_points(px, py, METRIC_CRS, crs)
+        header = [*columns, "distance"]
+        rows = [[f"{a:.7f}", f"{b:.7f}", f"{d:.2f}"] for a, b, d in zip(x, y, distance)]
+
+    start_time = time.time()
+    heights = query.query(x, y, crs=crs)
+    seconds = time.time() - start_time
+    if isinstance(query, SectorHeightQuery):
+        query.close()
+
+    out_fp = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(out_fp)
+        writer.writerow([*header, "height"])
+        for row, height in zip(rows, heights):
+            writer.writerow([*row, "" if math.isnan(height) else f"{height:.2f}"])
+    finally:
+        if output:
+            out_fp.close()
+
+    if verbose:
+        print(
+            f"{len(heights):,} points, {int((~np.isnan(heights)).sum()):,} with height"
+            f", {len(heights) / max(seconds, 1e-9):,.0f} points/s",
+            file=sys.stderr,
+        )
@@ -1,24 +1,38 @@
 import math
+import multiprocessing
 import os
+import random
 import warnings
 from multiprocessing.pool import ThreadPool as Pool
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Iterable, Union, TYPE_CHECKING
 
 import mercantile
 from tqdm import tqdm
 import numpy as np
 import cv2
-import PIL.Image
 
-from .files import PathConfig, DeleteFileOnException, split_tile_file_map
+from .files import PathConfig, DeleteFileOnException
+from .modalities import to_rgba, get_nan_mask, MODALITIES, DERIVED_MODALITIES, ENCODED_MODALITIES
 from .normalmap import NormalMapper
+from .resample import resize_area, resize_angles
+from .timing import timings, peak_rss_mb
+from .writer import TileWriter
+
+# imports rasterio, which is only needed for --lazy
+if TYPE_CHECKING:
+    from .tilesource import TileSource
+    from .shmcache import SharedTileCache
+
+
+# workers render interleaved stripes of this many tile columns, which keeps neighbours close
+COLUMN_STRIPE = 16
 
 
 def command_render(
         pathconfig: PathConfig,
-        modality: str,
+        modality: Union[str, List[str]],
         cache_zoom: int,
-        tile_zoom: Optional[int],
+        tile_zoom: Union[None, int, List[int]],
         resolution: Optional[int],
         edge_cache_size: int,
         tile_cache_size: int,
@@ -26,7 +40,43 @@ def command_render(
         workers: int,
         overwrite: bool,
         verbose: bool,
+        memory_budget: Optional[float] = None,
+        azimuth: float = 315.,
+        altitude: float = 45.,
+        lazy: bool = False,
+        lease_dir: Optional[str] = None,
+        node_id: Optional[str] = None,
+        lease_ttl: float = 120.,
+        lease_reset: bool = False,
+        processes: bool = False,
+        shared_cache_size: int = 1000,
+        write_workers: int = 0,
 ):
+    """
+    Render the output tiles, streaming through the tile cache column by column.
+
+    Each cache tile is decoded once and rendered to all modalities and tile zooms.
+    The hillshade, slope and aspect modalities reuse the normal-map of the tile.
+
+    :param memory_budget: optional megabytes for the normal-map caches of all workers
+    :param azimuth: hillshade light direction in degrees, clockwise from north
+    :param altitude: hillshade light angle above the horizon in degrees
+    :param lazy: render all tiles of the --tile-x/--tile-y ranges and reproject
+        the missing cache tiles on demand, see `TileSource`
+    :param lease_dir: split the stripes of COLUMN_STRIPE tile columns between
+        several nodes on a shared filesystem, see `LeaseManager`
+    :param lease_reset: render the stripes again that are done in the lease directory
+    :param processes: run the workers in forked processes instead of threads,
+        they share the decoded tiles and edges in a `SharedTileCache`
+    :param shared_cache_size: number of tiles in the shared cache
+    :param write_workers: number of threads that encode and write the tiles in the background,
+        per process, see `TileWriter`
+    """
+    workers = max(1, workers)
+    if processes and (lazy or lease_dir):
+        raise ValueError("processes can not be combined with lazy or lease_dir")
+    modality = [modality] if isinstance(modality, str) else list(modality)
+    tile_zoom = [cache_zoom] if tile_zoom is None else [tile_zoom] if isinstance(tile_zoom, int) else list(tile_zoom)
     kwargs = dict(
         modality=modality,
         pathconfig=pathconfig,
@@ -38,164 +88,354 @@ def command_render(
         approximate=approximate,
         overwrite=overwrite,
         verbose=verbose,
+        azimuth=azimuth,
+        altitude=altitude,
+        # a quarter for the edges, the rest for whole tiles
+        edge_cache_bytes=int(memory_budget * 2**20 / 4 / workers) if memory_budget else None,
+        tile_cache_bytes=int(memory_budget * 2**20 * 3 / 4 / workers) if memory_budget else None,
+        tile_source=None,
     )
-    tiles_map = pathconfig.tile_cache_file_map(zoom=cache_zoom)
 
-    if not tiles_map and verbose:
-        print("No tiles found")
-        return
+    if lazy:
+        from .tilesource import TileSource, tiles_in_range
+        kwargs["tile_source"] = TileSource(pathconfig, verbose=verbose)
+        tiles = tiles_in_range(pathconfig, cache_zoom)
+        if pathconfig.is_random_order:
+            random.shuffle(tiles)
+            tile_batches = [tiles[i::workers] for i in range(workers)]
+        else:
+            tile_batches = [[t for t in tiles if (t[0] // COLUMN_STRIPE) % workers == i] for i in range(workers)]
+    elif pathconfig.is_random_order:
+        tiles = list(pathconfig.tile_cache_file_map(zoom=cache_zoom))
+        tile_batches = [tiles[i::workers] for i in range(workers)]
+    else:
+        tile_batches = [
+            (
+                tile for tile, _ in pathconfig.iter_tile_cache_files(
+                    zoom=cache_zoom,
+                    column_filter=lambda x, i=i: (x // COLUMN_STRIPE) % workers == i,
+                )
+            )
+            for i in range(workers)
+        ]
+
+    if processes and workers > 1:
+        num_tiles = _render_processes(tile_batches, shared_cache_size, write_workers, kwargs)
+    else:
+        with TileWriter(workers=write_workers) as writer:
+            kwargs["writer"] = writer
+            if lease_dir:
+                num_tiles = _render_leased(
+                    lease_dir, node_id, lease_ttl, lease_reset, tiles if lazy else None, workers, kwargs,
+                )
+            elif workers == 1:
+                num_tiles = _render_tiles(tiles=tile_batches[0], **kwargs)
+            else:
+                with Pool(workers) as pool:
+                    num_tiles = sum(pool.map(
+                        _render_tiles_kwargs,
+                        [
+                            {
+                                "tiles": tiles_batch,
+                                "tqdm_position": i,
+                                **kwargs,
+                            }
+                            for i, tiles_batch in enumerate(tile_batches)
+                        ]
+                    ))
+
+    if kwargs["tile_source"] is not None:
+        kwargs["tile_source"].close()
+    if verbose:
+        if not num_tiles:
+            print("No tiles found")
+        if kwargs["tile_source"] is not None:
+            print(kwargs["tile_source"].stats())
+        print(f"peak rss {peak_rss_mb():.0f} MB")
+
 
-    if workers <= 1:
-        _render_tiles(tiles_map=tiles_map, **kwargs)
+def _render_leased(
+        lease_dir: str,
+        node_id: Optional[str],
+        lease_ttl: float,
+        lease_reset: bool,
+        tiles: Optional[List[Tuple[int, int]]],
+        workers: int,
+        kwargs: dict,
+) -> int:
+    """
+    Render the column stripes this node can claim, until all are done
+
+    :param tiles: the tiles of a lazy run, otherwise the tile cache is listed
+    """
+    from .lease import LeaseManager, job_name
+
+    pathconfig, cache_zoom = kwargs["pathconfig"], kwargs["cache_zoom"]
+    if tiles is None:
+        path = pathconfig.tile_cache_path() / str(cache_zoom)
+        columns = [int(e.name) for e in os.scandir(path) if e.is_dir() and e.name.isdigit()] if path.exists() else []
     else:
-        tiles_map_batches = split_tile_file_map(tiles_map, workers)
-        with Pool(workers) as pool:
-            pool.map(
-                _render_tiles_kwargs,
-                [
-                    {
-                        "tiles_map": tiles_batch,
-                        "tqdm_position": i,
-                        **kwargs,
-                    }
-                    for i, tiles_batch in enumerate(tiles_map_batches)
-                ]
+        columns = [t[0] for t in tiles]
+    stripes = sorted(set(x // COLUMN_STRIPE for x in columns))
+    counts = []
+
+    def _render_stripe(unit: str) -> dict:
+        stripe = int(unit)
+        if tiles is None:
+            stripe_tiles = (
+                tile for tile, _ in pathconfig.iter_tile_cache_files(
+                    zoom=cache_zoom, column_filter=lambda x: x // COLUMN_STRIPE == stripe,
+                )
             )
+        else:
+            stripe_tiles = [t for t in tiles if t[0] // COLUMN_STRIPE == stripe]
+        count = _render_tiles(tiles=stripe_tiles, **{**kwargs, "verbose": False})
+        # the stripe is done when its tiles are on disk
+        kwargs["writer"].flush()
+        counts.append(count)
+        return {"tiles": count}
+
+    job = f"render-{'-'.join(kwargs['modality'])}-z{cache_zoom}-t{'-'.join(str(z) for z in kwargs['tile_zoom'])}"
+    with LeaseManager(lease_dir, job_name(job, pathconfig), node_id=node_id, ttl=lease_ttl, reset=lease_reset) as lease:
+        if lease.num_done_before and kwargs["overwrite"]:
+            warnings.warn(
+                f"{lease.num_done_before} stripe(s) are done by a previous run and are not rendered again,"
+                f" use --lease-reset to overwrite them"
+            )
+        num_units = lease.process([str(s) for s in stripes], _render_stripe, workers=workers)
+    if kwargs["verbose"]:
+        print(f"rendered {num_units} of {len(stripes)} stripe(s) on node {lease.node_id}")
+    return sum(counts)
+
+
+# the tile batches are generators with lambdas, which can not be pickled,
+# so the forked worker processes get them from here
+_PROCESS_STATE = {}
+
+
+def _render_processes(
+        tile_batches: List[Iterable[Tuple[int, int]]],
+        shared_cache_size: int,
+        write_workers: int,
+        kwargs: dict,
+) -> int:
+    from .shmcache import SharedTileCache
+
+    pathconfig, cache_zoom = kwargs["pathconfig"], kwargs["cache_zoom"]
+    first_tile = next(iter(pathconfig.iter_tile_cache_files(zoom=cache_zoom)), None)
+    if first_tile is None:
+        return 0
+    resolution = pathconfig.load_tile_cache_file(cache_zoom, *first_tile[0]).shape[0]
+
+    shared_cache = SharedTileCache(resolution, max_tiles=shared_cache_size)
+    _PROCESS_STATE.update(
+        tile_batches=tile_batches, kwargs=kwargs, shared_cache=shared_cache, write_workers=write_workers,
+    )
+    try:
+        with multiprocessing.get_context("fork").Pool(len(tile_batches)) as pool:
+            results = pool.map(_render_process, range(len(tile_batches)), chunksize=1)
+    finally:
+        _PROCESS_STATE.clear()
+        shared_cache.close()
+
+    for _, snapshot in results:
+        timings.merge(snapshot)
+    if kwargs["verbose"]:
+        print(f"shared cache {shared_cache.num_bytes / 2**20:.0f} MB")
+    return sum(count for count, _ in results)
+
+
+def _render_process(index: int) -> Tuple[int, dict]:
+    # the timings of the parent process have been copied by the fork
+    timings.reset()
+    # the threads of the parent do not exist in the fork
+    with TileWriter(workers=_PROCESS_STATE["write_workers"]) as writer:
+        count = _render_tiles(
+            tiles=_PROCESS_STATE["tile_batches"][index],
+            tqdm_position=index,
+            shared_cache=_PROCESS_STATE["shared_cache"],
+            writer=writer,
+            **_PROCESS_STATE["kwargs"],
+        )
+    return count, timings.snapshot()
 
 
 def _render_tiles_kwargs(kwargs: dict):
-    _render_tiles(**kwargs)
+    return _render_tiles(**kwargs)
+
 
 def _render_tiles(
-        tiles_map,
-        modality: str,
+        tiles: Iterable[Tuple[int, int]],
+        modality: List[str],
         pathconfig: PathConfig,
         cache_zoom: int,
-        tile_zoom: Optional[int],
+        tile_zoom: List[int],
         resolution: Optional[int],
         overwrite: bool,
         edge_cache_size: int,
         tile_cache_size: int,
         approximate: bool,
         verbose: bool,
+        edge_cache_bytes: Optional[int] = None,
+        tile_cache_bytes: Optional[int] = None,
+        azimuth: float = 315.,
+        altitude: float = 45.,
         interpolation: int = cv2.INTER_CUBIC,
         tqdm_position: int = 0,
-):
-    if tile_zoom is None:
-        tile_zoom = cache_zoom
-
-    progress = tqdm(tiles_map.items(), desc="tiles", disable=not verbose, position=tqdm_position)
-    normal_mapper = None if modality != "normal" else NormalMapper(
+        tile_source: Optional["TileSource"] = None,
+        shared_cache: Optional["SharedTileCache"] = None,
+        writer: Optional[TileWriter] = None,
+) -> int:
+    """
+    :return: number of cache tiles that have been looked at
+    """
+    # heights first, so the normal-map finds the decoded tile in its cache, then normals for the derived modalities
+    modalities = sorted(modality, key=lambda m: MODALITIES.index(m))
+    tile_zooms = tile_zoom
+    progress = tqdm(tiles, desc="tiles", disable=not verbose, position=tqdm_position)
+    normal_mapper = None if not set(modalities) & {"normal", *DERIVED_MODALITIES} else NormalMapper(
         pathconfig=pathconfig,
         zoom=cache_zoom,
         edge_cache_size=edge_cache_size,
-        tile_cache_size=tile_cache_size,
+        # the heights are also used for the other modalities
+        tile_cache_size=max(1, tile_cache_size),
         approximate=approximate,
+        edge_cache_bytes=edge_cache_bytes,
+        tile_cache_bytes=tile_cache_bytes,
+        tile_source=tile_source,
+        shared_cache=shared_cache,
     )
 
-    def _get_cache_tile(x, y):
-        if modality == "height":
-            return pathconfig.load_tile_cache_file(cache_zoom, x, y, modality=modality)
-        elif modality == "normal":
-            return normal_mapper.normal_map(x, y)
+    def _get_cache_tile(x: int, y: int, modality: str, computed: dict):
+        """
+        Returns the modality of the cache tile, `computed` holds the modalities of this tile so far
+        """
+        if modality not in computed:
+            if modality == "height":
+                if normal_mapper is not None:
+                    computed[modality] = normal_mapper.get_tile(x, y)
+                elif tile_source is not None:
+                    computed[modality] = tile_source.get_height(cache_zoom, x, y)
+                else:
+                    computed[modality] = pathconfig.load_tile_cache_file(cache_zoom, x, y)
+            elif modality == "normal":
+                computed[modality] = normal_mapper.normal_map(x, y)
+            elif modality in ENCODED_MODALITIES:
+                computed[modality] = _get_cache_tile(x, y, "height", computed)
+            else:
+                computed[modality] = normal_mapper.derived_map(
+                    x, y, modality, azimuth=azimuth, altitude=altitude,
+                    normals=_get_cache_tile(x, y, "normal", computed),
+                )
+        return computed[modality]
+
+    def _in_range(tile: mercantile.Tile) -> bool:
+        if pathconfig.tile_range_x and not pathconfig.tile_range_x[0] <= tile.x <= pathconfig.tile_range_x[1]:
+            return False
+        if pathconfig.tile_range_y and not pathconfig.tile_range_y[0] <= tile.y <= pathconfig.tile_range_y[1]:
+            return False
+        return True
+
+    def _iter_tiles_and_slices(x: int, y: int, tile_zoom: int, data_resolution: int):
+        if tile_zoom == cache_zoom:
+            yield mercantile.Tile(x=x, y=y, z=tile_zoom), (slice(None, None), slice(None, None))
+
+        elif tile_zoom < cache_zoom:
+            div = pow(2, cache_zoom - tile_zoom)
+            yield mercantile.Tile(x=x//div, y=y//div, z=tile_zoom), (slice(None, None), slice(None, None))
+
+        else:
+            fac = pow(2, tile_zoom - cache_zoom)
+            sw = sh = data_resolution // fac
+            for sy in range(fac):
+                for sx in range(fac):
+                    yield (
+                        mercantile.Tile(x=x * fac + sx, y=y * fac + sy, z=tile_zoom),
+                        (slice(sy * sh, (sy + 1) * sh), slice(sx * sw, (sx + 1) * sw)),
+                    )
 
     num_skipped = 0
+    num_tiles = 0
+    # the resize targets are reused for all tiles
+    resize_buffers = {}
 
-    def _iter_tiles(resolution: Optional[int]):
-        nonlocal num_skipped
+    def _resize(data: np.ndarray, resolution: int, modality: str) -> np.ndarray:
+        if modality == "aspect":
+            with timings.measure("resize", bytes=data.nbytes):
+                return resize_angles(data, (resolution, resolution), interpolation=interpolation)
+        shape = (resolution, resolution, *data.shape[2:])
+        buffer = resize_buffers.get((shape, data.dtype))
+        if buffer is None:
+            buffer = resize_buffers[(shape, data.dtype)] = np.empty(shape, dtype=data.dtype)
+        with timings.measure("resize", bytes=data.nbytes):
+            return cv2.resize(data, (resolution, resolution), dst=buffer, interpolation=interpolation)
+
+    def _iter_tiles():
+        nonlocal num_skipped, num_tiles
         data_resolution = None
-        for (x, y), filename in progress:
+        resolutions = {}
+        for x, y in progress:
+            num_tiles += 1
             source_tile = mercantile.Tile(x, y, cache_zoom)
 
-            data = None
+            computed = {}
             if data_resolution is None:
                 try:
-                    data = _get_cache_tile(x, y)
+                    heights = _get_cache_tile(x, y, "height", computed)
                 except Exception as e:
-                    warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(cache_zoom, x, y, modality=modality)}")
+                    warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(cache_zoom, x, y)}")
                     continue
-                data_resolution = data.shape[0]
-            if resolution is None:
-                resolution = int(data_resolution * math.pow(2, cache_zoom - tile_zoom))
-                if verbose:
-                    print(f"Resampling from resolution {data.shape[0]}² to {resolution}²")
-
-            if tile_zoom == cache_zoom:
-                tiles_and_slices = [
-                    (mercantile.Tile(x=x, y=y, z=tile_zoom), (slice(None, None), slice(None, None))),
-                ]
+                if heights is None:
+                    continue
+                data_resolution = heights.shape[0]
+                for z in tile_zooms:
+                    resolutions[z] = resolution or int(data_resolution * math.pow(2, cache_zoom - z))
+                    if verbose:
+                        print(f"Resampling from resolution {data_resolution}² to {resolutions[z]}² at zoom {z}")
 
-            elif tile_zoom < cache_zoom:
-                div = pow(2, cache_zoom - tile_zoom)
-                tiles_and_slices = [
-                    (mercantile.Tile(x=x//div, y=y//div, z=tile_zoom), (slice(None, None), slice(None, None))),
+            targets = [
+                (modality, tile, slices)
+                for modality in modalities
+                for z in tile_zooms
+                for tile, slices in _iter_tiles_and_slices(x, y, z, data_resolution)
+                if _in_range(tile)
+            ]
+            if not overwrite:
+                targets = [
+                    (modality, tile, slices) for modality, tile, slices in targets
+                    if not pathconfig.tile_output_exists(tile.z, tile.x, tile.y, modality=modality)
                 ]
+                if not targets:
+                    num_skipped += 1
+                    continue
 
-            else:
-                fac = pow(2, tile_zoom - cache_zoom)
-                sw = sh = data_resolution // fac
-                tiles_and_slices = []
-                for sy in range(fac):
-                    for sx in range(fac):
-                        tiles_and_slices.append((
-                            mercantile.Tile(x=x * fac + sx, y=y * fac + sy, z=tile_zoom),
-                            (slice(sy * sh, (sy + 1) * sh), slice(sx * sw, (sx + 1) * sw)),
-                         ))
-
-            do_it = overwrite
-            if not do_it:
-                for tile, (slice_y, slice_x) in tiles_and_slices:
-                    if not pathconfig.tile_output_exists(tile.z, tile.x, tile.y, modality=modality):
-                        do_it = True
-                        break
-
-                if not do_it:
-                    num_skipped += len(tiles_and_slices)
-
-            if do_it:
-                if pathconfig.tile_range_x:
-                    tiles_and_slices = [
-                        (tile, slices)
-                        for tile, slices in tiles_and_slices
-                        if pathconfig.tile_range_x[0] <= tile.x <= pathconfig.tile_range_x[1]
-                    ]
-                if pathconfig.tile_range_y:
-                    tiles_and_slices = [
-                        (tile, slices)
-                        for tile, slices in tiles_and_slices
-                        if pathconfig.tile_range_y[0] <= tile.y <= pathconfig.tile_range_y[1]
-                    ]
-
-                if data is None:
-                    try:
-                        data = _get_cache_tile(x, y)
-                    except Exception as e:
-                        warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(cache_zoom, x, y, modality=modality)}")
-                        continue
-                #print("DATA", np.isnan(data).mean(), data.min(), data.max())
-                for tile, (slice_y, slice_x) in tiles_and_slices:
-                    #print(tile, slice_y, slice_x)
+            if tile_source is not None and _get_cache_tile(x, y, "height", computed) is None:
+                # no sector covers this tile
+                continue
+
+            for modality in modalities:
+                modality_targets = [t for t in targets if t[0] == modality]
+                if not modality_targets:
+                    continue
+                try:
+                    data = _get_cache_tile(x, y, modality, computed)
+                except Exception as e:
+                    warnings.warn(f"{type(e).__name__}: {e}: {pathconfig.tile_cache_filename(cache_zoom, x, y)}")
+                    break
+                for _, tile, (slice_y, slice_x) in modality_targets:
                     data_slice = data[slice_y, slice_x]
-                    #print("SLICE", np.isnan(data_slice).mean(), data_slice.min(), data_slice.max())
-                    if data_slice.shape != (resolution, resolution):
-                        data_slice = cv2.resize(
-                            data_slice,
-                            (resolution, resolution),
-                            interpolation,
-                        )
-                    yield source_tile, tile, data_slice
+                    if data_slice.shape[:2] != (resolutions[tile.z], resolutions[tile.z]):
+                        data_slice = _resize(data_slice, resolutions[tile.z], modality)
+                    yield source_tile, modality, tile, data_slice
 
-    for source_tile, tile, array in _iter_tiles(resolution):
+    for source_tile, modality, tile, array in _iter_tiles():
 
         if not overwrite and pathconfig.tile_output_exists(tile.z, tile.x, tile.y, modality=modality):
             num_skipped += 1
             progress.set_postfix({"num_skipped": num_skipped})
             continue
 
-        array2d = array
-        if array2d.ndim == 3:
-            array2d = array2d[..., 0]
-        nan_mask = np.isnan(array2d) | (array2d <= -10_000)
+        nan_mask = get_nan_mask(array)
 
         progress.set_postfix({
             **({"num_skipped": num_skipped} if not overwrite else {}),
@@ -204,18 +444,82 @@ def _render_tiles(
             "filled": f"{round(float((1.-nan_mask.mean())*100), 1)}%",
         })
 
-        if nan_mask.ndim == 3:
-            nan_mask = nan_mask[..., 0]
-        array[nan_mask] = -1 if modality == "normal" else 0
-    
-        if modality == "normal":
-            array = array * .5 + .5
-            array = np.pad(array, ((0, 0), (0, 0), (0, 1)))
+        array = to_rgba(array, modality, nan_mask)
+
+        if writer is not None:
+            writer.save_output_tile(pathconfig, tile.z, tile.x, tile.y, array, modality=modality)
         else:
-            array /= 2000  # TODO: get max height in dataset
-            array = array[..., None].repeat(4, -1)
+            pathconfig.save_output_tile(tile.z, tile.x, tile.y, array, modality=modality)
+
+    return num_tiles
+
+
+def render_tile(
+        pathconfig: PathConfig,
+        modality: str,
+        cache_zoom: int,
+        tile: mercantile.Tile,
+        resolution: int,
+        normal_mapper: Optional[NormalMapper] = None,
+        max_compose_levels: int = 2,
+        interpolation: int = cv2.INTER_CUBIC,
+        azimuth: float = 315.,
+        altitude: float = 45.,
+) -> Optional[np.ndarray]:
+    """
+    Render a single output tile from the height cache, the same way `render` does.
 
-        array[..., 3] = 1. - nan_mask
+    Tiles below the cache zoom are composed from up to 4 ** max_compose_levels cache tiles.
 
-        pathconfig.save_output_tile(tile.z, tile.x, tile.y, array, modality=modality)
+    :return: float RGBA array (uint8 for the encoded height modalities)
+        or None if there is no data for the tile
+    """
+    def _get_cache_tile(x, y) -> Optional[np.ndarray]:
+        if not pathconfig.tile_cache_file_exists(cache_zoom, x, y):
+            return None
+        if modality == "normal":
+            return normal_mapper.normal_map(x, y)
+        if modality in DERIVED_MODALITIES:
+            return normal_mapper.derived_map(x, y, modality, azimuth=azimuth, altitude=altitude)
+        return pathconfig.load_tile_cache_file(cache_zoom, x, y)
+
+    if tile.z >= cache_zoom:
+        fac = pow(2, tile.z - cache_zoom)
+        data = _get_cache_tile(tile.x // fac, tile.y // fac)
+        if data is None:
+            return None
+        if fac > 1:
+            sw = sh = data.shape[0] // fac
+            sx, sy = tile.x % fac, tile.y % fac
+            data = data[sy * sh: (sy + 1) * sh, sx * sw: (sx + 1) * sw]
+        if data.shape[:2] != (resolution, resolution):
+            if modality == "aspect":
+                data = resize_angles(data, (resolution, resolution), interpolation=interpolation)
+            else:
+                data = cv2.resize(data, (resolution, resolution), interpolation=interpolation)
+
+    else:
+        div = pow(2, cache_zoom - tile.z)
+        if div > pow(2, max_compose_levels):
+            return None
+        mosaic = None
+        for sy in range(div):
+            for sx in range(div):
+                sub = _get_cache_tile(tile.x * div + sx, tile.y * div + sy)
+                if sub is None:
+                    continue
+                if mosaic is None:
+                    mosaic = np.full((div * sub.shape[0], div * sub.shape[1], *sub.shape[2:]), np.nan, dtype=np.float32)
+                h, w = sub.shape[:2]
+                mosaic[sy * h: (sy + 1) * h, sx * w: (sx + 1) * w] = sub
+        if mosaic is None:
+            return None
+        if modality == "aspect":
+            data = resize_angles(mosaic, (resolution, resolution))
+        elif mosaic.ndim == 2:
+            data = resize_area(mosaic, (resolution, resolution))
+        else:
+            data = np.stack([resize_area(mosaic[..., c], (resolution, resolution)) for c in range(mosaic.shape[2])], -1)
+            data /= np.linalg.norm(data, axis=2, keepdims=True) + 0.000001
 
+    return to_rgba(data, modality)
@@ -1,11 +1,15 @@
 import math
 import os
 import shutil
+import threading
+import time
 import warnings
-from typing import List, Tuple
+from multiprocessing.pool import ThreadPool as Pool
+from typing import List, Tuple, Optional, Dict, TYPE_CHECKING
 
 from tqdm import tqdm
 import rasterio
+import rasterio.enums
 import rasterio.warp
 import rasterio.windows
 import mercantile
@@ -14,7 +18,14 @@ import cv2
 
 from .opendtm import OpenDTM
 from . import config
-from .files import DeleteFileOnException, PathConfig
+from .files import DeleteFileOnException, PathConfig, sync_to_disk
+from .timing import timings
+from .journal import ReprojectJournal
+from .edges import EdgeStore
+from .resample import reduce_2x2, resize, warp_perspective
+from .writer import TileWriter
+if TYPE_CHECKING:
+    from .lease import LeaseManager
 
 # opendem's opendtm sectors are in
 src_crs = rasterio.crs.CRS.from_epsg(25832)
@@ -23,6 +34,15 @@ crs_4326 = rasterio.crs.CRS.from_epsg(4326)
 # and outputs 3857
 crs_3857 = rasterio.crs.CRS.from_epsg(3857)
 
+# the journal records blocks of (2 ** JOURNAL_BLOCK_LEVELS)² tiles
+JOURNAL_BLOCK_LEVELS = 3
+# journal sector of the metatiles, which are warped from the mosaic of all sectors
+MOSAIC_SECTOR = (0, 0)
+# extra pixels around a metatile, so the warp kernel sees the neighbouring data
+METATILE_BUFFER = 8
+# striped locks of the tile merges in `sample_tile`
+_SAMPLE_TILE_LOCKS = [threading.Lock() for _ in range(64)]
+
 
 def command_show_resolution(**kwargs):
 
@@ -59,98 +79,530 @@ def transform_coord(src_crs: rasterio.crs.CRS, dst_crs: rasterio.crs.CRS, x: flo
 def command_reproject(
         pathconfig: PathConfig,
         sectors: List[Tuple[int, int]],
-        zoom: int,
+        zoom: List[int],
         resolution: int,
         reset: bool,
         verbose: bool,
+        metatile: int = 0,
+        workers: int = 1,
+        lease_dir: Optional[str] = None,
+        node_id: Optional[str] = None,
+        lease_ttl: float = 120.,
+        lease_reset: bool = False,
+        write_workers: int = 0,
 ):
+    """
+    Reproject the sectors into map tiles of one or several zoom levels.
+
+    Only the highest zoom level is warped from the source data, lower levels
+    are reduced from their four children, so each sector is read once.
+    The --tile-x/--tile-y ranges apply to the highest zoom level.
+
+    With `metatile` > 0, blocks of metatile² tiles are warped in one piece
+    from a mosaic of all sectors, see `reproject_metatiles`.
+    Otherwise `workers` sectors are reprojected in parallel, largest first.
+
+    With `lease_dir`, several nodes on a shared filesystem split the work, see `LeaseManager`.
+    The edge stores are not written in this mode, build them with the `edges` command afterwards.
+    Blocks that are done in the lease directory are skipped, `lease_reset` redoes them.
+
+    The tiles are compressed and written by `write_workers` background threads, see `TileWriter`.
+    """
     dtm = OpenDTM(pathconfig=pathconfig, verbose=verbose)
+    zooms = sorted(set(zoom), reverse=True)
 
     available_sectors = dtm.available_sectors(sectors)
     if not available_sectors:
         warnings.warn("No sectors found in cache")
 
+    if lease_dir and (reset or metatile):
+        raise ValueError("--reset and --metatile can not be used with --lease-dir")
+
     if reset:
-        path = pathconfig.tile_cache_path() / str(zoom)
-        if path.exists():
-            shutil.rmtree(path)
+        for z in zooms:
+            for path in (pathconfig.tile_cache_path() / str(z), pathconfig.tile_edges_path(z)):
+                if path.exists():
+                    shutil.rmtree(path)
 
-    for sector in tqdm(available_sectors, desc="sectors", disable=not verbose):
-        with dtm.open_sector(sector) as ds:
-            bounds_4326 = rasterio.warp.transform_bounds(src_crs, crs_4326, *ds.bounds)
-            tiles = list(mercantile.tiles(*bounds_4326, zooms=zoom))
-            if pathconfig.tile_range_x:
-                tiles = [tile for tile in tiles if pathconfig.tile_range_x[0] <= tile.x <= pathconfig.tile_range_x[1]]
-            if pathconfig.tile_range_y:
-                tiles = [tile for tile in tiles if pathconfig.tile_range_y[0] <= tile.y <= pathconfig.tile_range_y[1]]
-            if not tiles:
-                continue
-
-            transformer = rasterio.transform.AffineTransformer(
-                ds.transform
-                # the sectors seem to be a little too small??
-                #* rasterio.Affine.scale(40_000/39_993)
+    lease = None
+    if lease_dir:
+        from .lease import LeaseManager, job_name
+        lease = LeaseManager(
+            lease_dir, job_name(f"reproject-z{zooms[0]}-r{resolution}", pathconfig),
+            node_id=node_id, ttl=lease_ttl, reset=lease_reset,
+        )
+        if lease.num_done_before and verbose:
+            print(f"Skipping {lease.num_done_before} block(s) done by a previous run, use --lease-reset to redo them")
+
+    journals = {
+        z: ReprojectJournal(
+            pathconfig.tile_cache_path() / str(z) / (f"journal.{lease.node_id}.jsonl" if lease else "journal.jsonl")
+        )
+        for z in zooms
+    }
+    num_interrupted = max(j.num_interrupted for j in journals.values())
+    if num_interrupted and verbose:
+        print(f"Redoing {num_interrupted} interrupted tile block(s)")
+    # the memory-mapped shards can not be shared between nodes
+    edge_stores = {z: None if lease else EdgeStore(pathconfig, z) for z in zooms}
+
+    with TileWriter(workers=write_workers) as writer:
+        if metatile:
+            reproject_metatiles(
+                pathconfig, dtm, available_sectors, zooms, resolution, metatile, journals, edge_stores, verbose,
+                writer=writer,
             )
-            for tile in tqdm(tiles, position=1, desc="tiles", disable=not verbose):
-                tile_bounds_3857 = mercantile.xy_bounds(*tile)
-                bl = transform_coord(crs_3857, src_crs, tile_bounds_3857[0], tile_bounds_3857[1])
-                br = transform_coord(crs_3857, src_crs, tile_bounds_3857[2], tile_bounds_3857[1])
-                tl = transform_coord(crs_3857, src_crs, tile_bounds_3857[0], tile_bounds_3857[3])
-                tr = transform_coord(crs_3857, src_crs, tile_bounds_3857[2], tile_bounds_3857[3])
-
-                ptl, pbl, pbr, ptr = (transformer.rowcol(*c)[::-1] for c in (bl, tl, tr, br))
-                p_extent = (
-                    min(p[0] for p in (pbr, ptr, ptl, pbl)),
-                    min(p[1] for p in (pbr, ptr, ptl, pbl)),
-                    max(p[0] for p in (pbr, ptr, ptl, pbl)),
-                    max(p[1] for p in (pbr, ptr, ptl, pbl)),
+        elif lease:
+            with lease:
+                reproject_sectors(
+                    pathconfig, dtm, available_sectors, zooms, resolution, journals, edge_stores, verbose,
+                    workers=workers, lease=lease, writer=writer,
                 )
-                window = rasterio.windows.Window(col_off=p_extent[0], row_off=p_extent[1], width=p_extent[2]-p_extent[0], height=p_extent[3]-p_extent[1]+1)
-                data = ds.read(1, window=window, boundless=True, fill_value=np.nan)
+        else:
+            reproject_sectors(
+                pathconfig, dtm, available_sectors, zooms, resolution, journals, edge_stores, verbose,
+                workers=workers, writer=writer,
+            )
+    for store in edge_stores.values():
+        if store is not None:
+            store.flush()
+
+
+def reproject_sectors(
+        pathconfig: PathConfig,
+        dtm: OpenDTM,
+        sectors: List[Tuple[int, int]],
+        zooms: List[int],
+        resolution: int,
+        journals: Dict[int, ReprojectJournal],
+        edge_stores: Dict[int, EdgeStore],
+        verbose: bool,
+        workers: int = 1,
+        lease: Optional["LeaseManager"] = None,
+        writer: Optional[TileWriter] = None,
+):
+    """
+    Warp the tiles of each sector separately and merge them into the tile cache.
+
+    The sectors are dispatched largest first to `workers` threads,
+    tiles on the border of two sectors are merged under a lock in `sample_tile`.
+
+    With a `lease`, the work units are the journal blocks, each with all the
+    sectors it overlaps, so nodes never merge into the same tile.
+    """
+    from .schedule import schedule_sectors
 
-                vmask = ~np.isnan(data) & (data != -32768)
-                if np.all(~vmask):
+    max_zoom = zooms[0]
+    block_zoom = max(0, min(zooms[-1], max_zoom - JOURNAL_BLOCK_LEVELS))
+    rate_key = f"reproject-z{max_zoom}-r{resolution}"
+
+    sectors, costs, sector_costs = schedule_sectors(
+        pathconfig, dtm, sectors, workers, rate_key=rate_key, verbose=verbose,
+    )
+    sector_seconds = {}
+
+    def _get_blocks(ds: rasterio.DatasetReader) -> Dict[mercantile.Tile, List[mercantile.Tile]]:
+        bounds_4326 = rasterio.warp.transform_bounds(src_crs, crs_4326, *ds.bounds)
+        blocks = {}
+        for tile in mercantile.tiles(*bounds_4326, zooms=max_zoom):
+            blocks.setdefault(mercantile.parent(tile, zoom=block_zoom), []).append(tile)
+        return blocks
+
+    def _reproject_block(
+            ds: rasterio.DatasetReader,
+            sector: Tuple[int, int],
+            block: mercantile.Tile,
+            block_tiles: List[mercantile.Tile],
+            progress: tqdm,
+    ) -> int:
+        """
+        :return: number of reprojected tiles, or -1 if the block was done before
+        """
+        transformer = rasterio.transform.AffineTransformer(
+            ds.transform
+            # the sectors seem to be a little too small??
+            #* rasterio.Affine.scale(40_000/39_993)
+        )
+        # the tiles and their ancestors that are reprojected in this block
+        needed = set()
+
+        def _reproject(tile: mercantile.Tile) -> Optional[np.ndarray]:
+            if tile.z == max_zoom:
+                data = reproject_tile(ds, transformer, tile, resolution)
+                progress.update()
+            else:
+                # depth-first, so only one set of children per level is in memory
+                children = [
+                    _reproject(child) if child in needed else None
+                    for child in mercantile.children(tile)
+                ]
+                if all(c is None for c in children):
+                    return None
+                mosaic = np.full((resolution * 2, resolution * 2), np.nan, dtype=np.float32)
+                for child, data in zip(mercantile.children(tile), children):
+                    if data is not None:
+                        ox, oy = (child.x % 2) * resolution, (child.y % 2) * resolution
+                        mosaic[oy: oy + resolution, ox: ox + resolution] = data
+                with timings.measure("reduce", bytes=mosaic.nbytes):
+                    data = reduce_2x2(mosaic)
+                if np.all(np.isnan(data)):
+                    return None
+
+            if data is not None and tile.z in journals:
+                sample_tile(pathconfig, tile, data, edge_stores[tile.z], writer=writer)
+            return data
+
+        tiles = block_tiles
+        if pathconfig.tile_range_x:
+            tiles = [tile for tile in tiles if pathconfig.tile_range_x[0] <= tile.x <= pathconfig.tile_range_x[1]]
+        if pathconfig.tile_range_y:
+            tiles = [tile for tile in tiles if pathconfig.tile_range_y[0] <= tile.y <= pathconfig.tile_range_y[1]]
+        # only blocks that are not cut by the tile ranges are journaled
+        is_complete = len(tiles) == len(block_tiles)
+
+        if is_complete and all(j.is_done(z, resolution, sector, block) for z, j in journals.items()):
+            progress.update(len(block_tiles))
+            return -1
+
+        if is_complete:
+            for z, j in journals.items():
+                j.begin(z, resolution, sector, block)
+
+        if len(zooms) == 1:
+            for tile in tiles:
+                _reproject(tile)
+        else:
+            for tile in tiles:
+                for z in range(block_zoom, max_zoom + 1):
+                    needed.add(mercantile.parent(tile, zoom=z) if z < max_zoom else tile)
+            _reproject(block)
+
+        if is_complete:
+            _journal_done(journals, resolution, sector, block, writer)
+        return len(tiles)
+
+    def _reproject_sector(sector: Tuple[int, int]):
+        start_time = time.time()
+        num_skipped = 0
+        with dtm.open_sector(sector) as ds:
+            blocks = _get_blocks(ds)
+            progress = tqdm(
+                total=sum(len(t) for t in blocks.values()), position=1, desc="tiles",
+                disable=not verbose or workers > 1,
+            )
+            for block, block_tiles in blocks.items():
+                if _reproject_block(ds, sector, block, block_tiles, progress) < 0:
+                    num_skipped += len(block_tiles)
+                    progress.set_postfix({"skipped": num_skipped})
+            progress.close()
+
+        # sectors that were skipped entirely say nothing about the rate
+        if num_skipped < sum(len(t) for t in blocks.values()):
+            sector_seconds[sector] = time.time() - start_time
+
+    if lease is not None:
+        block_sectors: Dict[mercantile.Tile, Dict[Tuple[int, int], List[mercantile.Tile]]] = {}
+        for sector in sectors:
+            with dtm.open_sector(sector) as ds:
+                for block, block_tiles in _get_blocks(ds).items():
+                    block_sectors.setdefault(block, {})[sector] = block_tiles
+        units = {f"{block.z}-{block.x}-{block.y}": block for block in block_sectors}
+        progress = tqdm(
+            total=sum(len(t) for b in block_sectors.values() for t in b.values()),
+            desc="tiles", disable=not verbose,
+        )
+
+        def _reproject_unit(unit: str) -> dict:
+            block = units[unit]
+            num_tiles = 0
+            for sector, block_tiles in block_sectors[block].items():
+                with dtm.open_sector(sector) as ds:
+                    num_tiles += max(0, _reproject_block(ds, sector, block, block_tiles, progress))
+            # the unit is done when its tiles are on disk
+            if writer is not None:
+                writer.flush()
+            return {"tiles": num_tiles}
+
+        lease.process(units, _reproject_unit, workers=workers)
+        progress.close()
+
+    elif workers <= 1:
+        for sector in tqdm(sectors, desc="sectors", disable=not verbose):
+            _reproject_sector(sector)
+    else:
+        with Pool(workers) as pool:
+            for _ in tqdm(
+                    pool.imap_unordered(_reproject_sector, sectors),
+                    total=len(sectors), desc="sectors", disable=not verbose,
+            ):
+                pass
+
+    if sector_seconds and not pathconfig.tile_range_x and not pathconfig.tile_range_y:
+        sector_costs.add_measurement(
+            rate_key, sum(sector_seconds.values()), sum(costs[s] for s in sector_seconds),
+        )
+        sector_costs.save()
+
+
+def reproject_metatiles(
+        pathconfig: PathConfig,
+        dtm: OpenDTM,
+        sectors: List[Tuple[int, int]],
+        zooms: List[int],
+        resolution: int,
+        metatile: int,
+        journals: Dict[int, ReprojectJournal],
+        edge_stores: Dict[int, EdgeStore],
+        verbose: bool,
+        writer: Optional[TileWriter] = None,
+):
+    """
+    Warp blocks of metatile² tiles from a virtual mosaic of the sectors in one go.
+
+    Tiles on sector borders are warped once instead of once per sector,
+    which removes the seams between sectors. Zoom levels down to
+    log2(metatile) below a warped level are reduced from the warped block,
+    lower ones get their own pass.
+    """
+    if metatile & (metatile - 1):
+        raise ValueError(f"--metatile must be a power of two, got {metatile}")
+    levels = int(math.log2(metatile))
+    if not sectors:
+        return
+
+    with dtm.open_mosaic(sectors) as mosaic:
+        sector_bounds = [
+            rasterio.warp.transform_bounds(src_crs, crs_4326, s[0] * 1000, s[1] * 1000, (s[0] + 40) * 1000, (s[1] + 40) * 1000)
+            for s in sectors
+        ]
+        remaining = list(zooms)
+        while remaining:
+            max_zoom = remaining[0]
+            block_zoom = max(0, max_zoom - levels)
+            group = [z for z in remaining if z >= block_zoom]
+            remaining = remaining[len(group):]
+
+            blocks = sorted(set(
+                tile
+                for bounds in sector_bounds
+                for tile in mercantile.tiles(*bounds, zooms=block_zoom)
+            ))
+            for block in tqdm(blocks, desc=f"metatiles z{max_zoom}", disable=not verbose):
+                tiles = [
+                    t for t in mercantile.children(block, zoom=max_zoom)
+                    if _in_tile_range(pathconfig, t, range_zoom=zooms[0])
+                ]
+                if not tiles:
+                    continue
+                is_complete = len(tiles) == 4 ** (max_zoom - block_zoom)
+                if is_complete and all(journals[z].is_done(z, resolution, MOSAIC_SECTOR, block) for z in group):
                     continue
+                if is_complete:
+                    for z in group:
+                        journals[z].begin(z, resolution, MOSAIC_SECTOR, block)
 
-                data[~vmask] = np.nan
-
-                l, b, r, t = p_extent
-                src = np.float32([[pbl[0]-l, pbl[1]-b], [pbr[0]-l, pbr[1]-b], [ptl[0]-l, ptl[1]-b], [ptr[0]-l, ptr[1]-b]])
-                dst = np.float32([[0, 0], [r - l, 0], [0, t - b + 1], [r - l + 1, t - b]])
-                src *= [[data.shape[1] / window.width, data.shape[0] / window.height]]
-                dst *= [[data.shape[1] / window.width, data.shape[0] / window.height]]
-                # try to fix the edges
-                src = np.float32([
-                    [math.ceil(src[0][0]), math.ceil(src[0][1])],
-                    [math.floor(src[1][0]), math.ceil(src[1][1])],
-                    [math.ceil(src[2][0]), math.floor(src[2][1])],
-                    [math.floor(src[3][0]), math.floor(src[3][1])],
-                ])
-
-                mat = cv2.getPerspectiveTransform(src=src, dst=dst)
-                data = cv2.warpPerspective(
-                    data, mat, (data.shape[1], data.shape[0]),
-                    flags=cv2.INTER_LINEAR,
-                )
+                data = warp_metatile(mosaic, block, (1 << (max_zoom - block_zoom)) * resolution)
+                if data is not None:
+                    wanted = set(tiles)
+                    for z in group:
+                        if z < max_zoom:
+                            wanted.update(mercantile.parent(t, zoom=z) for t in tiles)
+                    for z in range(max_zoom, block_zoom - 1, -1):
+                        if z < max_zoom:
+                            with timings.measure("reduce", bytes=data.nbytes):
+                                data = reduce_2x2(data)
+                        if z not in group:
+                            continue
+                        for tile in mercantile.children(block, zoom=z) if z > block_zoom else [block]:
+                            if tile not in wanted:
+                                continue
+                            ox = (tile.x - (block.x << (z - block_zoom))) * resolution
+                            oy = (tile.y - (block.y << (z - block_zoom))) * resolution
+                            tile_data = data[oy: oy + resolution, ox: ox + resolution]
+                            if not np.all(np.isnan(tile_data)):
+                                sample_tile(pathconfig, tile, tile_data.copy(), edge_stores[z], writer=writer)
 
-                data = cv2.resize(data, (resolution, resolution), cv2.INTER_CUBIC)
+                if is_complete:
+                    _journal_done({z: journals[z] for z in group}, resolution, MOSAIC_SECTOR, block, writer)
 
-                sample_tile(pathconfig, tile, data)
 
+def _journal_done(
+        journals: Dict[int, ReprojectJournal],
+        resolution: int,
+        sector: Tuple[int, int],
+        block: mercantile.Tile,
+        writer: Optional[TileWriter],
+):
+    """
+    Mark the block as done in the journals, once its tiles are written and on disk
+    """
+    def _done():
+        sync_to_disk()
+        for z, j in journals.items():
+            j.done(z, resolution, sector, block)
 
-def sample_tile(pathconfig: PathConfig, tile: mercantile.Tile, array: np.ndarray):
-    if not pathconfig.tile_cache_file_exists(tile.z, tile.x, tile.y):
-        sampler = array
+    if writer is None:
+        _done()
     else:
-        sampler = pathconfig.load_tile_cache_file(tile.z, tile.x, tile.y)
-        if sampler.shape != array.shape:
-            raise ValueError(
-                f"The reprojection samplers have shape {sampler.shape} and reprojected"
-                f" tiles have shape {array.shape}. Use --reset to delete the previous samplers"
-            )
+        writer.on_written(_done)
+
+
+def warp_metatile(mosaic: rasterio.DatasetReader, block: mercantile.Tile, size: int) -> Optional[np.ndarray]:
+    """
+    Warp the area of the block tile to an array of size² pixels in EPSG:3857.
+
+    :return: array with NaN for invalid pixels, or None if there is no valid pixel
+    """
+    left, bottom, right, top = mercantile.xy_bounds(block)
+    pixel_size = (right - left) / size
+    buffer = METATILE_BUFFER
+    data = np.full((size + 2 * buffer, size + 2 * buffer), np.nan, dtype=np.float32)
+    src_pixel_size = mosaic.transform.a
+    with timings.measure("warp", bytes=data.nbytes):
+        rasterio.warp.reproject(
+            source=rasterio.band(mosaic, 1),
+            destination=data,
+            src_nodata=-32768,
+            dst_transform=rasterio.Affine(
+                pixel_size, 0, left - buffer * pixel_size,
+                0, -pixel_size, top + buffer * pixel_size,
+            ),
+            dst_crs=crs_3857,
+            dst_nodata=np.nan,
+            resampling=(
+                rasterio.enums.Resampling.average
+                if pixel_size > src_pixel_size * 2 else rasterio.enums.Resampling.bilinear
+            ),
+        )
+    data = data[buffer: buffer + size, buffer: buffer + size]
+    if np.all(np.isnan(data)):
+        return None
+    return data
+
+
+def _in_tile_range(pathconfig: PathConfig, tile: mercantile.Tile, range_zoom: int) -> bool:
+    """
+    Whether the tile overlaps the --tile-x/--tile-y ranges, which are given at `range_zoom`
+    """
+    shift = range_zoom - tile.z
+    for value, tile_range in ((tile.x, pathconfig.tile_range_x), (tile.y, pathconfig.tile_range_y)):
+        if tile_range and not tile_range[0] >> shift <= value <= tile_range[1] >> shift:
+            return False
+    return True
+
+
+def reproject_tile(
+        ds: rasterio.DatasetReader,
+        transformer: rasterio.transform.AffineTransformer,
+        tile: mercantile.Tile,
+        resolution: int,
+) -> Optional[np.ndarray]:
+    """
+    Reproject the part of the sector that is covered by the map tile.
+
+    :return: array of shape (resolution, resolution) with NaN for invalid pixels,
+        or None if the tile has no valid pixels in this sector
+    """
+    tile_bounds_3857 = mercantile.xy_bounds(*tile)
+    bl = transform_coord(crs_3857, src_crs, tile_bounds_3857[0], tile_bounds_3857[1])
+    br = transform_coord(crs_3857, src_crs, tile_bounds_3857[2], tile_bounds_3857[1])
+    tl = transform_coord(crs_3857, src_crs, tile_bounds_3857[0], tile_bounds_3857[3])
+    tr = transform_coord(crs_3857, src_crs, tile_bounds_3857[2], tile_bounds_3857[3])
+
+    ptl, pbl, pbr, ptr = (transformer.rowcol(*c)[::-1] for c in (bl, tl, tr, br))
+    p_extent = (
+        min(p[0] for p in (pbr, ptr, ptl, pbl)),
+        min(p[1] for p in (pbr, ptr, ptl, pbl)),
+        max(p[0] for p in (pbr, ptr, ptl, pbl)),
+        max(p[1] for p in (pbr, ptr, ptl, pbl)),
+    )
+    window = rasterio.windows.Window(col_off=p_extent[0], row_off=p_extent[1], width=p_extent[2]-p_extent[0], height=p_extent[3]-p_extent[1]+1)
+    # let GDAL average (or use overviews) down to at least twice the target resolution
+    decimation = max(1, int(min(window.width, window.height) // (resolution * 2)))
+    out_shape = (math.ceil(window.height / decimation), math.ceil(window.width / decimation))
+    with timings.measure("tiff_read") as m:
+        data = ds.read(
+            1, window=window, out_shape=out_shape,
+            resampling=rasterio.enums.Resampling.average if decimation > 1 else rasterio.enums.Resampling.nearest,
+            boundless=True, fill_value=np.nan, masked=ds.nodata is not None,
+        )
+        if np.ma.isMaskedArray(data):
+            data = data.astype(np.float32).filled(np.nan)
+        m["bytes"] = data.nbytes
+
+    vmask = ~np.isnan(data) & (data != -32768)
+    if np.all(~vmask):
+        return None
+
+    data[~vmask] = np.nan
+
+    # reduce large windows before the warp, keeping at least twice the target resolution
+    with timings.measure("reduce", bytes=data.nbytes):
+        while min(data.shape) >= resolution * 4:
+            data = reduce_2x2(data)
+
+    l, b, r, t = p_extent
+    src = np.float32([[pbl[0]-l, pbl[1]-b], [pbr[0]-l, pbr[1]-b], [ptl[0]-l, ptl[1]-b], [ptr[0]-l, ptr[1]-b]])
+    dst = np.float32([[0, 0], [r - l, 0], [0, t - b + 1], [r - l + 1, t - b]])
+    # try to fix the edges (in source pixels, before scaling to the decimated data)
+    src = np.float32([
+        [math.ceil(src[0][0]), math.ceil(src[0][1])],
+        [math.floor(src[1][0]), math.ceil(src[1][1])],
+        [math.ceil(src[2][0]), math.floor(src[2][1])],
+        [math.floor(src[3][0]), math.floor(src[3][1])],
+    ])
+    src *= [[data.shape[1] / window.width, data.shape[0] / window.height]]
+    dst *= [[data.shape[1] / window.width, data.shape[0] / window.height]]
+
+    with timings.measure("warp", bytes=data.nbytes):
+        mat = cv2.getPerspectiveTransform(src=src, dst=dst)
+        data = warp_perspective(data, mat, (data.shape[1], data.shape[0]))
+
+    with timings.measure("resize", bytes=data.nbytes):
+        data = resize(data, (resolution, resolution))
+
+    return data
+
+
+def sample_tile(
+        pathconfig: PathConfig,
+        tile: mercantile.Tile,
+        array: np.ndarray,
+        edge_store: Optional[EdgeStore] = None,
+        writer: Optional[TileWriter] = None,
+):
+    """
+    Merge the valid pixels of the array into the cached tile.
+
+    The read-merge-write of one tile, including its edges, is atomic
+    between threads, so sectors sharing a border can be reprojected in parallel.
+    With a `writer`, the tile is written in the background and the array must not be changed afterwards.
+    """
+    with _SAMPLE_TILE_LOCKS[hash(tile) % len(_SAMPLE_TILE_LOCKS)]:
+        pending = None
+        if writer is not None:
+            pending = writer.pending_array(pathconfig.tile_cache_filename(tile.z, tile.x, tile.y))
+        if pending is None and not pathconfig.tile_cache_file_exists(tile.z, tile.x, tile.y):
+            sampler = array
+        else:
+            if pending is not None:
+                # the queued array is being encoded
+                sampler = pending.copy()
+            else:
+                sampler = pathconfig.load_tile_cache_file(tile.z, tile.x, tile.y)
+            if sampler.shape != array.shape:
+                raise ValueError(
+                    f"The reprojection samplers have shape {sampler.shape} and reprojected"
+                    f" tiles have shape {array.shape}. Use --reset to delete the previous samplers"
+                )
 
-        vmask = ~np.isnan(array)
-        sampler[vmask] = array[vmask]
+            vmask = ~np.isnan(array)
+            sampler[vmask] = array[vmask]
 
-    pathconfig.save_tile_cache_file(tile.z, tile.x, tile.y, sampler)
+        if writer is not None:
+            writer.save_tile_cache_file(pathconfig, tile.z, tile.x, tile.y, sampler)
+        else:
+            pathconfig.save_tile_cache_file(tile.z, tile.x, tile.y, sampler)
+        if edge_store is not None:
+            edge_store.put(tile.x, tile.y, sampler)
 
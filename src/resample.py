@@ -0,0 +1,109 @@
+from typing import Tuple, Optional
+
+import numpy as np
+import cv2
+
+
+def reduce_2x2(array: np.ndarray) -> np.ndarray:
+    """
+    Halve the resolution of a 2d array by averaging 2x2 blocks, ignoring NaNs.
+
+    Blocks without any valid pixel become NaN. Odd sizes are padded with NaN.
+    """
+    return reduce_by(array, 2)
+
+
+def reduce_by(array: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Reduce the resolution of a 2d array by averaging factor x factor blocks, ignoring NaNs.
+    """
+    if factor == 1:
+        return array
+    h, w = array.shape[:2]
+    ph, pw = -h % factor, -w % factor
+    if ph or pw:
+        array = np.pad(array, ((0, ph), (0, pw)), constant_values=np.nan)
+        h, w = array.shape[:2]
+
+    blocks = array.reshape(h // factor, factor, w // factor, factor)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        reduced = total / count
+    return reduced.astype(array.dtype, copy=False)
+
+
+def resize_area(array: np.ndarray, size: Tuple[int, int], min_weight: float = 1e-6) -> np.ndarray:
+    """
+    Resize a 2d array to (width, height) with area averaging, ignoring NaNs.
+    Pixels with less than `min_weight` valid support become NaN.
+    """
+    valid = ~np.isnan(array)
+    data = np.where(valid, array, 0).astype(np.float32)
+    weights = cv2.resize(valid.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+    data = cv2.resize(data, size, interpolation=cv2.INTER_AREA)
+    return _normalize(data, weights, min_weight=min_weight)
+
+
+def resize_angles(array: np.ndarray, size: Tuple[int, int], interpolation: Optional[int] = None) -> np.ndarray:
+    """
+    Resize a 2d array of angles in degrees, e.g. the aspect, to (width, height).
+
+    The sines and cosines are resized and recombined, so 359° next to 1° becomes 0° and not 180°.
+    Without `interpolation` they are area averaged with `resize_area`, otherwise resized with cv2.
+    """
+    radians = np.radians(array)
+    sin, cos = np.sin(radians), np.cos(radians)
+    if interpolation is None:
+        sin, cos = resize_area(sin, size), resize_area(cos, size)
+    else:
+        sin = cv2.resize(sin, size, interpolation=interpolation)
+        cos = cv2.resize(cos, size, interpolation=interpolation)
+    return (np.degrees(np.arctan2(sin, cos)) % 360).astype(array.dtype)
+
+
+def resize(array: np.ndarray, size: Tuple[int, int], min_weight: float = .5) -> np.ndarray:
+    """
+    Resize a 2d array to (width, height), ignoring NaNs.
+
+    Large reductions first halve the array with NaN-aware 2x2 means until it is
+    less than twice the target size and finish with area averaging.
+    Enlargements use bilinear interpolation, normalized by the interpolated
+    valid-pixel weights. Pixels with less than `min_weight` valid support become NaN.
+    """
+    while array.shape[1] >= size[0] * 2 and array.shape[0] >= size[1] * 2:
+        array = reduce_2x2(array)
+
+    if array.shape[1] >= size[0] and array.shape[0] >= size[1]:
+        return resize_area(array, size)
+
+    valid = ~np.isnan(array)
+    data = np.where(valid, array, 0).astype(np.float32)
+    weights = cv2.resize(valid.astype(np.float32), size, interpolation=cv2.INTER_LINEAR)
+    data = cv2.resize(data, size, interpolation=cv2.INTER_LINEAR)
+    return _normalize(data, weights, min_weight)
+
+
+def warp_perspective(
+        array: np.ndarray,
+        matrix: np.ndarray,
+        size: Tuple[int, int],
+        min_weight: float = .5,
+) -> np.ndarray:
+    """
+    cv2.warpPerspective with bilinear interpolation that does not spread NaNs,
+    instead invalid pixels are excluded via an interpolated weight mask.
+    """
+    valid = ~np.isnan(array)
+    data = np.where(valid, array, 0).astype(np.float32)
+    weights = cv2.warpPerspective(valid.astype(np.float32), matrix, size, flags=cv2.INTER_LINEAR)
+    data = cv2.warpPerspective(data, matrix, size, flags=cv2.INTER_LINEAR)
+    return _normalize(data, weights, min_weight)
+
+
+def _normalize(data: np.ndarray, weights: np.ndarray, min_weight: float) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data /= weights
+    data[weights < min_weight] = np.nan
+    return data
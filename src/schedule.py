@@ -0,0 +1,171 @@
+import heapq
+import json
+import os
+import statistics
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .files import PathConfig
+from .opendtm import OpenDTM
+
+Sector = OpenDTM.Sector
+
+# seconds per cost unit (byte of zip file) of one worker, until a run has been measured
+DEFAULT_SECONDS_PER_COST = {
+    "cache": 1 / 20_000_000,
+    "reproject": 1 / 2_000_000,
+}
+
+
+class SectorCosts:
+    """
+    Estimated processing cost of each sector, to dispatch the largest sectors first.
+
+    The cost of a sector is the size of its zip (or GeoTiff, if the zip is gone)
+    times the fraction of valid pixels over its footprint, which is read once
+    from a decimated version of the GeoTiff. Unknown sizes count as the median.
+
+    The estimates and the measured seconds per cost unit of previous runs are kept in
+
+        {web-cache}/sector-costs.json
+    """
+    def __init__(self, pathconfig: PathConfig):
+        self.pathconfig = pathconfig
+        self.filename = Path(pathconfig.web_cache_path) / "sector-costs.json"
+        self._lock = threading.Lock()
+        self._data = {"sectors": {}, "rates": {}}
+        if self.filename.exists():
+            try:
+                self._data.update(json.loads(self.filename.read_text()))
+            except json.JSONDecodeError:
+                pass
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.filename.parent, exist_ok=True)
+            temp_filename = self.filename.with_name(f"{self.filename.name}.{os.getpid()}.tmp")
+            temp_filename.write_text(json.dumps(self._data, indent=1))
+            os.replace(temp_filename, self.filename)
+
+    def estimate(self, dtm: OpenDTM, sectors: List[Sector], remote: bool = False) -> Dict[Sector, float]:
+        """
+        :param remote: bool, ask the server for the size of zips that are not downloaded
+        :return: dict of sector -> cost
+        """
+        sizes, fractions = {}, {}
+        for sector in sectors:
+            entry = self._sector_entry(dtm, sector, remote)
+            sizes[sector] = entry.get("bytes")
+            fractions[sector] = entry.get("valid_fraction", 1.)
+
+        known = [s for s in sizes.values() if s]
+        default_size = statistics.median(known) if known else 1
+        return {
+            sector: (sizes[sector] or default_size) * fractions[sector]
+            for sector in sectors
+        }
+
+    def seconds_per_cost(self, key: str) -> Tuple[float, bool]:
+        """
+        :return: tuple of seconds per cost unit and whether it has been measured
+        """
+        rate = self._data["rates"].get(key)
+        if rate:
+            return rate["seconds"] / rate["cost"], True
+        return DEFAULT_SECONDS_PER_COST[key.split("-")[0]], False
+
+    def add_measurement(self, key: str, seconds: float, cost: float):
+        """
+        Store the worker-seconds spent on sectors of the given cost,
+        replacing the previous measurement
+        """
+        if cost > 0:
+            with self._lock:
+                self._data["rates"][key] = {"seconds": seconds, "cost": cost}
+
+    def _sector_entry(self, dtm: OpenDTM, sector: Sector, remote: bool) -> dict:
+        name = f"E{sector[0]}N{sector[1]}"
+        entry = self._data["sectors"].setdefault(name, {})
+
+        zip_filename = self.pathconfig.web_cache_file(*sector, extension=".zip")
+        tif_filename = self.pathconfig.web_cache_file(*sector)
+        if zip_filename.exists():
+            entry["bytes"] = zip_filename.stat().st_size
+        elif not entry.get("bytes") and tif_filename.exists():
+            entry["bytes"] = tif_filename.stat().st_size
+        elif not entry.get("bytes") and remote:
+            entry["bytes"] = dtm.remote_sector_size(sector)
+
+        if tif_filename.exists() and entry.get("valid_mtime") != tif_filename.stat().st_mtime:
+            entry["valid_fraction"] = sector_valid_fraction(dtm, sector)
+            entry["valid_mtime"] = tif_filename.stat().st_mtime
+        return entry
+
+
+def sector_valid_fraction(dtm: OpenDTM, sector: Sector, size: int = 64) -> float:
+    """
+    Fraction of valid pixels in a size² decimated read of the sector GeoTiff
+    """
+    with dtm.open_sector(sector) as ds:
+        data = ds.read(1, out_shape=(size, size), masked=True)
+    valid = ~np.ma.getmaskarray(data) & (data.filled(-32768) != -32768)
+    return float(valid.mean())
+
+
+def lpt_schedule(costs: Dict[Sector, float], workers: int) -> Tuple[List[Sector], float]:
+    """
+    Longest-processing-time-first order of the sectors.
+
+    Handing the sectors in this order to the next free worker puts each one on the
+    least loaded worker, which keeps the makespan within 4/3 of the optimum.
+
+    :return: tuple of the sector order and the predicted makespan in cost units
+    """
+    order = sorted(costs, key=lambda s: (-costs[s], s))
+    loads = [0.] * max(1, workers)
+    for sector in order:
+        heapq.heapreplace(loads, loads[0] + costs[sector])
+    return order, max(loads)
+
+
+def schedule_sectors(
+        pathconfig: PathConfig,
+        dtm: OpenDTM,
+        sectors: List[Sector],
+        workers: int,
+        rate_key: str,
+        remote: bool = False,
+        verbose: bool = False,
+) -> Tuple[List[Sector], Dict[Sector, float], SectorCosts]:
+    """
+    Estimate the sector costs, order them longest first and print the predicted wall time.
+
+    :return: tuple of sector order, costs per sector and the `SectorCosts` to record the run
+    """
+    sector_costs = SectorCosts(pathconfig)
+    costs = sector_costs.estimate(dtm, sectors, remote=remote)
+    sector_costs.save()
+    order, makespan = lpt_schedule(costs, workers)
+
+    if verbose and order:
+        seconds_per_cost, measured = sector_costs.seconds_per_cost(rate_key)
+        longest = costs[order[0]] * seconds_per_cost
+        print(
+            f"predicted wall time {format_seconds(makespan * seconds_per_cost)}"
+            f" for {len(order)} sector(s) on {workers} worker(s)"
+            f", longest sector {format_seconds(longest)}"
+            + ("" if measured else " (uncalibrated)")
+        )
+    return order, costs, sector_costs
+
+
+def format_seconds(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02}s"
+    return f"{seconds // 3600}h {seconds // 60 % 60:02}m"
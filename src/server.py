@@ -0,0 +1,276 @@
+import asyncio
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Dict
+
+import mercantile
+
+from .files import PathConfig, MemoryCache
+from .modalities import MODALITIES
+from .normalmap import NormalMapper
+from .rendertiles import render_tile
+from .timing import timings
+
+
+# state of each render process
+_worker: dict = {}
+
+
+def _init_worker(
+        pathconfig: PathConfig,
+        cache_zoom: int,
+        edge_cache_size: int,
+        tile_cache_size: int,
+        approximate: bool,
+):
+    _worker["pathconfig"] = pathconfig
+    _worker["cache_zoom"] = cache_zoom
+    # one NormalMapper per process, so the neighbour edges are cached between requests
+    _worker["normal_mapper"] = NormalMapper(
+        pathconfig=pathconfig,
+        zoom=cache_zoom,
+        edge_cache_size=edge_cache_size,
+        tile_cache_size=tile_cache_size,
+        approximate=approximate,
+    )
+
+
+def _render_png(modality: str, z: int, x: int, y: int, resolution: int, write_back: bool) -> Tuple[Optional[bytes], dict]:
+    """
+    Returns the encoded image (or None) and the timings of this process since the last call
+    """
+    data = _render_png_data(modality, z, x, y, resolution, write_back)
+    snapshot = timings.snapshot()
+    timings.reset()
+    return data, snapshot
+
+
+def _render_png_data(modality: str, z: int, x: int, y: int, resolution: int, write_back: bool) -> Optional[bytes]:
+    pathconfig: PathConfig = _worker["pathconfig"]
+    array = render_tile(
+        pathconfig=pathconfig,
+        modality=modality,
+        cache_zoom=_worker["cache_zoom"],
+        tile=mercantile.Tile(x, y, z),
+        resolution=resolution,
+        normal_mapper=_worker["normal_mapper"],
+    )
+    if array is None:
+        return None
+
+    data = pathconfig.encode_output_tile(array, modality=modality)
+    if write_back:
+        pathconfig.write_output_tile(z, x, y, data, modality=modality)
+    return data
+
+
+class TileServer:
+    """
+    Serves /{modality}/{z}/{x}/{y}.png, or the extension of the configured output format
+
+    Pre-rendered tiles are read from the output path, missing tiles
+    are rendered from the height cache in a process pool.
+    Encoded images are kept in an in-memory LRU cache.
+    """
+    URL_RE = re.compile(r"^/([\w-]+)/(\d+)/(\d+)/(\d+)(\.\w+)$")
+
+    def __init__(
+            self,
+            pathconfig: PathConfig,
+            cache_zoom: int,
+            resolution: int,
+            workers: int,
+            response_cache_size: int,
+            edge_cache_size: int,
+            tile_cache_size: int,
+            approximate: bool,
+            write_back: bool,
+            verbose: bool,
+    ):
+        self.pathconfig = pathconfig
+        self.cache_zoom = cache_zoom
+        self.resolution = resolution
+        self.write_back = write_back
+        self.verbose = verbose
+        self.response_cache = MemoryCache(max_items=response_cache_size)
+        self.num_rendered = 0
+        self.num_from_disk = 0
+        self._in_flight: Dict[Tuple[str, int, int, int], asyncio.Future] = {}
+        self._executor = ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            initializer=_init_worker,
+            initargs=(pathconfig, cache_zoom, edge_cache_size, tile_cache_size, approximate),
+        )
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    async def get_tile(self, modality: str, z: int, x: int, y: int) -> Optional[bytes]:
+        key = (modality, z, x, y)
+        data = self.response_cache.get(key)
+        if data is not None:
+            return data or None
+
+        # concurrent requests for the same tile wait for the same result
+        if key in self._in_flight:
+            return await asyncio.shield(self._in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            data = await self._load_or_render(modality, z, x, y)
+            # remember empty tiles as well
+            self.response_cache.put(key, data or b"")
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            # the waiting requests get the exception, no need to warn about it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+        return data
+
+    async def _load_or_render(self, modality: str, z: int, x: int, y: int) -> Optional[bytes]:
+        loop = asyncio.get_running_loop()
+        filename = self.pathconfig.tile_output_filename(z, x, y, modality=modality)
+        data = await loop.run_in_executor(None, _read_file, filename)
+        if data is not None:
+            self.num_from_disk += 1
+            return data
+
+        data, worker_timings = await loop.run_in_executor(
+            self._executor, _render_png, modality, z, x, y, self.resolution, self.write_back,
+        )
+        timings.merge(worker_timings)
+        self.num_rendered += 1
+        return data
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    if name.strip().lower() == "connection" and value.strip().lower() == "close":
+                        keep_alive = False
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) < 2:
+                    await self._respond(writer, 400, b"Bad Request", keep_alive=False)
+                    break
+                method, path = parts[0], parts[1].split("?")[0]
+                status, body, content_type = await self._handle_request(method, path)
+                await self._respond(writer, status, body, content_type, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method: str, path: str) -> Tuple[int, bytes, str]:
+        if method != "GET":
+            return 405, b"Method Not Allowed", "text/plain"
+        match = self.URL_RE.match(path)
+        if (
+                not match or match.group(1) not in MODALITIES
+                or match.group(5) != self.pathconfig.output_encoder.extension
+        ):
+            return 404, b"Not Found", "text/plain"
+        modality = match.group(1)
+        z, x, y = (int(g) for g in match.groups()[1:4])
+        try:
+            data = await self.get_tile(modality, z, x, y)
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}: {path}", file=sys.stderr)
+            return 500, b"Internal Server Error", "text/plain"
+        if data is None:
+            return 404, b"Not Found", "text/plain"
+        return 200, data, self.pathconfig.output_encoder.content_type
+
+    @staticmethod
+    async def _respond(
+            writer: asyncio.StreamWriter,
+            status: int,
+            body: bytes,
+            content_type: str = "text/plain",
+            keep_alive: bool = True,
+    ):
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}.get(status, "Error")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Access-Control-Allow-Origin: *\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"\r\n".encode("latin-1")
+        )
+        writer.write(body)
+        await writer.drain()
+
+    def stats(self) -> dict:
+        return {
+            "rendered": self.num_rendered,
+            "from_disk": self.num_from_disk,
+            "response_hits/misses": f"{self.response_cache.num_hits}/{self.response_cache.num_misses}",
+        }
+
+
+def _read_file(filename) -> Optional[bytes]:
+    try:
+        with open(filename, "rb") as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def command_serve(
+        pathconfig: PathConfig,
+        host: str,
+        port: int,
+        cache_zoom: int,
+        resolution: int,
+        workers: int,
+        response_cache_size: int,
+        edge_cache_size: int,
+        tile_cache_size: int,
+        approximate: bool,
+        write_back: bool,
+        verbose: bool,
+):
+    server = TileServer(
+        pathconfig=pathconfig,
+        cache_zoom=cache_zoom,
+        resolution=resolution,
+        workers=workers,
+        response_cache_size=response_cache_size,
+        edge_cache_size=edge_cache_size,
+        tile_cache_size=tile_cache_size,
+        approximate=approximate,
+        write_back=write_back,
+        verbose=verbose,
+    )
+
+    async def _serve():
+        tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+        if verbose:
+            print(f"serving http://{host}:{port}/{{{','.join(MODALITIES)}}}/{{z}}/{{x}}/{{y}}{pathconfig.output_encoder.extension}")
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if verbose:
+            print(server.stats())
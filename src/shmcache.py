@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+from typing import Optional, Union
+
+import numpy as np
+
+from .edges import EDGE_NAMES
+
+# value of empty slots
+_EMPTY = -1
+# the tile is known to not exist
+_MISSING = 1
+_PRESENT = 2
+
+
+class SharedTileCache:
+    """
+    Decoded height tiles and their edges of one zoom level, shared between worker processes.
+
+    The tiles and edges live in fixed-size slabs in one `multiprocessing.shared_memory` block,
+    indexed by a set-associative table in the same block: a tile can only be in one of
+    the `ways` slots of the set its key hashes to, and the least recently used slot
+    of the set is replaced. Each set is guarded by one of `num_locks` process locks.
+
+    The cache is created by the parent process and inherited by the forked workers.
+    `get_tile` returns a copy, so an evicted slot can not change a tile in use.
+    """
+    def __init__(
+            self,
+            resolution: int,
+            max_tiles: int,
+            max_edges: Optional[int] = None,
+            ways: int = 8,
+            num_locks: int = 64,
+            context: Optional[multiprocessing.context.BaseContext] = None,
+    ):
+        self.resolution = resolution
+        self.ways = ways
+        self.num_tile_sets = max(1, max_tiles // ways)
+        self.num_edge_sets = max(1, (max_edges or max_tiles * 8) // ways)
+        num_tiles, num_edges = self.num_tile_sets * ways, self.num_edge_sets * ways
+
+        layout = [
+            ("tile_keys", np.int64, (num_tiles,)),
+            ("tile_states", np.int8, (num_tiles,)),
+            ("tile_stamps", np.int64, (num_tiles,)),
+            ("edge_keys", np.int64, (num_edges,)),
+            ("edge_stamps", np.int64, (num_edges,)),
+            ("tiles", np.float32, (num_tiles, resolution, resolution)),
+            ("edges", np.float32, (num_edges, len(EDGE_NAMES), resolution)),
+        ]
+        offsets, size = [], 0
+        for _, dtype, shape in layout:
+            # keep the slabs aligned
+            size = (size + 63) // 64 * 64
+            offsets.append(size)
+            size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        # the forked workers inherit the object, but only the creator removes the memory
+        self._owner_pid = os.getpid()
+        for (name, dtype, shape), offset in zip(layout, offsets):
+            setattr(self, f"_{name}", np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset))
+        self._tile_keys[:] = _EMPTY
+        self._edge_keys[:] = _EMPTY
+
+        context = context or multiprocessing.get_context("fork")
+        self._locks = [context.Lock() for _ in range(num_locks)]
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @property
+    def num_bytes(self) -> int:
+        return self._shm.size
+
+    def close(self):
+        """
+        Release the shared memory, the creating process also removes it
+        """
+        for name in ("tile_keys", "tile_states", "tile_stamps", "edge_keys", "edge_stamps", "tiles", "edges"):
+            setattr(self, f"_{name}", None)
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+            self._owner_pid = None
+
+    def get_tile(self, x: int, y: int) -> Union[None, bool, np.ndarray]:
+        """
+        :return: the tile, False if it is known to not exist, or None if it is not cached
+        """
+        key = _key(x, y)
+        start = self._set_start(key, self.num_tile_sets)
+        with self._lock(start):
+            for i in range(start, start + self.ways):
+                if self._tile_keys[i] == key:
+                    self._tile_stamps[i] = time.monotonic_ns()
+                    self.num_hits += 1
+                    if self._tile_states[i] == _MISSING:
+                        return False
+                    return self._tiles[i].copy()
+        self.num_misses += 1
+        return None
+
+    def put_tile(self, x: int, y: int, tile: Optional[np.ndarray]):
+        """
+        Store the tile and its edges, None marks a missing tile
+        """
+        if tile is not None and tile.shape != (self.resolution, self.resolution):
+            return
+        key = _key(x, y)
+        start = self._set_start(key, self.num_tile_sets)
+        with self._lock(start):
+            i = self._find_slot(self._tile_keys, self._tile_stamps, start, key)
+            self._tile_keys[i] = _EMPTY
+            if tile is not None:
+                self._tiles[i] = tile
+            self._tile_states[i] = _MISSING if tile is None else _PRESENT
+            self._tile_stamps[i] = time.monotonic_ns()
+            self._tile_keys[i] = key
+        if tile is not None:
+            self.put_edges(x, y, tile)
+
+    def get_edge(self, x: int, y: int, name: str) -> Optional[np.ndarray]:
+        """
+        One edge in the shape of the tile slice, like `EdgeStore.get_edge`
+        """
+        key = _key(x, y)
+        start = self._set_start(key, self.num_edge_sets)
+        with self._lock(start):
+            for i in range(start, start + self.ways):
+                if self._edge_keys[i] == key:
+                    self._edge_stamps[i] = time.monotonic_ns()
+                    edge = self._edges[i, EDGE_NAMES.index(name)].copy()
+                    return edge[:, None] if name in ("left", "right") else edge[None, :]
+        return None
+
+    def put_edges(self, x: int, y: int, tile: np.ndarray):
+        key = _key(x, y)
+        start = self._set_start(key, self.num_edge_sets)
+        with self._lock(start):
+            i = self._find_slot(self._edge_keys, self._edge_stamps, start, key)
+            self._edge_keys[i] = _EMPTY
+            self._edges[i] = (tile[:, 0], tile[:, -1], tile[0], tile[-1])
+            self._edge_stamps[i] = time.monotonic_ns()
+            self._edge_keys[i] = key
+
+    def stats(self) -> dict:
+        return {
+            "shared_hits/misses": f"{self.num_hits}/{self.num_misses}",
+        }
+
+    def _set_start(self, key: int, num_sets: int) -> int:
+        # fibonacci hashing, the high bits mix x and y, so neighbouring tiles go to different sets
+        return (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 24) % num_sets * self.ways
+
+    def _lock(self, start: int):
+        return self._locks[(start // self.ways) % len(self._locks)]
+
+    def _find_slot(self, keys: np.ndarray, stamps: np.ndarray, start: int, key: int) -> int:
+        """
+        The slot of the key, an empty one or the least recently used one of the set
+        """
+        set_keys = keys[start: start + self.ways]
+        for i in np.flatnonzero(set_keys == key):
+            return start + int(i)
+        for i in np.flatnonzero(set_keys == _EMPTY):
+            return start + int(i)
+        return start + int(np.argmin(stamps[start: start + self.ways]))
+
+
+def _key(x: int, y: int) -> int:
+    return (x << 32) | y
@@ -0,0 +1,27 @@
+import os
+import unittest
+
+from src.benchmark import run_benchmark, _run_stage
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_100_synthetic_pipeline(self):
+        result = run_benchmark(
+            sectors=[(640, 5600), (680, 5600)],
+            pixels=800,
+            zoom=11,
+            resolution=32,
+        )
+        self.assertEqual(["reproject", "render", "downsample", "preview"], list(result["stages"]))
+        for name, stage in result["stages"].items():
+            self.assertGreater(stage["tiles"], 0, name)
+            self.assertGreater(stage["peak_rss_mb"], 0, name)
+        self.assertIn("tiff_read", result["stages"]["reproject"]["timings"])
+        # the cli does not import the command modules
+        self.assertLess(result["import_seconds"]["src.cli"], result["import_seconds"]["src.reproject"])
+
+    def test_200_dead_stage(self):
+        # like a stage that is killed by the out-of-memory killer
+        with self.assertRaises(RuntimeError):
+            _run_stage(lambda: os._exit(9))
@@ -0,0 +1,49 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.edges import EdgeStore, command_edges
+from src.files import PathConfig
+from src.normalmap import NormalMapper
+from src.timing import timings
+
+
+class TestEdges(unittest.TestCase):
+
+    def test_100_put_get(self):
+        with tempfile.TemporaryDirectory() as path:
+            pathconfig = PathConfig(tile_cache_path=Path(path))
+            store = EdgeStore(pathconfig, zoom=12, shard_size=4)
+            data = np.arange(64, dtype=np.float32).reshape(8, 8)
+            store.put(1001, 1002, data)
+            store.flush()
+
+            store = EdgeStore(pathconfig, zoom=12)
+            self.assertEqual(4, store.shard_size)
+            self.assertIsNone(store.get(1002, 1002))
+            self.assertIsNone(store.get(2000, 2000))
+            np.testing.assert_equal(data[:, :1], store.get_edge(1001, 1002, "left"))
+            np.testing.assert_equal(data[:, -1:], store.get_edge(1001, 1002, "right"))
+            np.testing.assert_equal(data[:1], store.get_edge(1001, 1002, "bottom"))
+            np.testing.assert_equal(data[-1:], store.get_edge(1001, 1002, "top"))
+
+    def test_200_normal_map_from_edges(self):
+        with tempfile.TemporaryDirectory() as path:
+            pathconfig = PathConfig(tile_cache_path=Path(path))
+            rng = np.random.default_rng(23)
+            for x in range(3):
+                for y in range(3):
+                    pathconfig.save_tile_cache_file(12, 100 + x, 100 + y, rng.normal(size=(16, 16)).astype(np.float32))
+
+            kwargs = dict(pathconfig=pathconfig, zoom=12, edge_cache_size=100, tile_cache_size=1, approximate=False)
+            expected = NormalMapper(**kwargs).normal_map(101, 101)
+
+            command_edges(pathconfig, zoom=12, workers=2, verbose=False)
+            mapper = NormalMapper(**kwargs)
+            timings.reset()
+            np.testing.assert_allclose(expected, mapper.normal_map(101, 101))
+            # only the center tile is decoded
+            self.assertEqual(1, timings.snapshot()["npz_decode"]["count"])
+            self.assertEqual(0, mapper.num_edges_approximated)
@@ -0,0 +1,53 @@
+import io
+import unittest
+
+import numpy as np
+import PIL.Image
+
+from src.encoders import ENCODERS, optimize_png_mode
+
+
+class TestEncoders(unittest.TestCase):
+
+    def assert_lossless(self, rgba: np.ndarray):
+        for encoder in ENCODERS.values():
+            if not encoder.lossless:
+                continue
+            image = PIL.Image.open(io.BytesIO(encoder.encode(PIL.Image.fromarray(rgba))))
+            decoded = np.asarray(image.convert("RGBA"))
+            opaque = rgba[..., 3] == 255
+            np.testing.assert_equal(rgba[..., 3], decoded[..., 3], err_msg=encoder.name)
+            np.testing.assert_equal(rgba[opaque], decoded[opaque], err_msg=encoder.name)
+
+    def test_100_lossless(self):
+        rng = np.random.Generator(np.random.PCG64(23))
+        rgba = rng.integers(0, 256, (64, 64, 4), dtype=np.uint8)
+        rgba[..., 3] = 255
+        rgba[:10, :20, 3] = 0
+        self.assert_lossless(rgba)
+
+        gray = rgba.copy()
+        gray[..., 1] = gray[..., 2] = gray[..., 0]
+        self.assert_lossless(gray)
+
+        few_colors = rgba.copy()
+        few_colors[..., :3] = few_colors[..., :3] // 64
+        self.assert_lossless(few_colors)
+
+    def test_200_optimized_modes(self):
+        rgba = np.zeros((32, 32, 4), dtype=np.uint8)
+        rgba[..., 3] = 255
+        rgba[:4, :4, 3] = 0
+        rgba[..., :3] = (np.arange(32 * 32) % 256).astype(np.uint8).reshape(32, 32, 1)
+        # all 256 gray values and a transparent one neither fit into grayscale nor a palette
+        self.assertEqual("RGB", optimize_png_mode(PIL.Image.fromarray(rgba)).mode)
+
+        rgba[..., :3] //= 2
+        self.assertEqual("L", optimize_png_mode(PIL.Image.fromarray(rgba)).mode)
+
+        rgba[..., 1] = 0
+        self.assertEqual("P", optimize_png_mode(PIL.Image.fromarray(rgba)).mode)
+
+        # partial transparency is kept
+        rgba[0, 0, 3] = 128
+        self.assertEqual("RGBA", optimize_png_mode(PIL.Image.fromarray(rgba)).mode)
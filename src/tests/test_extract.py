@@ -0,0 +1,51 @@
+import unittest
+import tempfile
+import zipfile
+from pathlib import Path
+
+from src.files import PathConfig
+from src.opendtm import OpenDTM
+
+
+class TestExtract(unittest.TestCase):
+
+    def test_100_extract_sector(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            pathconfig = PathConfig(web_cache_path=base_path)
+            dtm = OpenDTM(pathconfig=pathconfig, verbose=False)
+            sector = (640, 5600)
+            content = bytes(range(256)) * 10_000
+
+            zip_filename = pathconfig.web_cache_file(*sector, extension=".zip")
+            zip_filename.parent.mkdir(parents=True)
+            with zipfile.ZipFile(zip_filename, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr("E640N5600/E640N5600.tif", content)
+
+            dtm.extract_sector(sector)
+
+            tif_filename = pathconfig.web_cache_file(*sector)
+            self.assertEqual(content, tif_filename.read_bytes())
+            self.assertTrue(Path(f"{tif_filename}.done").exists())
+            self.assertFalse(Path(f"{tif_filename}.part").exists())
+
+    def test_200_redo_interrupted_extraction(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            pathconfig = PathConfig(web_cache_path=base_path)
+            dtm = OpenDTM(pathconfig=pathconfig, verbose=False)
+            sector = (640, 5600)
+            content = b"DTM" * 100_000
+
+            zip_filename = pathconfig.web_cache_file(*sector, extension=".zip")
+            zip_filename.parent.mkdir(parents=True)
+            with zipfile.ZipFile(zip_filename, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr("E640N5600.tif", content)
+
+            # a half-written file without completion marker
+            tif_filename = pathconfig.web_cache_file(*sector)
+            tif_filename.parent.mkdir(parents=True)
+            tif_filename.write_bytes(content[:1000])
+
+            dtm.extract_sector(sector)
+
+            self.assertEqual(content, tif_filename.read_bytes())
+            self.assertTrue(Path(f"{tif_filename}.done").exists())
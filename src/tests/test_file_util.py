@@ -1,8 +1,16 @@
+import os
 import unittest
 import tempfile
 from pathlib import Path
+from unittest import mock
 
-from src.files import DeleteFileOnException
+import mercantile
+import numpy as np
+
+from src.files import DeleteFileOnException, PathConfig
+from src.journal import ReprojectJournal
+from src.reproject import _journal_done
+from src.writer import TileWriter
 
 
 class TestFileUtil(unittest.TestCase):
@@ -32,3 +40,23 @@ class TestFileUtil(unittest.TestCase):
                         raise KeyboardInterrupt()
 
             self.assertFalse(fn.exists())
+
+    def test_200_sync_cache_tiles(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            pathconfig = PathConfig(tile_cache_path=Path(base_path) / "cache")
+            journal = ReprojectJournal(pathconfig.tile_cache_path() / "10" / "journal.jsonl")
+            block = mercantile.Tile(1, 2, 10)
+            calls = []
+            with mock.patch("src.files.os.fsync", wraps=os.fsync) as fsync, \
+                    mock.patch("src.files.os.sync", side_effect=lambda: calls.append("sync")), \
+                    mock.patch.object(journal, "done", side_effect=lambda *args: calls.append("done")):
+                with TileWriter(workers=2) as writer:
+                    for y in range(4):
+                        writer.save_tile_cache_file(pathconfig, 10, 1, y, np.ones((4, 4), dtype=np.float32))
+                    # the tiles are not synced one by one
+                    _journal_done({10: journal}, 4, (640, 5600), block, writer)
+                    writer.flush()
+                    self.assertEqual(0, fsync.call_count)
+                    # but all at once before the block is marked done
+                    self.assertEqual(["sync", "done"], calls)
+            np.testing.assert_equal(np.ones((4, 4)), pathconfig.load_tile_cache_file(10, 1, 2))
@@ -0,0 +1,47 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+import mercantile
+
+from src.journal import ReprojectJournal
+
+
+class TestReprojectJournal(unittest.TestCase):
+
+    def test_100_done_and_reload(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            filename = Path(base_path) / "17" / "journal.jsonl"
+            sector = (640, 5600)
+            block = mercantile.Tile(8716, 5487, 14)
+
+            journal = ReprojectJournal(filename)
+            self.assertFalse(journal.is_done(17, 256, sector, block))
+            journal.begin(17, 256, sector, block)
+            journal.done(17, 256, sector, block)
+            self.assertTrue(journal.is_done(17, 256, sector, block))
+
+            journal = ReprojectJournal(filename)
+            self.assertEqual(0, journal.num_interrupted)
+            self.assertTrue(journal.is_done(17, 256, sector, block))
+            # the sub-blocks are done as well
+            self.assertTrue(journal.is_done(17, 256, sector, mercantile.children(block)[0]))
+            # but not other resolutions, sectors or blocks
+            self.assertFalse(journal.is_done(17, 128, sector, block))
+            self.assertFalse(journal.is_done(17, 256, (680, 5600), block))
+            self.assertFalse(journal.is_done(17, 256, sector, mercantile.parent(block)))
+
+    def test_200_interrupted(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            filename = Path(base_path) / "journal.jsonl"
+            sector = (640, 5600)
+            block = mercantile.Tile(8716, 5487, 14)
+
+            journal = ReprojectJournal(filename)
+            journal.begin(17, 256, sector, block)
+            with filename.open("a") as fp:
+                fp.write('{"event": "do')
+
+            journal = ReprojectJournal(filename)
+            self.assertEqual(1, journal.num_interrupted)
+            self.assertFalse(journal.is_done(17, 256, sector, block))
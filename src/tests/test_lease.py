@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from src.benchmark import make_synthetic_sector
+from src.files import PathConfig
+from src.lease import LeaseManager, lease_status
+from src.rendertiles import command_render
+from src.reproject import command_reproject
+
+
+def _process_units(lease_dir: str, result_dir: str, node_id: str, units: list):
+    def _func(unit: str) -> dict:
+        # fails if another node did the same unit
+        fd = os.open(Path(result_dir) / unit, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(fd, node_id.encode())
+        os.close(fd)
+        time.sleep(.005)
+        return {"tiles": 2}
+
+    with LeaseManager(lease_dir, "job", node_id=node_id, ttl=5) as lease:
+        lease.process(units, _func, workers=2)
+
+
+def _reproject_node(pathconfig: PathConfig, sectors: list, lease_dir: str, node_id: str):
+    command_reproject(
+        pathconfig, sectors=sectors, zoom=[11, 9], resolution=32, reset=False, verbose=False,
+        lease_dir=lease_dir, node_id=node_id, lease_ttl=2,
+    )
+
+
+class TestLease(unittest.TestCase):
+
+    def test_100_nodes_share_units(self):
+        units = [f"unit-{i}" for i in range(60)]
+        with tempfile.TemporaryDirectory() as path:
+            lease_dir, result_dir = Path(path) / "leases", Path(path) / "results"
+            os.makedirs(result_dir)
+            context = multiprocessing.get_context("fork")
+            processes = [
+                context.Process(target=_process_units, args=(lease_dir, result_dir, f"node-{i}", units))
+                for i in range(3)
+            ]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                self.assertEqual(0, p.exitcode)
+
+            self.assertEqual(set(units), set(os.listdir(result_dir)))
+            status = lease_status(lease_dir)
+            job = status["jobs"]["job"]
+            self.assertEqual(60, job["done"])
+            self.assertEqual(0, job["leased"])
+            self.assertEqual(120, job["stats"]["tiles"])
+            self.assertEqual(3, len(status["nodes"]))
+            self.assertEqual(60, sum(n["units_done"] for n in status["nodes"].values()))
+
+    def test_200_take_over_expired_lease(self):
+        with tempfile.TemporaryDirectory() as path:
+            dead = LeaseManager(path, "job", node_id="dead", ttl=1)
+            self.assertTrue(dead.try_acquire("a"))
+            self.assertTrue(dead.try_acquire("b"))
+
+            lease = LeaseManager(path, "job", node_id="alive", ttl=1, poll_interval=.05)
+            self.assertFalse(lease.try_acquire("a"))
+            # the dead node stopped its heartbeat a while ago
+            os.utime(dead.lease_filename("a"), (time.time() - 2, time.time() - 2))
+
+            processed = []
+            with lease:
+                lease.process(["a", "b", "c"], lambda unit: processed.append(unit), wait=False)
+            self.assertEqual(["a", "c"], processed)
+            self.assertEqual(1, lease.num_taken_over)
+            self.assertFalse(lease.is_done("b"))
+            self.assertEqual(1, lease_status(path, ttl=1)["jobs"]["job"]["leased"])
+
+    def test_250_lost_lease(self):
+        with tempfile.TemporaryDirectory() as path:
+            stalled = LeaseManager(path, "job", node_id="stalled", ttl=1)
+            alive = LeaseManager(path, "job", node_id="alive", ttl=1)
+            for unit in ("a", "b", "c"):
+                self.assertTrue(stalled.try_acquire(unit))
+            for unit in ("a", "c"):
+                os.utime(stalled.lease_filename(unit), (time.time() - 2, time.time() - 2))
+                self.assertTrue(alive.try_acquire(unit))
+                os.utime(alive.lease_filename(unit), (100, 100))
+            os.utime(stalled.lease_filename("b"), (100, 100))
+
+            # the stalled node wakes up and does not touch the leases of the other node
+            self.assertFalse(stalled.complete("a"))
+            self.assertFalse(stalled.is_done("a"))
+            stalled.release("a")
+            stalled.touch_leases()
+            self.assertEqual(2, stalled.num_lost)
+            self.assertEqual(0, stalled.num_done)
+            for unit in ("a", "c"):
+                self.assertEqual(100, os.stat(alive.lease_filename(unit)).st_mtime)
+            self.assertGreater(os.stat(stalled.lease_filename("b")).st_mtime, 100)
+
+            self.assertTrue(alive.complete("a"))
+            self.assertTrue(stalled.complete("b"))
+            self.assertTrue(alive.is_done("a"))
+            self.assertTrue(alive.lease_filename("c").exists())
+
+    def test_300_distributed_reproject(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600), (640, 5640)]
+            single_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "single")
+            shared_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "shared")
+            for sector in sectors:
+                make_synthetic_sector(single_config.web_cache_file(*sector), sector, 200)
+            command_reproject(single_config, sectors=sectors, zoom=[11, 9], resolution=32, reset=True, verbose=False)
+
+            context = multiprocessing.get_context("fork")
+            processes = [
+                context.Process(target=_reproject_node, args=(shared_config, sectors, path / "leases", f"node-{i}"))
+                for i in range(3)
+            ]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                self.assertEqual(0, p.exitcode)
+
+            for z in (11, 9):
+                tiles = single_config.tile_cache_file_map(z)
+                self.assertEqual(set(tiles), set(shared_config.tile_cache_file_map(z)))
+                for x, y in tiles:
+                    np.testing.assert_equal(
+                        single_config.load_tile_cache_file(z, x, y),
+                        shared_config.load_tile_cache_file(z, x, y),
+                    )
+            job = lease_status(path / "leases")["jobs"]["reproject-z11-r32"]
+            self.assertEqual(0, job["leased"])
+            self.assertGreater(job["stats"]["tiles"], 0)
+
+    def test_400_second_run(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600), (640, 5640)]
+            single_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "single")
+            for sector in sectors:
+                make_synthetic_sector(single_config.web_cache_file(*sector), sector, 200)
+            command_reproject(single_config, sectors=sectors, zoom=[11, 9], resolution=32, reset=True, verbose=False)
+            columns = sorted(set(x for x, y in single_config.tile_cache_file_map(11)))
+
+            # a ranged run followed by a full run with the same lease directory
+            kwargs = dict(web_cache_path=path / "web", tile_cache_path=path / "shared")
+            for pathconfig in (
+                    PathConfig(**kwargs, tile_x=(columns[0], columns[len(columns) // 2])),
+                    PathConfig(**kwargs),
+            ):
+                command_reproject(
+                    pathconfig, sectors=sectors, zoom=[11, 9], resolution=32, reset=False, verbose=False,
+                    lease_dir=path / "leases",
+                )
+            for z in (11, 9):
+                self.assertEqual(set(single_config.tile_cache_file_map(z)), set(pathconfig.tile_cache_file_map(z)))
+
+            # a second render only renders again with lease_reset
+            pathconfig = PathConfig(**kwargs, tile_output_path=path / "tiles")
+            for lease_reset in (False, False, True):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    command_render(
+                        pathconfig=pathconfig, modality="normal", cache_zoom=11, tile_zoom=11, resolution=None,
+                        edge_cache_size=10, tile_cache_size=10, approximate=False, workers=2, overwrite=True,
+                        verbose=False, lease_dir=path / "leases", lease_reset=lease_reset,
+                    )
+                num_files = len(list((path / "tiles").rglob("*.png")))
+                if lease_reset:
+                    self.assertEqual(len(single_config.tile_cache_file_map(11)), num_files)
+                    self.assertFalse(caught)
+                elif num_files:
+                    # the first run, the second is skipped with a warning
+                    shutil.rmtree(path / "tiles")
+                else:
+                    self.assertIn("--lease-reset", str(caught[0].message))
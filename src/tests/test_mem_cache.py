@@ -1,5 +1,7 @@
 import unittest
 
+import numpy as np
+
 from src.files import MemoryCache
 
 
@@ -52,3 +54,17 @@ class TestMemoryCache(unittest.TestCase):
         self.assertIsNotNone(cache.get(5))
         self.assertEqual(9, cache.num_hits)
         self.assertEqual(3, cache.num_misses)
+
+    def test_300_max_bytes(self):
+        cache = MemoryCache(max_items=100, max_bytes=3000)
+        for i in range(5):
+            cache.put(i, np.zeros(1000, dtype=np.uint8))
+        self.assertEqual(3000, cache.num_bytes)
+        self.assertFalse(cache.has(1))
+        self.assertTrue(cache.has(2))
+
+        cache.put(2, np.zeros(2000, dtype=np.uint8))
+        self.assertEqual(3000, cache.num_bytes)
+        self.assertFalse(cache.has(3))
+        self.assertTrue(cache.has(4))
+        self.assertTrue(cache.has(2))
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+from src.modalities import derive_from_normals, encode_heights, decode_heights
+from src.normalmap import heights_to_normals
+
+
+class TestModalities(unittest.TestCase):
+
+    def test_100_slope_and_aspect(self):
+        yy, xx = np.mgrid[:10, :10].astype(np.float32)
+        pixel_size = 2.
+        # rising to the east by 1m per meter, so facing west
+        normals = heights_to_normals(xx * pixel_size)
+        self.assertAlmostEqual(45, derive_from_normals(normals, "slope", pixel_size)[3, 3], places=4)
+        self.assertAlmostEqual(270, derive_from_normals(normals, "aspect", pixel_size)[3, 3], places=4)
+        # array rows go south, so this rises to the north and faces south
+        normals = heights_to_normals(-yy * pixel_size * .5)
+        self.assertAlmostEqual(180, derive_from_normals(normals, "aspect", pixel_size)[3, 3], places=4)
+
+    def test_200_hillshade(self):
+        flat = heights_to_normals(np.zeros((10, 10)))
+        shade = derive_from_normals(flat, "hillshade", 1., azimuth=315, altitude=30)
+        np.testing.assert_allclose(.5, shade, rtol=1e-5)
+
+        # a slope facing the light is brighter than flat land, the opposite one is darker
+        xx = np.mgrid[:10, :10][1].astype(np.float32)
+        facing_west = derive_from_normals(heights_to_normals(xx), "hillshade", 1., azimuth=270)
+        facing_east = derive_from_normals(heights_to_normals(-xx), "hillshade", 1., azimuth=270)
+        self.assertGreater(facing_west.mean(), derive_from_normals(flat, "hillshade", 1., azimuth=270).mean())
+        self.assertLess(facing_east.mean(), derive_from_normals(flat, "hillshade", 1., azimuth=270).mean())
+
+    def test_300_encoded_heights(self):
+        heights = np.random.uniform(-100, 3000, (64, 64)).astype(np.float32)
+        heights[:3, :5] = np.nan
+        for modality, precision in (("terrain-rgb", .05), ("terrarium", 1 / 256)):
+            rgba = encode_heights(heights, modality)
+            self.assertEqual(np.uint8, rgba.dtype)
+            self.assertTrue((rgba[:3, :5, 3] == 0).all())
+            self.assertTrue((rgba[3:, :, 3] == 255).all())
+
+            decoded = decode_heights(rgba, modality)
+            self.assertTrue(np.isnan(decoded[:3, :5]).all())
+            valid = ~np.isnan(heights)
+            self.assertLessEqual(np.abs(decoded[valid] - heights[valid]).max(), precision + 1e-3)
+
+        # the reference values of the specifications
+        np.testing.assert_equal([1, 134, 160, 255], encode_heights(np.zeros((1, 1)), "terrain-rgb")[0, 0])
+        np.testing.assert_equal([128, 0, 0, 255], encode_heights(np.zeros((1, 1)), "terrarium")[0, 0])
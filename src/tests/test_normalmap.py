@@ -28,6 +28,11 @@ class MockPathConfig(PathConfig):
             if mod == modality and z == zoom
         }
 
+    def iter_tile_cache_files(self, zoom: int, modality: str = "height", column_filter=None):
+        for (x, y), filename in sorted(self.tile_cache_file_map(zoom, modality).items()):
+            if column_filter is None or column_filter(x):
+                yield (x, y), filename
+
     def tile_output_file_map(self, zoom: int, modality: str = "height"):
         return {
             (x, y): Path(f"{modality}/{z}/{y}/{x}.npz")
@@ -112,3 +117,45 @@ class TestNormalMapping(unittest.TestCase):
             ],
             pathconfig.statements,
         )
+
+    def test_200_render_modalities_and_zooms_from_one_read(self):
+        res = 32
+        rng = np.random.default_rng(39)
+        heights = {
+            (1000 + x, 1000 + y): rng.uniform(0, 500, (res, res)).astype(np.float32)
+            for x in range(3) for y in range(3)
+        }
+        pathconfig, normal_pathconfig = MockPathConfig(), MockPathConfig()
+        for (x, y), tile in heights.items():
+            pathconfig.save_tile_cache_file(16, x, y, tile)
+            normal_pathconfig.save_tile_cache_file(16, x, y, tile)
+        pathconfig.statements.clear()
+
+        for config, modality in ((pathconfig, ["normal", "height"]), (normal_pathconfig, ["normal"])):
+            command_render(
+                pathconfig=config,
+                modality=modality,
+                cache_zoom=16,
+                tile_zoom=[16, 17],
+                resolution=None,
+                edge_cache_size=1000,
+                tile_cache_size=1000,
+                approximate=False,
+                overwrite=True,
+                workers=1,
+                verbose=False,
+            )
+        # rendering the heights does not change the cached tiles the normals are calculated from
+        for (x, y), tile in heights.items():
+            np.testing.assert_equal(tile, pathconfig._mock_cache[("height", 16, x, y)])
+        normal_tiles = {key: tile for key, tile in normal_pathconfig._mock_tiles.items()}
+        self.assertEqual(9 + 9 * 4, len(normal_tiles))
+        for key, tile in normal_tiles.items():
+            np.testing.assert_equal(tile, pathconfig._mock_tiles[key])
+
+        loads = [kwargs for s, kwargs in pathconfig.statements if s == "load_tile_cache_file"]
+        saves = [kwargs for s, kwargs in pathconfig.statements if s == "save_output_tile"]
+        self.assertEqual(9, len(loads))
+        # 2 modalities, 9 tiles at zoom 16 and 9 * 4 at zoom 17
+        self.assertEqual(2 * (9 + 9 * 4), len(saves))
+        self.assertIn({"z": 17, "x": 2005, "y": 2005, "array": (16, 16, 4), "modality": "height"}, saves)
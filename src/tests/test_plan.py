@@ -0,0 +1,69 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import mercantile
+import rasterio.warp
+
+from src.files import PathConfig
+from src.plan import count_tiles, make_plan, load_calibration
+from src.reproject import src_crs, crs_4326
+
+
+class TestPlan(unittest.TestCase):
+
+    def test_100_count_tiles(self):
+        rects = [(0, 0, 3, 3), (2, 2, 5, 4), (10, 0, 10, 0), (1, 1, 2, 2)]
+        tiles = set(
+            (x, y)
+            for x0, y0, x1, y1 in rects
+            for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+        )
+        self.assertEqual(len(tiles), count_tiles(rects))
+        self.assertEqual(0, count_tiles([]))
+
+    def test_200_plan(self):
+        sectors = [(640, 5600), (680, 5600), (640, 5640), (680, 5640)]
+        tiles = set()
+        for s in sectors:
+            bounds = rasterio.warp.transform_bounds(
+                src_crs, crs_4326, s[0] * 1000, s[1] * 1000, (s[0] + 40) * 1000, (s[1] + 40) * 1000,
+            )
+            tiles |= set(mercantile.tiles(*bounds, zooms=13))
+
+        with tempfile.TemporaryDirectory() as path:
+            filename = Path(path) / "benchmark.json"
+            filename.write_text(json.dumps({
+                "meta": {"resolution": 128},
+                "stages": {
+                    "reproject": {"seconds": 10, "tiles": 100, "timings": {
+                        "tiff_read": {"seconds": 4, "bytes": 4_000_000, "count": 100},
+                        "write": {"seconds": 1, "bytes": 5_000_000, "count": 100},
+                    }},
+                    "render": {"seconds": 5, "tiles": 100, "timings": {
+                        "write": {"seconds": 1, "bytes": 2_000_000, "count": 100},
+                    }},
+                },
+            }))
+            calibration = load_calibration([str(filename)])
+            self.assertAlmostEqual(.06, calibration["reproject"]["seconds_per_tile"])
+
+            plan = make_plan(
+                PathConfig(web_cache_path=Path(path) / "web"), sectors,
+                zoom=[13], resolution=256, modality=["normal", "hillshade"], downsample_zoom=11,
+                workers=4, calibration=calibration,
+            )
+        self.assertEqual(len(tiles), plan["tiles_per_zoom"][13])
+        stages = plan["stages"]
+        self.assertEqual(len(tiles), stages["reproject"]["tiles"])
+        self.assertEqual(len(tiles) * 2, stages["render"]["tiles"])
+        self.assertEqual(
+            2 * sum(len(set(mercantile.parent(t, zoom=z) for t in tiles)) for z in (11, 12)),
+            stages["downsample"]["tiles"],
+        )
+        # 4 times the pixels of the calibration run
+        self.assertAlmostEqual(len(tiles) * 5e4 * 4, stages["reproject"]["cache_bytes"])
+        self.assertAlmostEqual(len(tiles) * 2 * .05 * 4 / 3600, stages["render"]["cpu_hours"])
+        self.assertAlmostEqual(stages["render"]["cpu_hours"] / 4, stages["render"]["wall_hours"])
+        self.assertIsNone(stages["downsample"]["cpu_hours"])
@@ -0,0 +1,32 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import PIL.Image
+
+from src.pngwriter import PNGStreamWriter
+
+
+class TestPNGStreamWriter(unittest.TestCase):
+
+    def test_100_write_bands(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            for channels in (1, 2, 3, 4):
+                filename = Path(base_path) / f"image-{channels}.png"
+                image = np.random.randint(0, 256, (50, 30, channels), dtype=np.uint8)
+
+                with PNGStreamWriter(filename, width=30, height=50, channels=channels, chunk_size=100) as writer:
+                    for y in range(0, 50, 7):
+                        writer.write_rows(image[y: y + 7])
+
+                loaded = np.array(PIL.Image.open(filename))
+                if loaded.ndim == 2:
+                    loaded = loaded[..., None]
+                np.testing.assert_equal(image, loaded)
+
+    def test_200_incomplete(self):
+        with tempfile.TemporaryDirectory("opendtm-unittest") as base_path:
+            with self.assertRaises(ValueError):
+                with PNGStreamWriter(Path(base_path) / "image.png", width=10, height=10) as writer:
+                    writer.write_rows(np.zeros((5, 10, 4)))
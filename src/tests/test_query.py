@@ -0,0 +1,89 @@
+import csv
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from src.benchmark import make_synthetic_sector
+from src.files import PathConfig
+from src.opendtm import OpenDTM
+from src.query import CacheHeightQuery, SectorHeightQuery, MERCATOR_ORIGIN, transform_points, command_query
+from src.timing import timings
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_100_cache_query(self):
+        zoom, resolution = 10, 16
+        with tempfile.TemporaryDirectory() as path:
+            pathconfig = PathConfig(tile_cache_path=Path(path) / "cache")
+            # a plane over the global pixel coordinates, which bilinear interpolation reproduces exactly
+            for x in range(500, 503):
+                for y in range(300, 303):
+                    gy, gx = np.mgrid[:resolution, :resolution].astype(np.float32)
+                    tile = (gx + x * resolution) * .5 + (gy + y * resolution) * 2
+                    pathconfig.save_tile_cache_file(zoom, x, y, tile.astype(np.float32))
+
+            rng = np.random.Generator(np.random.PCG64(23))
+            gx = rng.uniform(500 * resolution, 503 * resolution - 1, 10_000)
+            gy = rng.uniform(300 * resolution, 303 * resolution - 1, 10_000)
+            num_pixels = resolution * (1 << zoom)
+            mx = (gx + .5) / num_pixels * 2 * MERCATOR_ORIGIN - MERCATOR_ORIGIN
+            my = MERCATOR_ORIGIN - (gy + .5) / num_pixels * 2 * MERCATOR_ORIGIN
+
+            query = CacheHeightQuery(pathconfig, zoom)
+            timings.reset()
+            heights = query.query(mx, my, crs="EPSG:3857")
+            np.testing.assert_allclose(gx * .5 + gy * 2, heights, rtol=1e-5)
+            # each tile is decoded once
+            self.assertEqual(9, timings.snapshot()["npz_decode"]["count"])
+
+            lon, lat = transform_points(mx, my, "EPSG:3857", "EPSG:4326")
+            np.testing.assert_allclose(heights, query.query(lon, lat), rtol=1e-4)
+
+            self.assertTrue(np.isnan(query.query([0.], [0.])).all())
+
+    def test_200_sector_query(self):
+        with tempfile.TemporaryDirectory() as path:
+            pathconfig = PathConfig(web_cache_path=Path(path) / "web")
+            sector = (640, 5600)
+            make_synthetic_sector(pathconfig.web_cache_file(*sector), sector, 400)
+            with rasterio.open(pathconfig.web_cache_file(*sector)) as ds:
+                data = ds.read(1)
+            data[data == -32768] = np.nan
+
+            query = SectorHeightQuery(OpenDTM(pathconfig=pathconfig, verbose=False), block_size=64)
+            # pixel centers and the middle between 4 pixels, 100 meters per pixel
+            rows, cols = np.mgrid[1:399:7, 1:399:5]
+            e = sector[0] * 1000 + cols.ravel() * 100. + 50
+            n = (sector[1] + 40) * 1000 - rows.ravel() * 100. - 50
+            np.testing.assert_allclose(data[rows.ravel(), cols.ravel()], query.query(e, n, crs="EPSG:25832"), rtol=1e-5)
+
+            expected = np.nanmean(np.stack([
+                data[rows.ravel() + dy, cols.ravel() + dx] for dy in (0, 1) for dx in (0, 1)
+            ]), axis=0)
+            np.testing.assert_allclose(expected, query.query(e + 50, n - 50, crs="EPSG:25832"), rtol=1e-5)
+            query.close()
+
+    def test_300_step_in_meters(self):
+        # 1000 m to the north at 51° latitude, which is about 1590 web-mercator units
+        lon, lat = transform_points([680_000, 680_000], [5_650_000, 5_651_000], "EPSG:25832", "EPSG:4326")
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            (path / "line.csv").write_text("lon,lat\n" + "".join(f"{a},{b}\n" for a, b in zip(lon, lat)))
+            command_query(
+                PathConfig(tile_cache_path=path / "cache"), source="cache", zoom=10,
+                input=str(path / "line.csv"), output=str(path / "profile.csv"), crs="4326",
+                columns=["lon", "lat"], step=10., tile_cache_size=10, verbose=False,
+            )
+            with (path / "profile.csv").open() as fp:
+                rows = list(csv.DictReader(fp))
+
+        self.assertEqual(101, len(rows))
+        self.assertAlmostEqual(1000., float(rows[-1]["distance"]), places=1)
+        e, n = transform_points(
+            [float(r["lon"]) for r in rows], [float(r["lat"]) for r in rows], "EPSG:4326", "EPSG:25832",
+        )
+        np.testing.assert_allclose(10., np.hypot(np.diff(e), np.diff(n)), atol=.01)
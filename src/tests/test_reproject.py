@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from src.benchmark import make_synthetic_sector
+from src.files import PathConfig
+from src.reproject import command_reproject
+
+
+class TestReproject(unittest.TestCase):
+
+    def test_100_metatiles_match_sector_tiles(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600)]
+            results = []
+            for metatile in (0, 4):
+                pathconfig = PathConfig(
+                    web_cache_path=path / "web",
+                    tile_cache_path=path / f"cache-{metatile}",
+                )
+                for sector in sectors:
+                    make_synthetic_sector(pathconfig.web_cache_file(*sector), sector, 800)
+                command_reproject(
+                    pathconfig, sectors=sectors, zoom=[11, 9], resolution=32,
+                    reset=True, verbose=False, metatile=metatile,
+                )
+                results.append({
+                    (z, *t): pathconfig.load_tile_cache_file(z, *t)
+                    for z in (11, 9)
+                    for t in pathconfig.tile_cache_file_map(z)
+                })
+
+            self.assertEqual(set(results[0]), set(results[1]))
+            diff = np.concatenate([
+                np.abs(results[0][key] - results[1][key]).flatten() for key in results[0]
+            ])
+            self.assertLess(np.nanmean(diff), 5)
+
+    def test_200_sector_without_nodata_tag(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sector = (640, 5600)
+            results = []
+            for tagged in (True, False):
+                pathconfig = PathConfig(web_cache_path=path / f"web-{tagged}", tile_cache_path=path / f"cache-{tagged}")
+                filename = pathconfig.web_cache_file(*sector)
+                make_synthetic_sector(filename, sector, 2000)
+                with rasterio.open(filename) as ds:
+                    profile, heights = ds.profile, ds.read(1)
+                heights[:, :1000] = -32768
+                if not tagged:
+                    profile.pop("nodata")
+                with rasterio.open(filename, "w", **profile) as ds:
+                    ds.write(heights, 1)
+                # decimated reads average the source pixels
+                command_reproject(pathconfig, sectors=[sector], zoom=[10], resolution=64, reset=True, verbose=False)
+                results.append({t: pathconfig.load_tile_cache_file(10, *t) for t in pathconfig.tile_cache_file_map(10)})
+
+            self.assertEqual(set(results[0]), set(results[1]))
+            for key, tile in results[1].items():
+                self.assertGreater(np.nanmin(tile), -1000)
+                np.testing.assert_allclose(results[0][key], tile, rtol=1e-5)
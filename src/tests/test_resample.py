@@ -0,0 +1,66 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from src.resample import reduce_2x2, reduce_by, resize_area, resize, resize_angles, warp_perspective
+
+
+class TestResample(unittest.TestCase):
+
+    def test_100_reduce_2x2(self):
+        array = np.array([
+            [1, 3, np.nan, np.nan],
+            [5, 7, np.nan, 4],
+        ], dtype=np.float32)
+        np.testing.assert_equal(
+            np.array([[4, 4]], dtype=np.float32),
+            reduce_2x2(array),
+        )
+        array[1, 3] = np.nan
+        self.assertTrue(np.isnan(reduce_2x2(array)[0, 1]))
+
+    def test_200_reduce_by_odd_size(self):
+        array = np.ones((5, 7), dtype=np.float32)
+        reduced = reduce_by(array, 4)
+        self.assertEqual((2, 2), reduced.shape)
+        np.testing.assert_equal(np.ones((2, 2)), reduced)
+
+    def test_300_resize_area(self):
+        array = np.full((30, 30), 10, dtype=np.float32)
+        array[:, :15] = np.nan
+        resized = resize_area(array, (10, 10))
+        self.assertTrue(np.all(np.isnan(resized[:, :5])))
+        np.testing.assert_allclose(resized[:, 5:], 10)
+
+    def test_400_resize_does_not_spread_nan(self):
+        array = np.full((64, 64), 10, dtype=np.float32)
+        array[:, :32] = np.nan
+        resized = resize(array, (24, 24))
+        self.assertTrue(np.all(np.isnan(resized[:, :11])))
+        np.testing.assert_allclose(resized[:, 13:], 10)
+
+        enlarged = resize(array[:8, 28:36], (32, 32))
+        self.assertTrue(np.all(np.isnan(enlarged[:, :14])))
+        np.testing.assert_allclose(enlarged[:, 18:], 10)
+
+    def test_450_resize_angles(self):
+        # north-facing slopes alternate between 359° and 1°
+        array = np.tile(np.array([[359, 1], [1, 359]], dtype=np.float32), (16, 16))
+        array[:, :8] = np.nan
+        for interpolation in (None, cv2.INTER_CUBIC, cv2.INTER_NEAREST):
+            resized = resize_angles(array, (8, 8), interpolation=interpolation)
+            self.assertEqual(np.float32, resized.dtype)
+            valid = resized[:, 3:]
+            # close to north, not 180°
+            np.testing.assert_array_less(np.minimum(valid, 360 - valid), 1.001)
+        self.assertTrue(np.all(np.isnan(resize_angles(array, (8, 8))[:, :2])))
+
+    def test_500_warp_perspective(self):
+        array = np.full((16, 16), 10, dtype=np.float32)
+        array[4, 4] = np.nan
+        shift = np.float32([[1, 0, .5], [0, 1, .5], [0, 0, 1]])
+        warped = warp_perspective(array, shift, (16, 16))
+        # bilinear cv2.warpPerspective would turn the 4 neighbours into NaN
+        self.assertEqual(0, np.isnan(warped[1:, 1:]).sum())
+        np.testing.assert_allclose(warped[1:, 1:], 10, rtol=1e-6)
@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.benchmark import make_synthetic_sector
+from src.edges import EdgeStore
+from src.files import PathConfig
+from src.reproject import command_reproject
+from src.schedule import SectorCosts, lpt_schedule
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_100_lpt_schedule(self):
+        costs = {(0, 0): 2, (0, 1): 7, (1, 0): 3, (1, 1): 5, (2, 0): 4}
+        order, makespan = lpt_schedule(costs, 2)
+        self.assertEqual([(0, 1), (1, 1), (2, 0), (1, 0), (0, 0)], order)
+        # 7 + 3 | 5 + 4 + 2
+        self.assertEqual(11, makespan)
+        self.assertEqual(21, lpt_schedule(costs, 1)[1])
+        self.assertEqual(7, lpt_schedule(costs, 8)[1])
+
+    def test_200_parallel_reproject(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600), (640, 5640), (680, 5640)]
+            serial_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "serial")
+            parallel_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "parallel")
+            for sector in sectors:
+                make_synthetic_sector(serial_config.web_cache_file(*sector), sector, 200)
+
+            command_reproject(serial_config, sectors=sectors, zoom=[10, 9], resolution=32, reset=True, verbose=False)
+            command_reproject(
+                parallel_config, sectors=sectors, zoom=[10, 9], resolution=32, reset=True, verbose=False, workers=4,
+            )
+            for z in (10, 9):
+                tiles = serial_config.tile_cache_file_map(z)
+                self.assertEqual(set(tiles), set(parallel_config.tile_cache_file_map(z)))
+                num_pixels = num_equal = 0
+                edge_store = EdgeStore(parallel_config, z)
+                for x, y in tiles:
+                    serial = serial_config.load_tile_cache_file(z, x, y)
+                    parallel = parallel_config.load_tile_cache_file(z, x, y)
+                    np.testing.assert_equal(np.isnan(serial), np.isnan(parallel))
+                    # the edges are stored under the same lock as the tile
+                    np.testing.assert_equal(parallel[0], edge_store.get_edge(x, y, "bottom")[0])
+                    num_pixels += (~np.isnan(serial)).sum()
+                    num_equal += (serial == parallel).sum()
+                # the sectors overlap by a few pixels, where the last merged one wins
+                self.assertGreater(num_equal / num_pixels, .97)
+
+            sector_costs = SectorCosts(serial_config)
+            self.assertTrue(sector_costs.seconds_per_cost("reproject-z10-r32")[1])
+            costs = sector_costs.estimate(None, sectors)
+            self.assertEqual(set(sectors), set(costs))
+            for sector in sectors:
+                self.assertGreater(costs[sector], 0)
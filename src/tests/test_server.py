@@ -0,0 +1,62 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.files import PathConfig
+from src.loadtest import _run_requests
+from src.server import TileServer
+
+
+class TestTileServer(unittest.TestCase):
+
+    def test_100_serve_tiles(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            pathconfig = PathConfig(tile_cache_path=path / "cache", tile_output_path=path / "tiles")
+            rng = np.random.default_rng(29)
+            for x in range(2000, 2003):
+                for y in range(1000, 1003):
+                    pathconfig.save_tile_cache_file(12, x, y, rng.uniform(0, 100, (16, 16)).astype(np.float32))
+
+            server = TileServer(
+                pathconfig=pathconfig, cache_zoom=12, resolution=16, workers=1, response_cache_size=100,
+                edge_cache_size=100, tile_cache_size=10, approximate=False, write_back=True, verbose=False,
+            )
+
+            async def _test():
+                # concurrent requests for one tile render it once
+                tiles = await asyncio.gather(*(server.get_tile("normal", 12, 2001, 1001) for _ in range(8)))
+                self.assertEqual(1, server.num_rendered)
+                self.assertEqual(0, server.response_cache.num_hits)
+                self.assertEqual(1, len(set(tiles)))
+                self.assertTrue(tiles[0].startswith(b"\x89PNG"))
+                # later requests come from the response cache
+                self.assertEqual(tiles[0], await server.get_tile("normal", 12, 2001, 1001))
+                self.assertEqual(1, server.response_cache.num_hits)
+
+                tcp_server = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+                port = tcp_server.sockets[0].getsockname()[1]
+                async with tcp_server:
+                    results = await _run_requests("127.0.0.1", port, [
+                        "/normal/12/2001/1001.png",
+                        "/height/12/2000/1002.png",
+                        # outside the cache, unknown modality, wrong extension
+                        "/normal/12/3000/1001.png",
+                        "/nothing/12/2001/1001.png",
+                        "/normal/12/2001/1001.webp",
+                    ], concurrency=1)
+                return [status for status, _, _ in results]
+
+            try:
+                statuses = asyncio.run(_test())
+            finally:
+                server.close()
+
+            self.assertEqual([200, 200, 404, 404, 404], statuses)
+            # the rendered tiles are written back to the output path
+            self.assertTrue(pathconfig.tile_output_exists(12, 2001, 1001, modality="normal"))
+            self.assertTrue(pathconfig.tile_output_exists(12, 2000, 1002, modality="height"))
+            self.assertEqual(3, server.num_rendered)
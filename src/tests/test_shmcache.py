@@ -0,0 +1,73 @@
+import multiprocessing
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.files import PathConfig
+from src.rendertiles import command_render
+from src.shmcache import SharedTileCache
+
+
+def _put_tiles(cache: SharedTileCache, start: int):
+    for i in range(start, start + 8):
+        cache.put_tile(i, 0, np.full((4, 4), i, dtype=np.float32))
+
+
+class TestSharedTileCache(unittest.TestCase):
+
+    def test_100_put_get(self):
+        cache = SharedTileCache(4, max_tiles=16, ways=4)
+        try:
+            self.assertIsNone(cache.get_tile(1, 2))
+            tile = np.arange(16, dtype=np.float32).reshape(4, 4)
+            cache.put_tile(1, 2, tile)
+            cache.put_tile(2, 2, None)
+            np.testing.assert_equal(tile, cache.get_tile(1, 2))
+            self.assertIs(False, cache.get_tile(2, 2))
+            np.testing.assert_equal(tile[:, :1], cache.get_edge(1, 2, "left"))
+            np.testing.assert_equal(tile[-1:], cache.get_edge(1, 2, "top"))
+            self.assertIsNone(cache.get_edge(2, 2, "left"))
+
+            # filled by another process
+            process = multiprocessing.get_context("fork").Process(target=_put_tiles, args=(cache, 100))
+            process.start()
+            process.join()
+            for i in range(100, 108):
+                found = cache.get_tile(i, 0)
+                if found is not None:
+                    self.assertEqual(i, found[0, 0])
+
+            # the oldest tiles are evicted, never more than fit
+            for i in range(200):
+                cache.put_tile(i, 1000, tile)
+            num_cached = sum(cache.get_tile(i, 1000) is not None for i in range(200))
+            self.assertLessEqual(num_cached, 16)
+            self.assertGreater(num_cached, 0)
+            self.assertIsNotNone(cache.get_tile(199, 1000))
+        finally:
+            cache.close()
+
+    def test_200_render_processes(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            rng = np.random.default_rng(23)
+            for x in range(40):
+                for y in range(3):
+                    PathConfig(tile_cache_path=path / "cache").save_tile_cache_file(
+                        12, 2000 + x, 1000 + y, rng.uniform(0, 100, (16, 16)).astype(np.float32),
+                    )
+            for processes in (False, True):
+                pathconfig = PathConfig(tile_cache_path=path / "cache", tile_output_path=path / str(processes))
+                command_render(
+                    pathconfig=pathconfig, modality=["normal", "hillshade"], cache_zoom=12, tile_zoom=12,
+                    resolution=None, edge_cache_size=10, tile_cache_size=10, approximate=False,
+                    workers=3, overwrite=True, verbose=False,
+                    processes=processes, shared_cache_size=16,
+                )
+
+            files = sorted(p.relative_to(path / "False") for p in (path / "False").rglob("*") if p.is_file())
+            self.assertEqual(40 * 3 * 2, len(files))
+            for filename in files:
+                self.assertEqual((path / "False" / filename).read_bytes(), (path / "True" / filename).read_bytes())
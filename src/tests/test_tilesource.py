@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.benchmark import make_synthetic_sector
+from src.files import PathConfig
+from src.reproject import command_reproject
+from src.tilesource import TileSource
+
+
+class TestTileSource(unittest.TestCase):
+
+    def test_100_lazy_tiles_match_reprojection(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600)]
+            batch_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "batch")
+            lazy_config = PathConfig(web_cache_path=path / "web", tile_cache_path=path / "lazy")
+            for sector in sectors:
+                make_synthetic_sector(batch_config.web_cache_file(*sector), sector, 400)
+            command_reproject(batch_config, sectors=sectors, zoom=[11], resolution=32, reset=True, verbose=False)
+            tiles = list(batch_config.tile_cache_file_map(11))
+
+            source = TileSource(lazy_config, resolution=32)
+            for x, y in tiles:
+                lazy = source.get_height(11, x, y)
+                batch = batch_config.load_tile_cache_file(11, x, y)
+                np.testing.assert_equal(np.isnan(batch), np.isnan(lazy))
+                self.assertLess(np.nanmax(np.abs(batch - lazy)), 1e-3)
+            self.assertEqual(len(tiles), source.num_reprojected)
+            self.assertEqual(set(tiles), set(lazy_config.tile_cache_file_map(11)))
+
+            # the second time from the cache
+            source.get_height(11, *tiles[0])
+            self.assertEqual(1, source.num_loaded)
+
+            self.assertIsNone(source.get_height(11, 0, 0))
+            source.close()
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from src.benchmark import make_synthetic_sector
+from src.files import PathConfig
+from src.reproject import command_reproject
+from src.writer import TileWriter
+
+
+class TestTileWriter(unittest.TestCase):
+
+    def test_100_write_in_order(self):
+        with tempfile.TemporaryDirectory() as path:
+            pathconfig = PathConfig(tile_cache_path=Path(path))
+            written = []
+            with TileWriter(workers=3, max_queued=4) as writer:
+                for i in range(20):
+                    for x in range(5):
+                        writer.save_tile_cache_file(pathconfig, 10, x, i % 4, np.full((4, 4), i, dtype=np.float32))
+                pending = writer.pending_array(pathconfig.tile_cache_filename(10, 0, 3))
+                self.assertTrue(pending is None or pending[0, 0] == 19)
+                writer.on_written(lambda: written.append(len(list(Path(path).rglob("*.npz")))))
+                writer.flush()
+                self.assertEqual([20], written)
+                self.assertIsNone(writer.pending_array(pathconfig.tile_cache_filename(10, 0, 3)))
+
+            self.assertEqual(100, writer.num_written)
+            for x in range(5):
+                for y in range(4):
+                    # the last of the writes of each tile
+                    self.assertEqual(16 + y, pathconfig.load_tile_cache_file(10, x, y)[0, 0])
+
+    def test_200_raise_errors(self):
+        with tempfile.TemporaryDirectory() as path:
+            # a lossy format must not store heights
+            pathconfig = PathConfig(tile_output_path=Path(path), output_format="webp-lossy")
+            writer = TileWriter(workers=2)
+            writer.save_output_tile(pathconfig, 10, 0, 0, np.zeros((4, 4, 4)), modality="terrarium")
+            with self.assertRaises(ValueError):
+                writer.flush()
+            with self.assertRaises(ValueError):
+                writer.close()
+
+    def test_300_reproject(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = Path(path)
+            sectors = [(640, 5600), (680, 5600), (640, 5640)]
+            configs = {
+                write_workers: PathConfig(web_cache_path=path / "web", tile_cache_path=path / str(write_workers))
+                for write_workers in (0, 3)
+            }
+            for sector in sectors:
+                make_synthetic_sector(configs[0].web_cache_file(*sector), sector, 200)
+            for write_workers, pathconfig in configs.items():
+                command_reproject(
+                    pathconfig, sectors=sectors, zoom=[11, 9], resolution=32, reset=True, verbose=False,
+                    write_workers=write_workers,
+                )
+
+            for z in (11, 9):
+                tiles = configs[0].tile_cache_file_map(z)
+                self.assertEqual(set(tiles), set(configs[3].tile_cache_file_map(z)))
+                for x, y in tiles:
+                    np.testing.assert_equal(
+                        configs[0].load_tile_cache_file(z, x, y),
+                        configs[3].load_tile_cache_file(z, x, y),
+                    )
+                # all blocks are marked done after their tiles are written
+                num_done = [
+                    (c.tile_cache_path() / str(z) / "journal.jsonl").read_text().count('"done"')
+                    for c in configs.values()
+                ]
+                self.assertGreater(num_done[0], 0)
+                self.assertEqual(num_done[0], num_done[1])
@@ -0,0 +1,150 @@
+import math
+import threading
+from contextlib import contextmanager
+from typing import Optional, List, Tuple, Generator, Set
+
+import mercantile
+import numpy as np
+import rasterio
+import rasterio.transform
+import rasterio.warp
+
+from .files import PathConfig
+from .opendtm import OpenDTM
+from .reproject import reproject_tile, sample_tile, src_crs, crs_3857
+
+
+class TileSource:
+    """
+    Height tiles from the tile cache, missing tiles are reprojected on demand
+    from the sectors they overlap and written back to the cache.
+
+    Open sector datasets are pooled, at most `max_open_sectors` idle handles are kept.
+    Safe to use from several threads.
+    """
+    def __init__(
+            self,
+            pathconfig: PathConfig,
+            resolution: Optional[int] = None,
+            max_open_sectors: int = 8,
+            write_back: bool = True,
+            verbose: bool = False,
+    ):
+        self.pathconfig = pathconfig
+        self.dtm = OpenDTM(pathconfig=pathconfig, verbose=verbose)
+        self.max_open_sectors = max_open_sectors
+        self.write_back = write_back
+        self.num_loaded = 0
+        self.num_reprojected = 0
+        self._resolution = resolution
+        self._lock = threading.Lock()
+        # the same tile is reprojected only once at a time
+        self._tile_locks = [threading.Lock() for _ in range(64)]
+        self._idle_handles: List[Tuple[Tuple[int, int], rasterio.DatasetReader, rasterio.transform.AffineTransformer]] = []
+        self._empty: Set[Tuple[int, int, int]] = set()
+
+    def resolution(self, z: int) -> int:
+        """
+        The resolution of the cached tiles of this zoom level, or the configured one
+        """
+        if self._resolution is None:
+            for (x, y), _ in self.pathconfig.iter_tile_cache_files(z):
+                self._resolution = self.pathconfig.load_tile_cache_file(z, x, y).shape[0]
+                break
+            else:
+                self._resolution = 256
+        return self._resolution
+
+    def close(self):
+        with self._lock:
+            for _, ds, _ in self._idle_handles:
+                ds.close()
+            self._idle_handles.clear()
+
+    def get_height(self, z: int, x: int, y: int) -> Optional[np.ndarray]:
+        """
+        :return: array of shape (resolution, resolution) with NaN for invalid pixels,
+            or None if no sector covers the tile
+        """
+        if (z, x, y) in self._empty:
+            return None
+        with self._tile_locks[hash((z, x, y)) % len(self._tile_locks)]:
+            if self.pathconfig.tile_cache_file_exists(z, x, y):
+                self.num_loaded += 1
+                return self.pathconfig.load_tile_cache_file(z, x, y)
+
+            tile = mercantile.Tile(x, y, z)
+            data = None
+            for sector in self.sectors_of_tile(tile):
+                with self._open_sector(sector) as (ds, transformer):
+                    sector_data = reproject_tile(ds, transformer, tile, self.resolution(z))
+                if sector_data is None:
+                    continue
+                if data is None:
+                    data = sector_data
+                else:
+                    vmask = ~np.isnan(sector_data)
+                    data[vmask] = sector_data[vmask]
+
+            if data is None:
+                self._empty.add((z, x, y))
+                return None
+            self.num_reprojected += 1
+            if self.write_back:
+                sample_tile(self.pathconfig, tile, data)
+            return data
+
+    def sectors_of_tile(self, tile: mercantile.Tile) -> List[Tuple[int, int]]:
+        """
+        The available sectors that overlap the tile
+        """
+        left, bottom, right, top = rasterio.warp.transform_bounds(crs_3857, src_crs, *mercantile.xy_bounds(tile))
+        sectors = []
+        for e in range(math.floor(left / 40000) * 40000, math.floor(right / 40000) * 40000 + 1, 40000):
+            for n in range(math.floor(bottom / 40000) * 40000, math.floor(top / 40000) * 40000 + 1, 40000):
+                sector = self.dtm.sector_at(e, n)
+                if sector is not None:
+                    sectors.append(sector)
+        return self.dtm.available_sectors(sectors)
+
+    @contextmanager
+    def _open_sector(
+            self,
+            sector: Tuple[int, int],
+    ) -> Generator[Tuple[rasterio.DatasetReader, rasterio.transform.AffineTransformer], None, None]:
+        handle = None
+        with self._lock:
+            for i, (s, ds, transformer) in enumerate(self._idle_handles):
+                if s == sector:
+                    handle = self._idle_handles.pop(i)
+                    break
+        if handle is None:
+            ds = self.dtm.open_sector(sector)
+            handle = (sector, ds, rasterio.transform.AffineTransformer(ds.transform))
+        try:
+            yield handle[1:]
+        finally:
+            with self._lock:
+                self._idle_handles.append(handle)
+                while len(self._idle_handles) > self.max_open_sectors:
+                    self._idle_handles.pop(0)[1].close()
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.num_loaded,
+            "reprojected": self.num_reprojected,
+            "empty": len(self._empty),
+        }
+
+
+def tiles_in_range(pathconfig: PathConfig, zoom: int) -> List[Tuple[int, int]]:
+    """
+    All tiles of the --tile-x/--tile-y ranges, which are required for lazy processing
+    """
+    if not pathconfig.tile_range_x or not pathconfig.tile_range_y:
+        raise ValueError("--lazy needs --tile-x and --tile-y ranges")
+    return [
+        (x, y)
+        for x in range(pathconfig.tile_range_x[0], pathconfig.tile_range_x[1] + 1)
+        for y in range(pathconfig.tile_range_y[0], pathconfig.tile_range_y[1] + 1)
+    ]
@@ -0,0 +1,120 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union, Dict
+
+
+class Timings:
+    """
+    Accumulates time, bytes and counts per processing stage.
+
+    Thread-safe, so all workers of a ThreadPool add to the same instance.
+    Snapshots of other processes can be merged in.
+
+        with timings.measure("npz_decode") as m:
+            array = np.load(filename)["arr_0"]
+            m["bytes"] = array.nbytes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, dict] = {}
+        self._start_time = time.time()
+
+    def add(self, stage: str, seconds: float, bytes: int = 0, count: int = 1):
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = {"count": 0, "seconds": 0., "bytes": 0}
+            s["count"] += count
+            s["seconds"] += seconds
+            s["bytes"] += bytes
+
+    @contextmanager
+    def measure(self, stage: str, bytes: int = 0):
+        info = {"bytes": bytes}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.add(stage, time.perf_counter() - start, bytes=info["bytes"])
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {stage: dict(s) for stage, s in self._stages.items()}
+
+    def merge(self, snapshot: Dict[str, dict]):
+        for stage, s in snapshot.items():
+            self.add(stage, s["seconds"], bytes=s["bytes"], count=s["count"])
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._start_time = time.time()
+
+    def report(self) -> dict:
+        wall_time = time.time() - self._start_time
+        stages = {}
+        for stage, s in sorted(self.snapshot().items(), key=lambda i: -i[1]["seconds"]):
+            stages[stage] = {
+                **s,
+                "seconds": round(s["seconds"], 4),
+                "ms_per_call": round(s["seconds"] / s["count"] * 1000, 3) if s["count"] else None,
+                "mb_per_second": round(s["bytes"] / s["seconds"] / 1e6, 3) if s["seconds"] and s["bytes"] else None,
+            }
+        return {
+            "pid": os.getpid(),
+            "wall_seconds": round(wall_time, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": stages,
+        }
+
+    def log_line(self) -> str:
+        parts = [
+            f"{stage} {s['count']}x {s['seconds']:.2f}s"
+            + (f" {s['bytes'] / 1e6:.1f}MB" if s["bytes"] else "")
+            for stage, s in sorted(self.snapshot().items(), key=lambda i: -i[1]["seconds"])
+        ]
+        return "timings: " + ", ".join(parts)
+
+    def write_report(self, filename: Union[str, Path], **extra):
+        filename = Path(filename)
+        if filename.parent:
+            os.makedirs(filename.parent, exist_ok=True)
+        filename.write_text(json.dumps({**extra, **self.report()}, indent=2))
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+# the process-wide instance all stages report to
+timings = Timings()
+
+
+class PeriodicLogger:
+    """
+    Prints the accumulated timings to stderr every `interval` seconds in a daemon thread
+    """
+    def __init__(self, interval: float, timings_: Optional[Timings] = None):
+        self.interval = interval
+        self.timings = timings_ or timings
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            print(self.timings.log_line(), file=sys.stderr)
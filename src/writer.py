@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Callable, Union, List, Dict, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from .files import PathConfig
+from .timing import timings
+
+if TYPE_CHECKING:
+    import PIL.Image
+
+
+class TileWriter:
+    """
+    Encodes and writes cache and output tiles in background threads,
+    so the compute threads don't wait for `np.savez_compressed`, png encoding and the disk.
+
+    Each file always goes to the same worker, so two writes of one tile land in order.
+    The queues are bounded, a full queue blocks the compute threads (see the `writer_wait` timing).
+    Arrays that are queued but not yet written are returned by `pending_array`, so a merge
+    into a tile never misses a previous write. The workers call the `save_*` methods
+    of the PathConfig, which write a temporary file and rename it.
+
+    With `workers=0` the tiles are written immediately in the calling thread.
+
+    The first error of a worker is raised by the next `save_*`, `flush` or `close` call.
+    """
+    def __init__(self, workers: int = 2, max_queued: int = 64):
+        self.workers = max(0, workers)
+        self.num_written = 0
+        self._lock = threading.Lock()
+        self._pending: Dict[Path, Tuple[np.ndarray, int]] = {}
+        self._sequence = 0
+        self._errors: List[Exception] = []
+        self._queues = [queue.Queue(maxsize=max(1, max_queued // max(1, self.workers))) for _ in range(self.workers)]
+        self._threads = [
+            threading.Thread(target=self._worker, args=(q, ), daemon=True)
+            for q in self._queues
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # don't hide the error of the compute thread
+        self.close(raise_errors=exc_type is None)
+
+    def save_tile_cache_file(
+            self,
+            pathconfig: PathConfig,
+            z: int, x: int, y: int,
+            array: np.ndarray,
+            modality: str = "height",
+    ):
+        """
+        Like `PathConfig.save_tile_cache_file`, the array must not be changed afterwards
+        """
+        self._submit(
+            pathconfig.tile_cache_filename(z, x, y, modality=modality), array,
+            lambda: pathconfig.save_tile_cache_file(z, x, y, array, modality=modality),
+        )
+
+    def save_output_tile(
+            self,
+            pathconfig: PathConfig,
+            z: int, x: int, y: int,
+            array: Union[np.ndarray, "PIL.Image.Image"],
+            modality: str = "height",
+    ):
+        """
+        Like `PathConfig.save_output_tile`, the array must not be changed afterwards
+        """
+        self._submit(
+            pathconfig.tile_output_filename(z, x, y, modality=modality), array,
+            lambda: pathconfig.save_output_tile(z, x, y, array, modality=modality),
+        )
+
+    def pending_array(self, filename: Path) -> Optional[np.ndarray]:
+        """
+        The latest array of the file that is not yet written, do not change it
+        """
+        with self._lock:
+            entry = self._pending.get(filename)
+        return None if entry is None else entry[0]
+
+    def on_written(self, callback: Callable[[], None]):
+        """
+        Call the function in a worker thread once all tiles queued so far are written.
+        It is not called if a write failed.
+        """
+        if not self.workers:
+            self._raise_errors()
+            callback()
+            return
+        remaining = [len(self._queues)]
+        for q in self._queues:
+            self._put(q, ("barrier", remaining, callback))
+
+    def flush(self):
+        """
+        Wait until all queued tiles are written
+        """
+        for q in self._queues:
+            q.join()
+        self._raise_errors()
+
+    def close(self, raise_errors: bool = True):
+        for q in self._queues:
+            self._put(q, None)
+        for thread in self._threads:
+            thread.join()
+        self._queues, self._threads = [], []
+        if raise_errors:
+            self._raise_errors()
+
+    def _submit(self, filename: Path, array, save: Callable[[], None]):
+        self._raise_errors()
+        if not self.workers:
+            self._write(save)
+            return
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+            if isinstance(array, np.ndarray):
+                self._pending[filename] = (array, sequence)
+        self._put(
+            self._queues[hash(filename) % len(self._queues)],
+            ("write", filename, save, sequence),
+        )
+
+    def _put(self, q: queue.Queue, item):
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            q.put(item)
+            timings.add("writer_wait", time.perf_counter() - start)
+
+    def _worker(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    break
+                if item[0] == "barrier":
+                    _, remaining, callback = item
+                    with self._lock:
+                        remaining[0] -= 1
+                        is_last = not remaining[0]
+                    if is_last and not self._errors:
+                        callback()
+                else:
+                    _, filename, save, sequence = item
+                    try:
+                        if not self._errors:
+                            self._write(save)
+                    finally:
+                        with self._lock:
+                            entry = self._pending.get(filename)
+                            if entry is not None and entry[1] == sequence:
+                                del self._pending[filename]
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                q.task_done()
+
+    def _write(self, save: Callable[[], None]):
+        save()
+        with self._lock:
+            self.num_written += 1
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]